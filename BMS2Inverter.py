@@ -10,20 +10,39 @@ Purpose:
 Feature Details:
 '''
 
+from time import monotonic
+StartTime = monotonic()            #startup budget is measured from here
+
 import can
 #import argparse
-import paho.mqtt.client as mqtt
 import struct
 from enum import Enum
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import threading
-from time import sleep
+import itertools
+import heapq
+import bisect
+import contextlib
+import functools
+import signal
+from time import sleep, time, perf_counter
 import json
+import queue
 import yaml
 import os
+import select
+import mmap
+import socket
+import shlex
+import subprocess
+import urllib.request
+import termios
 from datetime import datetime, timedelta
 import math
+from collections import OrderedDict, deque
+from array import array
+import BMSStateReader
 
 
 #region ********** Metrics Class ************
@@ -45,6 +64,34 @@ class BMStoInverterMetrics ():
    BMSBytesWritten = 0
    InverterBytesWritten = 0
    InverterBytesRead = 0
+   MQTTConnected = False
+   MQTTConnects = 0
+   MQTTQueueDepth = 0
+   MQTTInflight = 0
+   MQTTDropped = 0
+   MQTTCoalesced = 0
+   MQTTPublishErrors = 0
+   MQTTAckLatencyMs = 0
+   MQTTAckLatencyMaxMs = 0
+   MQTTAckTimeouts = 0
+   lastRS485Write = None
+   RS485Polls = 0
+   RS485Errors = 0
+   DashboardClients = 0
+   DashboardDroppedClients = 0
+   CaptureDumps = 0
+   InverterLateFrames = 0
+   InverterOverruns = 0
+   StartupMs = 0
+   InverterFramesFiltered = 0
+   BMSDecodeErrors = 0
+   InverterSendUs = 0
+   AlarmNotifications = 0
+   AlarmNotifyErrors = 0
+   InverterSendMaxUs = 0
+   ConfigReloads = 0
+   ConfigReloadErrors = 0
+   ConfigReloadLatencyMs = 0
 
 
    def friendlySize(self,bytes):
@@ -93,9 +140,16 @@ class BMSDiscoverSCBatteryLimits ():
    requestedMaximumDischargeCurrent = 0.0;
    lowBatteryCutOutVoltage = 0.0;
 
+   # (field, struct code, divisor), shared with the offline trace analytics
+   fields = (('requestedChargeVoltage', 'H', 10),
+             ('requestedChargeCurrent', 'H', 10),
+             ('requestedMaximumDischargeCurrent', 'H', 10),
+             ('lowBatteryCutOutVoltage', 'H', 10))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
+
    def decode(self, buffer):
       # Unpack 8 bytes (little endian)      
-      unpackedBuffer = struct.unpack("<HHHH", buffer) 
+      unpackedBuffer = self.layout.unpack(buffer) 
 
       self.requestedChargeVoltage = unpackedBuffer[0]/10
       self.requestedChargeCurrent = unpackedBuffer[1]/10
@@ -120,9 +174,15 @@ class BMSDiscoverSCBatteryCapacity ():
    batteryNominalCapacity = 0
    batteryRemainingCapacity = 0
 
+   fields = (('batteryNominalCapacity', 'H', 1),
+             ('batteryRemainingCapacity', 'H', 1),
+             (None, 'H', 1),
+             (None, 'H', 1))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
+
    def decode(self, buffer):
       # Unpack 8 bytes (little endian)      
-      unpackedBuffer = struct.unpack("<HHHH", buffer) 
+      unpackedBuffer = self.layout.unpack(buffer) 
 
       self.batteryNominalCapacity = unpackedBuffer[0]
       self.batteryRemainingCapacity = unpackedBuffer[1]
@@ -145,9 +205,15 @@ class BMSDiscoverSCBatteryStatus ():
    batteryStateOfCharge = 0
    batteryStateOfHealth = 0
 
+   fields = (('batteryStateOfCharge', 'H', 1),
+             ('batteryStateOfHealth', 'H', 1),
+             (None, 'H', 1),
+             (None, 'H', 1))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
+
    def decode(self, buffer):
       # Unpack 8 bytes (little endian)      
-      unpackedBuffer = struct.unpack("<HHHH", buffer) 
+      unpackedBuffer = self.layout.unpack(buffer) 
 
       self.batteryStateOfCharge = unpackedBuffer[0]
       self.batteryStateOfHealth = unpackedBuffer[1]
@@ -172,28 +238,20 @@ class BMSDiscoverSCBatteryMeasurements ():
    batteryCurrent = 0.0
    batteryTemperature = 0.0
    batteryTemperatureF = 0.0
-   lowVoltageWarning = 48.0
-   __lowVoltageCounter = 0
+
+   fields = (('batteryVoltage', 'H', 10),
+             ('batteryCurrent', 'h', 10),
+             ('batteryTemperature', 'h', 10),
+             (None, 'H', 1))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
 
    def decode(self, buffer):
       # Unpack 8 bytes (little endian)      
-      unpackedBuffer = struct.unpack("<HhhH", buffer) 
+      unpackedBuffer = self.layout.unpack(buffer) 
 
+      #--raw values only, glitch filtering of the lynk II readings is done by the
+      #--SignalConditioner stage in readBMS before the values reach the encoders
       self.batteryVoltage = unpackedBuffer[0]/10
- 
-      #--occasionaly we see an erroneous low voltage reported by the lynk II (46.x) volts
-      #--which causes the Midnite AIO inverter to go to standby causing a 20-30 second outage
-      #--to mitigate, we will not report to the inverter unless it occurs 3 times consecutively
-      if (self.batteryVoltage <= self.lowVoltageWarning):
-         self.__lowVoltageCounter += 1
-         logger.warning("Low voltage reported by BMS: " + str(self.batteryVoltage) + ", occurence count:" + self.__lowVoltageCounter)
-         logger.warning("0x356 message: " + buffer)
-         if (self.__lowVoltageCounter < 3):
-            self.batteryVoltage = self.lowVoltageWarning + 0.1
-            logger.error("Low voltage reported by BMS over 3 times:" + str(self.batteryVoltage) + ", occurence count:" + self.__lowVoltageCounter)
-      else:
-         self.__lowVoltageCounter = 0
-
       self.batteryCurrent = unpackedBuffer[1]/10
       self.batteryTemperature = unpackedBuffer[2]/10
       self.batteryTemperatureF = (self.batteryTemperature * 9/5) +32
@@ -263,88 +321,100 @@ Example:
   
   Byte  Value   Dec Value   Converted Value     Description   
 '''
-class BMSDiscoverSCBatteryAlarms ():
+'''
+Alarm frames (0x359 / 0x35A) repeat every second and almost never change.
+The payload is compared as one integer with the last frame and only decoded
+when it differs.  mask holds the active alarms as bits, bit n for the Alarm
+with value n + 1 and bit 64 + n for the protection, so the alarm events stage
+finds what was raised and cleared with one XOR.
+'''
+def alarmMask(alarms, protections):
+   mask = 0
+   for alarm in alarms:
+      mask |= 1 << (alarm.value - 1)
+   for protection in protections:
+      mask |= 1 << (protection.value + 63)
+   return mask
+
+class BMSAlarmFrame ():
    initialized = False
-
    alarms = {}
    protections = {}
+   payload = None
+   mask = 0
 
-   def __BytesTo2bits(self, data):
-      bits_array = []
-      doubleBitsArray = []
-      for byte in data:
-         bits = bin(byte)[2:].zfill(8)
-         bits_array.extend(map(int, bits))
-
-      for bittuple in zip(bits_array[::2], bits_array[1::2]):
-        #print (int(str(bit1) + str(bit2),2))
-        doubleBitsArray.append(int(str(bittuple[0]) + str(bittuple[1]),2))
+   def decode(self, buffer):
+      payload = int.from_bytes(buffer, 'little')
+      if payload == self.payload:
+         return
+      self.payload = payload
+      # new dicts swapped in whole, readers never see a partial update
+      self.alarms, self.protections = self.decodeAlarms(buffer)
+      self.mask = alarmMask(self.alarms, self.protections)
+      self.initialized = True
 
-      return doubleBitsArray
-   
-   def __setAlarm(self, alarm, BMSAlarmState):
+class BMSDiscoverSCBatteryAlarms (BMSAlarmFrame):
+
+   # (2 bit pair index, alarm, is protection) in decode order, shared with the
+   # offline trace analytics.  Pairs are numbered from the high bits of byte 0.
+   pairs = ((0, Alarm.FAILURE_OTHER, False),                    #General BMS Alarm
+            (1, Alarm.PACK_VOLTAGE_HIGH, False),                #High Voltage Alarm
+            (2, Alarm.PACK_VOLTAGE_LOW, False),                 #Low Voltage Alarm
+            (3, Alarm.DISCHARGE_TEMPERATURE_HIGH, False),       #High Temperature Discharge Alarm
+            (4, Alarm.DISCHARGE_TEMPERATURE_LOW, False),        #Low Temperature Discharge Alarm
+            (5, Alarm.CHARGE_TEMPERATURE_HIGH, False),          #High Temperature Charge Alarm
+            (6, Alarm.CHARGE_TEMPERATURE_LOW, False),           #Low Temperature Charge Alarm
+            (7, Alarm.DISCHARGE_CURRENT_HIGH, False),           #Battery High Discharge Alarm
+            (8, Alarm.CHARGE_CURRENT_HIGH, False),              #Battery High Charge Current Alarm
+            #skip (byte 2, bits 2-3)
+            (10, Alarm.FAILURE_OTHER, False),                   #Internal BMS Alarm
+            (11, Alarm.CELL_VOLTAGE_DIFFERENCE_HIGH, False),    #Imbalanced Cell Alarm
+            #skip (byte 3, bits 0-1)
+            #skip (byte 4, bits 2-3)
+            (14, Alarm.PACK_VOLTAGE_HIGH, True),                #High Voltage Warning
+            (15, Alarm.PACK_VOLTAGE_LOW, True),                 #Low Voltage Warning
+            (16, Alarm.DISCHARGE_TEMPERATURE_HIGH, True),       #High Temperature Discharge Warning
+            (17, Alarm.DISCHARGE_TEMPERATURE_LOW, True),        #Low Temperature Discharge Warning
+            (18, Alarm.CHARGE_TEMPERATURE_HIGH, True),          #High Temperature Charge Warning
+            (19, Alarm.CHARGE_TEMPERATURE_LOW, True),           #Low Tmperature Charge Warning
+            (20, Alarm.DISCHARGE_CURRENT_HIGH, True),           #Battery High Discharge Current Warning
+            (21, Alarm.CHARGE_CURRENT_HIGH, True),              #Battery High Charge Current Warning
+            #skip (byte 5, bits 4-5)
+            (23, Alarm.FAILURE_OTHER, True),                    #Internal BMS Warning
+            (24, Alarm.CELL_VOLTAGE_DIFFERENCE_HIGH, True))     #Imbalanced Cell Warning
+            #skip (bytes 6, bits 2-7)
+
+   def decodeAlarms(self, buffer):
       # Discover protocol sends 0=Ignored - Not Used, 1=Alarm/Warning, 2=Normal Operation, 3=Ignored - Not Used 
-      if BMSAlarmState != 1:
-         level=AlarmLevel.NONE
-      else:
-         level=AlarmLevel.ALARM
-      # Alarm 
-      if level != AlarmLevel.NONE:
-         self.alarms[alarm] = AlarmLevel.ALARM
-      else:
-         #Clear Alarm
-         if alarm in self.alarms:
-            del self.alarms[alarm]
+      alarms = {}
+      protections = {}
+      for index, alarm, protection in self.pairs:
+         if (buffer[index // 4] >> (6 - 2 * (index % 4))) & 3 == 1:
+            if protection:
+               protections[alarm] = AlarmLevel.WARNING
+            else:
+               alarms[alarm] = AlarmLevel.ALARM
+      return alarms, protections
 
-   def __setProtections(self, protection, BMSAlarmState):
-      # Discover protocol sends 0=Ignored - Not Used, 1=Alarm/Warning, 2=Normal Operation, 3=Ignored - Not Used 
-      if BMSAlarmState != 1:
-         level=AlarmLevel.NONE
-      else:
-         level=AlarmLevel.WARNING
-      # Alarm 
-      if level != AlarmLevel.NONE:
-         self.protections[protection] = AlarmLevel.WARNING
-      else:
-         #Clear Alarm
-         if protection in self.protections:
-            del self.protections[protection]
+'''
+Identity frames (0x35E, 0x370-0x373) repeat every 10s but almost never
+change.  The raw bytes are compared with the last frame and only decoded
+when they differ, revision counts the changes so the identity is only
+published when it changed.
+'''
+class BMSStaticFrame ():
+   initialized = False
+   raw = None
+   revision = 0
 
    def decode(self, buffer):
-      # Unpack 8 bytes (little endian)      
-      #unpackedBuffer = struct.unpack("<HHHc", buffer) 
-
-      #print (self.__access_bit(buffer,1))
-      errorWarningArray = self.__BytesTo2bits(buffer)
-      #logger.debug('Read 0x35A - Raw Alerts/Protections Array: %s', errorWarningArray)
-      self.__setAlarm(Alarm.FAILURE_OTHER, errorWarningArray[0])  #General BMS Alarm
-      self.__setAlarm(Alarm.PACK_VOLTAGE_HIGH, errorWarningArray[1])  #High Voltage Alarm
-      self.__setAlarm(Alarm.PACK_VOLTAGE_LOW, errorWarningArray[2])  #Low Voltage Alarm
-      self.__setAlarm(Alarm.DISCHARGE_TEMPERATURE_HIGH, errorWarningArray[3])  #High Temperature Discharge Alarm
-      self.__setAlarm(Alarm.DISCHARGE_TEMPERATURE_LOW, errorWarningArray[4])  #Low Temperature Discharge Alarm
-      self.__setAlarm(Alarm.CHARGE_TEMPERATURE_HIGH, errorWarningArray[5])  #High Temperature Charge Alarm
-      self.__setAlarm(Alarm.CHARGE_TEMPERATURE_LOW, errorWarningArray[6])  #Low Temperature Charge Alarm
-      self.__setAlarm(Alarm.DISCHARGE_CURRENT_HIGH, errorWarningArray[7])  #Battery High Discharge Alarm
-      self.__setAlarm(Alarm.CHARGE_CURRENT_HIGH, errorWarningArray[8])  #Battery High Charge Current Alarm
-      #skip (byte 2, bits 2-3)
-      self.__setAlarm(Alarm.FAILURE_OTHER, errorWarningArray[10]) #Internal BMS Alarm
-      self.__setAlarm(Alarm.CELL_VOLTAGE_DIFFERENCE_HIGH, errorWarningArray[11]) #Imbalanced Cell Alarm
-      #skip (byte 3, bits 0-1)
-      #skip (byte 4, bits 2-3)
-      self.__setProtections(Alarm.PACK_VOLTAGE_HIGH, errorWarningArray[14]) #High Voltage Warning
-      self.__setProtections(Alarm.PACK_VOLTAGE_LOW, errorWarningArray[15]) #Low Voltage Warning
-      self.__setProtections(Alarm.DISCHARGE_TEMPERATURE_HIGH, errorWarningArray[16]) #High Temperature Discharge Warning
-      self.__setProtections(Alarm.DISCHARGE_TEMPERATURE_LOW, errorWarningArray[17]) #Low Temperature Discharge Warning
-      self.__setProtections(Alarm.CHARGE_TEMPERATURE_HIGH, errorWarningArray[18]) #High Temperature Charge Warning
-      self.__setProtections(Alarm.CHARGE_TEMPERATURE_LOW, errorWarningArray[19]) #Low Tmperature Charge Warning
-      self.__setProtections(Alarm.DISCHARGE_CURRENT_HIGH, errorWarningArray[20]) #Battery High Discharge Current Warning
-      self.__setProtections(Alarm.CHARGE_CURRENT_HIGH, errorWarningArray[21]) #Battery High Charge Current Warning
-      #skip (byte 5, bits 4-5)
-      self.__setProtections(Alarm.FAILURE_OTHER, errorWarningArray[23]) #Internal BMS Warning
-      self.__setProtections(Alarm.CELL_VOLTAGE_DIFFERENCE_HIGH, errorWarningArray[24]) #Imbalanced Cell Warning
-      #skip (bytes 6, bits 2-7)
-
-      self.initialized = True;
+      if buffer == self.raw:
+         return
+      raw = bytes(buffer)
+      self.decodeStatic(raw)
+      self.raw = raw
+      self.revision += 1
+      self.initialized = True
 
 '''
 BMS Battery Manufacturer Name (0x35E)
@@ -355,14 +425,11 @@ Example:
   
   Bytes 0-7 ASCII = DISCOVER
 '''
-class BMSDiscoverSCBatteryManufacturer ():
-   initialized = False
+class BMSDiscoverSCBatteryManufacturer (BMSStaticFrame):
    manufacturer = ''
 
-   def decode(self, buffer):
-      # Unpack 8 bytes (little endian)      
+   def decodeStatic(self, buffer):
       self.manufacturer = buffer.decode('utf-8').rstrip('\u0000')
-      self.initialized = True
 
 '''
 BMS Battery Model Name Upper (0x370)
@@ -373,14 +440,11 @@ Example:
   
   Bytes 0-7 ASCII = NULL
 '''
-class BMSDiscoverSCModelNameUpper ():
-   initialized = False
+class BMSDiscoverSCModelNameUpper (BMSStaticFrame):
    modelName = ''
 
-   def decode(self, buffer):
-      # Unpack 8 bytes (little endian)      
+   def decodeStatic(self, buffer):
       self.modelName = buffer.decode('utf-8').rstrip('\u0000')
-      self.initialized = True
 
 '''
 BMS Battery Model Name Lower (0x371)
@@ -391,14 +455,11 @@ Example:
   
   Bytes 0-7 ASCII = NULL
 '''
-class BMSDiscoverSCModelNameLower ():
-   initialized = False
+class BMSDiscoverSCModelNameLower (BMSStaticFrame):
    modelName = ''
 
-   def decode(self, buffer):
-      # Unpack 8 bytes (little endian)      
+   def decodeStatic(self, buffer):
       self.modelName = buffer.decode('utf-8').rstrip('\u0000')
-      self.initialized = True
 
 '''
 BMS Battery Lynx Firmware (0x372)
@@ -409,19 +470,14 @@ Example:
   
   Bytes 0-7 unsigned integer (xx.yy.zz.tt) little endian = 2.1.0.0
 '''
-class BMSDiscoverSCLynxFirmware ():
-   initialized = False
+class BMSDiscoverSCLynxFirmware (BMSStaticFrame):
    versionString = ''
    versionInt = 0
 
-   def decode(self, buffer):
-      versionFmtString = ""
-      versionString = ""
-      for abyte in buffer:
-         versionFmtString = str(abyte) + "." + versionFmtString
-         versionString =  str(abyte) + versionString
-      self.versionString = versionFmtString[:-1]
-      self.versionInt = str(versionString)
+   def decodeStatic(self, buffer):
+      # versionInt orders like the version, 2.1.0.0 = 0x02010000
+      self.versionString = '.'.join(str(abyte) for abyte in reversed(buffer))
+      self.versionInt = int.from_bytes(buffer, 'little')
 
 '''
 BMS Battery Protocol Version (0x373)
@@ -432,15 +488,831 @@ Example:
   
   Byte 0 unsigned integer (xx) = 1
 '''
-class BMSDiscoverSCProtocolVersion():
-   initialized = False
+class BMSDiscoverSCProtocolVersion (BMSStaticFrame):
    versionString = ''
    versionInt = 0
 
-   def decode(self, buffer):
+   def decodeStatic(self, buffer):
       self.versionString = str(buffer[0])
       self.versionInt = buffer[0]
 
+'''
+BMS Module Cell Voltages (0x3C0 + module, module 0-15)
+Transmission Rate: 10000ms
+
+The 0x3C0 / 0x3D0 layouts below are not in the Lynk II protocol document and
+have not been checked against a real gateway, decoding them is off unless
+modules.enabled is set.
+
+Example: 
+  can0  3C1   [8]  F8 0C 1C 0D 03 0E 14 14
+  
+  Bytes Value   Dec Value   Converted Value     Description   
+  0-1   0CF8    3320        3.320v              Lowest Cell Voltage
+  2-3   0D1C    3356        3.356v              Highest Cell Voltage
+  4     03      3           3                   Lowest Cell Number
+  5     0E      14          14                  Highest Cell Number
+  6-7   1414    5140        51.40v              Module Voltage
+'''
+class BMSDiscoverModuleCells ():
+   fields = (('minCellVoltage', 'H', 1000),
+             ('maxCellVoltage', 'H', 1000),
+             ('minCellNumber', 'B', 1),
+             ('maxCellNumber', 'B', 1),
+             ('moduleVoltage', 'H', 100))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
+
+'''
+BMS Module Temperatures and Balancing (0x3D0 + module, module 0-15)
+Transmission Rate: 10000ms
+
+Example: 
+  can0  3D1   [8]  E6 00 FA 00 04 20 00 00
+  
+  Bytes Value   Dec Value   Converted Value     Description   
+  0-1   00E6    230         23.0 ºC             Lowest Module Temperature
+  2-3   00FA    250         25.0 ºC             Highest Module Temperature
+  4-5   2004    8196        cells 3 and 14      Balancing Cells (bit n = cell n+1)
+  6-7   0000    0           0                   Reserved
+'''
+class BMSDiscoverModuleTemperatures ():
+   fields = (('minTemperature', 'h', 10),
+             ('maxTemperature', 'h', 10),
+             ('balancingCells', 'H', 1),
+             (None, 'H', 1))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
+
+'''
+Per module telemetry from the two frames above.  Values are kept in their raw
+units (mV, 0.1 ºC) in one array per field indexed by module instead of an
+object per module.  The pack extremes (cell spread, weakest and hottest
+module) are updated as each frame arrives, the modules are only scanned again
+when a frame comes from the module holding an extreme.
+'''
+class BMSDiscoverModuleTelemetry ():
+   modules = 16
+   cellFrames = 0x3C0
+   temperatureFrames = 0x3D0
+
+   def __init__(self):
+      self.initialized = False
+      self.seenCells = 0                   #bit n set once module n has sent cell voltages
+      self.seenTemperatures = 0            #and temperatures
+      self.minCell = array('H', bytes(2 * self.modules))
+      self.maxCell = array('H', bytes(2 * self.modules))
+      self.minCellNumber = array('B', bytes(self.modules))
+      self.maxCellNumber = array('B', bytes(self.modules))
+      self.voltage = array('H', bytes(2 * self.modules))
+      self.minTemperature = array('h', bytes(2 * self.modules))
+      self.maxTemperature = array('h', bytes(2 * self.modules))
+      self.balancing = array('H', bytes(2 * self.modules))
+      self.weakestModule = -1              #lowest cell
+      self.strongestModule = -1            #highest cell
+      self.hottestModule = -1
+      self.balancingCells = 0
+
+   def __seenModules(self, seen):
+      return [module for module in range(self.modules) if seen >> module & 1]
+
+   def decodeCells(self, module, buffer):
+      minCell, maxCell, minNumber, maxNumber, voltage = BMSDiscoverModuleCells.layout.unpack(buffer)
+      self.minCell[module] = minCell
+      self.maxCell[module] = maxCell
+      self.minCellNumber[module] = minNumber
+      self.maxCellNumber[module] = maxNumber
+      self.voltage[module] = voltage
+      self.seenCells |= 1 << module
+
+      #the holder of an extreme may have moved either way, the others only take it over
+      if module == self.weakestModule:
+         self.weakestModule = min(self.__seenModules(self.seenCells), key=self.minCell.__getitem__)
+      elif self.weakestModule < 0 or minCell < self.minCell[self.weakestModule]:
+         self.weakestModule = module
+      if module == self.strongestModule:
+         self.strongestModule = max(self.__seenModules(self.seenCells), key=self.maxCell.__getitem__)
+      elif self.strongestModule < 0 or maxCell > self.maxCell[self.strongestModule]:
+         self.strongestModule = module
+      self.initialized = True
+
+   def decodeTemperatures(self, module, buffer):
+      minTemperature, maxTemperature, balancing, _ = BMSDiscoverModuleTemperatures.layout.unpack(buffer)
+      self.minTemperature[module] = minTemperature
+      self.maxTemperature[module] = maxTemperature
+      self.balancingCells += bin(balancing).count('1') - bin(self.balancing[module]).count('1')
+      self.balancing[module] = balancing
+      self.seenTemperatures |= 1 << module
+      self.initialized = True
+
+      if module == self.hottestModule:
+         self.hottestModule = max(self.__seenModules(self.seenTemperatures), key=self.maxTemperature.__getitem__)
+      elif self.hottestModule < 0 or maxTemperature > self.maxTemperature[self.hottestModule]:
+         self.hottestModule = module
+
+   def cellSpread(self):
+      # mV between the highest and the lowest cell of the pack
+      if self.weakestModule < 0:
+         return 0
+      return self.maxCell[self.strongestModule] - self.minCell[self.weakestModule]
+
+   def snapshot(self):
+      data = {
+         "cellSpreadMv": self.cellSpread(),
+         "minCellVoltage": self.minCell[self.weakestModule] / 1000 if self.weakestModule >= 0 else 0.0,
+         "maxCellVoltage": self.maxCell[self.strongestModule] / 1000 if self.strongestModule >= 0 else 0.0,
+         "weakestModule": self.weakestModule,
+         "hottestModule": self.hottestModule,
+         "maxModuleTemperature": self.maxTemperature[self.hottestModule] / 10 if self.hottestModule >= 0 else 0.0,
+         "balancingCells": self.balancingCells,
+         "modules": [{
+            "module": module,
+            "voltage": self.voltage[module] / 100,
+            "minCellVoltage": self.minCell[module] / 1000,
+            "maxCellVoltage": self.maxCell[module] / 1000,
+            "minCellNumber": self.minCellNumber[module],
+            "maxCellNumber": self.maxCellNumber[module],
+            "cellSpreadMv": self.maxCell[module] - self.minCell[module],
+            "minTemperature": self.minTemperature[module] / 10,
+            "maxTemperature": self.maxTemperature[module] / 10,
+            "balancing": [cell + 1 for cell in range(16) if self.balancing[module] >> cell & 1],
+         } for module in self.__seenModules(self.seenCells | self.seenTemperatures)]
+      }
+      return data
+
+'''
+--------------------------------------
+BMS Classes (Pylontech / SMA / Victron style input)
+--------------------------------------
+
+Decoders for BMS sources speaking an inverter style 0x35x protocol, e.g. a
+JK BMS in Pylontech CAN mode.  They fill the same state attributes as the
+Discover classes.
+'''
+
+'''
+BMS Battery Status (0x355), 4 to 8 bytes
+
+  Bytes Value   Dec Value   Converted Value     Description   
+  0-1   004D    77          77%                 Battery State of Charge
+  2-3   0064    100         100%                Battery State of Health
+'''
+class BMSPylonBatteryStatus (BMSDiscoverSCBatteryStatus):
+
+   def decode(self, buffer):
+      # Unpack first 4 bytes (little endian)      
+      unpackedBuffer = struct.unpack_from("<HH", buffer) 
+
+      self.batteryStateOfCharge = unpackedBuffer[0]
+      self.batteryStateOfHealth = unpackedBuffer[1]
+      self.initialized = True
+
+'''
+BMS Battery Measurements (0x356), 6 to 8 bytes
+
+  Bytes Value   Dec Value   Converted Value     Description   
+  0-1   14AA    5290        52.9 V              Battery Voltage (0.01 V)
+  2-3   FFA4    -92         -9.2 A              Battery Current
+  4-5   00F0    240         24 ºC               Battery Temperature
+'''
+class BMSPylonBatteryMeasurements (BMSDiscoverSCBatteryMeasurements):
+
+   def decode(self, buffer):
+      # Unpack first 6 bytes (little endian)      
+      unpackedBuffer = struct.unpack_from("<Hhh", buffer) 
+
+      self.batteryVoltage = unpackedBuffer[0]/100
+      self.batteryCurrent = unpackedBuffer[1]/10
+      self.batteryTemperature = unpackedBuffer[2]/10
+      self.batteryTemperatureF = (self.batteryTemperature * 9/5) +32
+      self.initialized = True
+
+'''
+BMS Pylontech Battery Alarms/Protections (0x359)
+
+  Byte 0/2 (alarm/warning)      Bit
+  CellOvervoltage               1
+  CellUndervoltage              2
+  CellOvertemperature           3
+  CellUndertemperature          4
+  DischargeOvercurrent          7
+  Byte 1/3 (alarm/warning)      Bit
+  ChargeOvercurrent             0
+  System                        3
+'''
+class BMSPylonBatteryAlarms (BMSAlarmFrame):
+   bits = (
+      (0, 1, (Alarm.PACK_VOLTAGE_HIGH,)),
+      (0, 2, (Alarm.PACK_VOLTAGE_LOW,)),
+      (0, 3, (Alarm.DISCHARGE_TEMPERATURE_HIGH, Alarm.CHARGE_TEMPERATURE_HIGH)),
+      (0, 4, (Alarm.DISCHARGE_TEMPERATURE_LOW, Alarm.CHARGE_TEMPERATURE_LOW)),
+      (0, 7, (Alarm.DISCHARGE_CURRENT_HIGH,)),
+      (1, 0, (Alarm.CHARGE_CURRENT_HIGH,)),
+      (1, 3, (Alarm.FAILURE_OTHER,)),
+   )
+
+   def __decodeBits(self, buffer, offset, level):
+      active = {}
+      for byteIndex, bitIndex, alarms in self.bits:
+         if buffer[offset + byteIndex] & (1 << bitIndex):
+            for alarm in alarms:
+               active[alarm] = level
+      return active
+
+   def decodeAlarms(self, buffer):
+      return self.__decodeBits(buffer, 0, AlarmLevel.ALARM), self.__decodeBits(buffer, 2, AlarmLevel.WARNING)
+
+'''
+BMS SMA / Victron Battery Alarms/Warnings (0x35A)
+
+Inverse of SMABatteryAlarms: 2 bit pairs, least significant pair first,
+01 = active.  Bytes 0-3 alarms, bytes 4-7 warnings.
+'''
+class BMSSMABatteryAlarms (BMSAlarmFrame):
+   pairs = (
+      (0, Alarm.FAILURE_OTHER),
+      (1, Alarm.PACK_VOLTAGE_HIGH),
+      (2, Alarm.PACK_VOLTAGE_LOW),
+      (3, Alarm.DISCHARGE_TEMPERATURE_HIGH),
+      (4, Alarm.DISCHARGE_TEMPERATURE_LOW),
+      (5, Alarm.CHARGE_TEMPERATURE_HIGH),
+      (6, Alarm.CHARGE_TEMPERATURE_LOW),
+      (7, Alarm.DISCHARGE_CURRENT_HIGH),
+      (8, Alarm.CHARGE_CURRENT_HIGH),
+      (10, Alarm.FAILURE_SHORT_CIRCUIT_PROTECTION),
+      (11, Alarm.FAILURE_OTHER),
+      (12, Alarm.CELL_VOLTAGE_DIFFERENCE_HIGH),
+   )
+
+   def __decodePairs(self, buffer, offset, level):
+      active = {}
+      for pair, alarm in self.pairs:
+         if (buffer[offset + pair // 4] >> ((pair % 4) * 2)) & 3 == 1:
+            active[alarm] = level
+      return active
+
+   def decodeAlarms(self, buffer):
+      return (self.__decodePairs(buffer, 0, AlarmLevel.ALARM),
+              self.__decodePairs(buffer, 4, AlarmLevel.WARNING) if len(buffer) >= 8 else {})
+
+#endregion
+
+#region ********** BMS Protocols **********
+'''
+--------------------------------------
+BMS input protocols
+--------------------------------------
+
+Each protocol maps the arbitration ids it understands to the shared battery
+state it fills (the BMSBattery* objects read by the inverter encoders and
+MQTT) and the decoder class to use.  The arbitration id dispatch table is
+built once when the protocol is loaded, readBMS does a single dict lookup
+per frame.
+
+To add a BMS, subclass BMSProtocol and add it to BMSProtocols.
+'''
+
+# shared battery state -> default (never initialized) implementation
+BMSStateModel = {
+   'BMSBatteryLimits': BMSDiscoverSCBatteryLimits,
+   'BMSBatteryCapacity': BMSDiscoverSCBatteryCapacity,
+   'BMSBatteryStatus': BMSDiscoverSCBatteryStatus,
+   'BMSBatteryMeasurements': BMSDiscoverSCBatteryMeasurements,
+   'BMSBatteryAlarms': BMSDiscoverSCBatteryAlarms,
+   'BMSManufacturer': BMSDiscoverSCBatteryManufacturer,
+   'BMSModelNameUpper': BMSDiscoverSCModelNameUpper,
+   'BMSModelNameLower': BMSDiscoverSCModelNameLower,
+   'BMSLynxFirmware': BMSDiscoverSCLynxFirmware,
+   'BMSProtocolVersion': BMSDiscoverSCProtocolVersion,
+   'BMSModules': BMSDiscoverModuleTelemetry,
+}
+
+def ignoreFrame(buffer):
+   pass
+
+class BMSProtocol ():
+   name = ''
+   decoders = {}        # arbitration id -> (state name, decoder class)
+   moduleFrames = {}    # first arbitration id -> (state name, decoder method), one id per module
+   ignoredFrames = ()   # known arbitration ids carrying nothing we use
+
+   def __init__(self, hooks=None, modules=True):
+      # hooks: state name -> function(buffer, now) run after that state is decoded
+      hooks = hooks or {}
+      self.state = {}
+      for stateName, decoder in BMSStateModel.items():
+         self.state[stateName] = decoder()
+      for stateName, decoder in self.decoders.values():
+         if type(self.state[stateName]) is not decoder:
+            self.state[stateName] = decoder()
+      self.dispatch = {}
+      for arbitrationId, (stateName, decoder) in self.decoders.items():
+         self.dispatch[arbitrationId] = (self.state[stateName].decode, hooks.get(stateName))
+      for firstId, (stateName, method) in self.moduleFrames.items():
+         state = self.state[stateName]
+         for module in range(state.modules):
+            if modules:
+               self.dispatch[firstId + module] = (functools.partial(getattr(state, method), module), hooks.get(stateName))
+            else:
+               self.dispatch[firstId + module] = (ignoreFrame, None)
+      for arbitrationId in self.ignoredFrames:
+         self.dispatch[arbitrationId] = (ignoreFrame, None)
+
+class DiscoverProtocol (BMSProtocol):
+   name = 'discover'
+   decoders = {
+      0x351: ('BMSBatteryLimits', BMSDiscoverSCBatteryLimits),
+      0x354: ('BMSBatteryCapacity', BMSDiscoverSCBatteryCapacity),
+      0x355: ('BMSBatteryStatus', BMSDiscoverSCBatteryStatus),
+      0x356: ('BMSBatteryMeasurements', BMSDiscoverSCBatteryMeasurements),
+      0x35A: ('BMSBatteryAlarms', BMSDiscoverSCBatteryAlarms),
+      0x35E: ('BMSManufacturer', BMSDiscoverSCBatteryManufacturer),
+      0x370: ('BMSModelNameUpper', BMSDiscoverSCModelNameUpper),
+      0x371: ('BMSModelNameLower', BMSDiscoverSCModelNameLower),
+      0x372: ('BMSLynxFirmware', BMSDiscoverSCLynxFirmware),
+      0x373: ('BMSProtocolVersion', BMSDiscoverSCProtocolVersion),
+   }
+   moduleFrames = {
+      BMSDiscoverModuleTelemetry.cellFrames: ('BMSModules', 'decodeCells'),
+      BMSDiscoverModuleTelemetry.temperatureFrames: ('BMSModules', 'decodeTemperatures'),
+   }
+
+class PylontechInProtocol (BMSProtocol):
+   name = 'pylontech'
+   decoders = {
+      0x351: ('BMSBatteryLimits', BMSDiscoverSCBatteryLimits),
+      0x355: ('BMSBatteryStatus', BMSPylonBatteryStatus),
+      0x356: ('BMSBatteryMeasurements', BMSPylonBatteryMeasurements),
+      0x359: ('BMSBatteryAlarms', BMSPylonBatteryAlarms),
+      0x35E: ('BMSManufacturer', BMSDiscoverSCBatteryManufacturer),
+   }
+   ignoredFrames = (0x35C,)
+
+class SMAInProtocol (BMSProtocol):
+   name = 'SMA'
+   decoders = {
+      0x351: ('BMSBatteryLimits', BMSDiscoverSCBatteryLimits),
+      0x355: ('BMSBatteryStatus', BMSPylonBatteryStatus),
+      0x356: ('BMSBatteryMeasurements', BMSPylonBatteryMeasurements),
+      0x35A: ('BMSBatteryAlarms', BMSSMABatteryAlarms),
+      0x35E: ('BMSManufacturer', BMSDiscoverSCBatteryManufacturer),
+   }
+   ignoredFrames = (0x35C, 0x35F)
+
+BMSProtocols = {protocol.name: protocol for protocol in (DiscoverProtocol, PylontechInProtocol, SMAInProtocol)}
+
+#endregion
+
+#region ********** Signal Conditioning **********
+'''
+--------------------------------------
+Signal Conditioning Classes
+--------------------------------------
+'''
+
+'''
+Fixed size ring buffer of floats
+
+Storage is a preallocated array so appending a sample never allocates.  With
+ordered the same samples are also kept sorted, the sample leaving the window
+is removed and the new one inserted by bisection, so median() reads the
+middle instead of sorting the window on every sample.
+'''
+class RingBuffer ():
+
+   def __init__(self, size, ordered=False):
+      self.size = size
+      self.values = array('d', bytes(8 * size))
+      self.ordered = array('d') if ordered else None
+      self.index = 0
+      self.count = 0
+
+   def append(self, value):
+      if self.ordered is not None:
+         if self.count == self.size:
+            del self.ordered[bisect.bisect_left(self.ordered, self.values[self.index])]
+         bisect.insort(self.ordered, value)
+      self.values[self.index] = value
+      self.index += 1
+      if self.index == self.size:
+         self.index = 0
+      if self.count < self.size:
+         self.count += 1
+
+   def median(self):
+      # needs ordered
+      ordered = self.ordered
+      middle = self.count // 2
+      if self.count % 2:
+         return ordered[middle]
+      return (ordered[middle - 1] + ordered[middle]) / 2
+
+   def samples(self):
+      return self.values[:self.count] if self.count < self.size else self.values[:]
+
+   def clear(self):
+      self.index = 0
+      self.count = 0
+      if self.ordered is not None:
+         del self.ordered[:]
+
+'''
+Consecutive sample confirmation
+
+A sample at or below confirmLow (or at or above confirmHigh) is only passed
+through once it has been seen confirmSamples times in a row.  Until then the
+last accepted value is held, or before any value was accepted the threshold
+moved inwards by margin, so the inverter is not handed the threshold itself.
+
+--occasionaly we see an erroneous low voltage reported by the lynk II (46.x) volts
+--which causes the Midnite AIO inverter to go to standby causing a 20-30 second outage
+--to mitigate, the voltage channel is configured by default to not report a low voltage
+--to the inverter unless it occurs 3 times consecutively
+'''
+class ConfirmationFilter ():
+   margin = 0.1
+
+   def __init__(self, name, samples, low=None, high=None):
+      self.name = name
+      self.samples = samples
+      self.low = low
+      self.high = high
+      self.counter = 0
+      self.lastAccepted = None
+
+   def apply(self, value, now, buffer):
+      if (self.low is not None and value <= self.low) or (self.high is not None and value >= self.high):
+         self.counter += 1
+         if self.counter < self.samples:
+            logger.warning("Out of range " + self.name + " reported by BMS: " + str(value) + ", occurence count: " + str(self.counter))
+            logger.warning("Raw message: " + buffer.hex(' '))
+            if self.lastAccepted is not None:
+               return self.lastAccepted
+            return self.low + self.margin if self.low is not None and value <= self.low else self.high - self.margin
+         if self.counter == self.samples:
+            logger.error("Out of range " + self.name + " reported by BMS " + str(self.samples) + " times consecutively: " + str(value))
+      else:
+         self.counter = 0
+      self.lastAccepted = value
+      return value
+
+'''
+Median of the last N samples
+'''
+class MedianFilter ():
+
+   def __init__(self, window):
+      self.buffer = RingBuffer(window, ordered=True)
+
+   def apply(self, value, now, buffer):
+      self.buffer.append(value)
+      return self.buffer.median()
+
+'''
+Rate of change limiter, maxRate is in units per second
+'''
+class RateLimitFilter ():
+
+   def __init__(self, maxRate):
+      self.maxRate = maxRate
+      self.lastValue = None
+      self.lastTime = 0.0
+
+   def apply(self, value, now, buffer):
+      if self.lastValue is not None:
+         maxStep = self.maxRate * (now - self.lastTime)
+         if value > self.lastValue + maxStep:
+            value = self.lastValue + maxStep
+         elif value < self.lastValue - maxStep:
+            value = self.lastValue - maxStep
+      self.lastValue = value
+      self.lastTime = now
+      return value
+
+'''
+Exponential moving average, alpha is the weight of the newest sample (0-1]
+'''
+class EMAFilter ():
+
+   def __init__(self, alpha):
+      self.alpha = alpha
+      self.lastValue = None
+
+   def apply(self, value, now, buffer):
+      if self.lastValue is None:
+         self.lastValue = value
+      else:
+         self.lastValue += self.alpha * (value - self.lastValue)
+      return self.lastValue
+
+'''
+Per field signal conditioning stage
+
+Sits between decode and encode.  Each field (voltage, current, temperature, soc)
+gets a chain of filters built once from the signalconditioning section of the
+config, applied in the order: confirm -> median -> max-rate -> ema
+
+Example config:
+  signalconditioning:
+    voltage:
+      confirm-samples: 3
+      confirm-low: 48.5     (defaults to BMS lowVoltageWarning)
+    current:
+      median: 3
+    temperature:
+      ema-alpha: 0.2
+    soc:
+      max-rate: 1
+'''
+class SignalConditioner ():
+   fieldNames = ('voltage', 'current', 'temperature', 'soc')
+
+   def __init__(self, config, lowVoltageWarning):
+      self.filters = {}
+      for name in self.fieldNames:
+         fieldConfig = config.get(name) or {}
+         if name == 'voltage':
+            #--preserve the historical lynk II low voltage glitch filter by default
+            fieldConfig = dict({'confirm-samples': 3, 'confirm-low': lowVoltageWarning}, **fieldConfig)
+         self.filters[name] = self.__buildChain(name, fieldConfig)
+
+   def __buildChain(self, name, fieldConfig):
+      chain = []
+      if fieldConfig.get('confirm-samples', 0) > 1:
+         chain.append(ConfirmationFilter(name, fieldConfig['confirm-samples'],
+                                         fieldConfig.get('confirm-low'), fieldConfig.get('confirm-high')))
+      if fieldConfig.get('median', 0) > 1:
+         chain.append(MedianFilter(fieldConfig['median']))
+      if fieldConfig.get('max-rate', 0) > 0:
+         chain.append(RateLimitFilter(fieldConfig['max-rate']))
+      if 0 < fieldConfig.get('ema-alpha', 0) < 1:
+         chain.append(EMAFilter(fieldConfig['ema-alpha']))
+      return tuple(chain)
+
+   def setLowVoltageWarning(self, lowVoltageWarning):
+      for valueFilter in self.filters['voltage']:
+         if isinstance(valueFilter, ConfirmationFilter) and valueFilter.low is not None:
+            valueFilter.low = lowVoltageWarning
+
+   def condition(self, name, value, now, buffer):
+      for valueFilter in self.filters[name]:
+         value = valueFilter.apply(value, now, buffer)
+      return value
+
+   def conditionMeasurements(self, measurements, buffer, now):
+      measurements.batteryVoltage = self.condition('voltage', measurements.batteryVoltage, now, buffer)
+      measurements.batteryCurrent = self.condition('current', measurements.batteryCurrent, now, buffer)
+      measurements.batteryTemperature = self.condition('temperature', measurements.batteryTemperature, now, buffer)
+      measurements.batteryTemperatureF = (measurements.batteryTemperature * 9/5) +32
+
+   def conditionStatus(self, status, buffer, now):
+      status.batteryStateOfCharge = self.condition('soc', status.batteryStateOfCharge, now, buffer)
+
+#endregion
+
+#region ********** SOC Estimator **********
+'''
+--------------------------------------
+Coulomb counting SOC estimator
+--------------------------------------
+
+The BMS only reports SOC (0x355) and remaining capacity (0x354) as integers.
+The estimator integrates battery current from every 0x356 frame against
+monotonic timestamps to give a higher resolution SOC, and keeps itself
+anchored to the BMS by clamping the integrated remaining capacity to within
+one unit of the latest BMS readings.  Each update is O(1) with no
+containers allocated.
+'''
+class SOCEstimator ():
+   initialized = False
+   remainingCapacity = 0.0    #Ah
+   nominalCapacity = 0        #Ah
+   stateOfCharge = 0.0        #%
+   averageCurrent = 0.0       #A, smoothed for time to empty/full
+   timeToEmpty = -1           #minutes, -1 when not discharging
+   timeToFull = -1            #minutes, -1 when not charging
+
+   def __init__(self, maxGapSeconds=10, currentAlpha=0.1):
+      self.maxGapSeconds = maxGapSeconds
+      self.currentAlpha = currentAlpha
+      self.__lastCurrent = 0.0
+      self.__lastTime = None
+      self.__capacityAnchor = None
+      self.__socAnchor = None
+
+   def __clamp(self):
+      if self.__capacityAnchor is not None:
+         if self.remainingCapacity < self.__capacityAnchor - 1:
+            self.remainingCapacity = self.__capacityAnchor - 1.0
+         elif self.remainingCapacity > self.__capacityAnchor + 1:
+            self.remainingCapacity = self.__capacityAnchor + 1.0
+      if self.__socAnchor is not None and self.nominalCapacity > 0:
+         socUnit = self.nominalCapacity / 100
+         if self.remainingCapacity < (self.__socAnchor - 1) * socUnit:
+            self.remainingCapacity = (self.__socAnchor - 1) * socUnit
+         elif self.remainingCapacity > (self.__socAnchor + 1) * socUnit:
+            self.remainingCapacity = (self.__socAnchor + 1) * socUnit
+      if self.remainingCapacity < 0:
+         self.remainingCapacity = 0.0
+      elif self.nominalCapacity > 0 and self.remainingCapacity > self.nominalCapacity:
+         self.remainingCapacity = float(self.nominalCapacity)
+
+   def anchorCapacity(self, remainingCapacity, nominalCapacity):
+      self.nominalCapacity = nominalCapacity
+      if not self.initialized:
+         self.remainingCapacity = float(remainingCapacity)
+         self.initialized = True
+      self.__capacityAnchor = remainingCapacity
+      self.__clamp()
+
+   def anchorSOC(self, stateOfCharge):
+      self.__socAnchor = stateOfCharge
+      if self.initialized:
+         self.__clamp()
+
+   def update(self, current, now):
+      if self.__lastTime is not None and now - self.__lastTime <= self.maxGapSeconds:
+         #trapezoidal integration of Ah over the interval
+         self.remainingCapacity += (self.__lastCurrent + current) * (now - self.__lastTime) / 7200
+      self.__lastTime = now
+      self.__lastCurrent = current
+      self.averageCurrent += self.currentAlpha * (current - self.averageCurrent)
+
+      if not self.initialized or self.nominalCapacity <= 0:
+         return
+      self.__clamp()
+      self.stateOfCharge = self.remainingCapacity * 100 / self.nominalCapacity
+      if self.averageCurrent < 0:
+         self.timeToEmpty = int(self.remainingCapacity * 60 / -self.averageCurrent)
+         self.timeToFull = -1
+      elif self.averageCurrent > 0:
+         self.timeToEmpty = -1
+         self.timeToFull = int((self.nominalCapacity - self.remainingCapacity) * 60 / self.averageCurrent)
+      else:
+         self.timeToEmpty = -1
+         self.timeToFull = -1
+
+#endregion
+
+#region ********** Energy Accounting **********
+'''
+--------------------------------------
+Energy accounting
+--------------------------------------
+
+Integrates battery power (V * A) from every 0x356 frame into charge and
+discharge Wh and Ah totals plus hourly and daily buckets.  Each update is a
+few float additions, the buckets only roll over when the wall clock crosses
+an hour.  Equivalent full cycles are discharged Ah over the nominal capacity
+and round trip efficiency is discharged over charged Wh.
+
+Totals and buckets are checkpointed to a JSON file from the main loop (never
+from the reader) and loaded again at startup, so a restart loses at most one
+checkpoint interval.
+'''
+class EnergyAccumulator ():
+
+   def __init__(self, fileName, checkpointInterval=300, hours=48, days=31, maxGapSeconds=10):
+      self.fileName = fileName
+      self.checkpointInterval = checkpointInterval
+      self.maxGapSeconds = maxGapSeconds
+      self.chargeWh = 0.0
+      self.dischargeWh = 0.0
+      self.chargeAh = 0.0
+      self.dischargeAh = 0.0
+      self.hours = deque(maxlen=hours)        #[hour label, charge Wh, discharge Wh]
+      self.days = deque(maxlen=days)          #[date label, charge Wh, discharge Wh]
+      self.__hourEnd = 0.0
+      self.__dayEnd = 0.0
+      self.__lastPower = 0.0
+      self.__lastCurrent = 0.0
+      self.__lastTime = None
+      self.__lastCheckpoint = monotonic()
+      self.__load()
+
+   def __load(self):
+      try:
+         with open(self.fileName) as f:
+            saved = json.load(f)
+      except FileNotFoundError:
+         return
+      except (OSError, ValueError) as e:
+         logger.error ('Energy totals not loaded from ' + self.fileName + ', starting from zero: ' + str(e))
+         return
+      self.applyHandoff(saved)
+      logger.info ('Energy totals loaded from ' + self.fileName)
+
+   def __roll(self, wallTime):
+      # start new buckets once the wall clock has passed the current hour / day
+      hour = datetime.fromtimestamp(wallTime).replace(minute=0, second=0, microsecond=0)
+      if wallTime >= self.__hourEnd:
+         label = hour.strftime('%Y-%m-%dT%H')
+         if not self.hours or self.hours[-1][0] != label:
+            self.hours.append([label, 0.0, 0.0])
+         self.__hourEnd = (hour + timedelta(hours=1)).timestamp()
+      if wallTime >= self.__dayEnd:
+         day = hour.replace(hour=0)
+         label = day.strftime('%Y-%m-%d')
+         if not self.days or self.days[-1][0] != label:
+            self.days.append([label, 0.0, 0.0])
+         self.__dayEnd = (day + timedelta(days=1)).timestamp()
+
+   def update(self, voltage, current, now, wallTime):
+      power = voltage * current
+      if self.__lastTime is not None and now - self.__lastTime <= self.maxGapSeconds:
+         #trapezoidal integration over the interval
+         seconds = now - self.__lastTime
+         wh = (self.__lastPower + power) * seconds / 7200
+         ah = (self.__lastCurrent + current) * seconds / 7200
+         if wallTime >= self.__hourEnd:
+            self.__roll(wallTime)
+         if wh >= 0:
+            self.chargeWh += wh
+            self.hours[-1][1] += wh
+            self.days[-1][1] += wh
+         else:
+            self.dischargeWh -= wh
+            self.hours[-1][2] -= wh
+            self.days[-1][2] -= wh
+         if ah >= 0:
+            self.chargeAh += ah
+         else:
+            self.dischargeAh -= ah
+      self.__lastTime = now
+      self.__lastPower = power
+      self.__lastCurrent = current
+
+   def equivalentCycles(self, nominalCapacity):
+      return self.dischargeAh / nominalCapacity if nominalCapacity > 0 else 0.0
+
+   def roundTripEfficiency(self):
+      return self.dischargeWh / self.chargeWh if self.chargeWh > 0 else 0.0
+
+   def summary(self, nominalCapacity):
+      today = self.days[-1] if self.days else ['', 0.0, 0.0]
+      return {
+         "chargeKWh": round(self.chargeWh / 1000, 3),
+         "dischargeKWh": round(self.dischargeWh / 1000, 3),
+         "equivalentCycles": round(self.equivalentCycles(nominalCapacity), 3),
+         "roundTripEfficiency": round(self.roundTripEfficiency(), 4),
+         "todayChargeKWh": round(today[1] / 1000, 3),
+         "todayDischargeKWh": round(today[2] / 1000, 3),
+      }
+
+   def buckets(self):
+      return {
+         "hours": [{"hour": label, "chargeKWh": round(charge / 1000, 3), "dischargeKWh": round(discharge / 1000, 3)}
+                   for label, charge, discharge in list(self.hours)],
+         "days": [{"day": label, "chargeKWh": round(charge / 1000, 3), "dischargeKWh": round(discharge / 1000, 3)}
+                  for label, charge, discharge in list(self.days)],
+      }
+
+   def handoffState(self):
+      # totals and buckets, as checkpointed and as handed to a standby bridge
+      return {
+         'chargeWh': self.chargeWh,
+         'dischargeWh': self.dischargeWh,
+         'chargeAh': self.chargeAh,
+         'dischargeAh': self.dischargeAh,
+         'hours': [list(bucket) for bucket in list(self.hours)],
+         'days': [list(bucket) for bucket in list(self.days)],
+      }
+
+   def applyHandoff(self, saved):
+      # replaces the totals, the reader may be updating meanwhile so buckets are
+      # swapped in whole and never left empty
+      self.chargeWh = saved.get('chargeWh', 0.0)
+      self.dischargeWh = saved.get('dischargeWh', 0.0)
+      self.chargeAh = saved.get('chargeAh', 0.0)
+      self.dischargeAh = saved.get('dischargeAh', 0.0)
+      if saved.get('hours'):
+         self.hours = deque(saved['hours'], maxlen=self.hours.maxlen)
+         self.__hourEnd = 0.0
+      if saved.get('days'):
+         self.days = deque(saved['days'], maxlen=self.days.maxlen)
+         self.__dayEnd = 0.0
+
+   def checkpoint(self, now, force=False):
+      if not force and now - self.__lastCheckpoint < self.checkpointInterval:
+         return
+      self.__lastCheckpoint = now
+      saved = self.handoffState()
+      #written aside and renamed so a crash mid write keeps the previous checkpoint
+      try:
+         with open(self.fileName + '.tmp', 'w') as f:
+            json.dump(saved, f)
+            f.flush()
+            os.fsync(f.fileno())
+         os.replace(self.fileName + '.tmp', self.fileName)
+      except OSError as e:
+         logger.error ('Energy checkpoint to ' + self.fileName + ' failed: ' + str(e))
+
+def createEnergyAccumulator():
+   if EnergyParam.get('enabled', False):
+      return EnergyAccumulator(EnergyParam.get('file', '/var/lib/BMS2Inverter/energy.json'),
+                               EnergyParam.get('checkpoint-interval', 300),
+                               EnergyParam.get('hours', 48),
+                               EnergyParam.get('days', 31))
+   return None
+
 #endregion
 
 #region ********** Inverter Classes **********
@@ -495,14 +1367,14 @@ class PylonBatteryStatus ():
    CellBalancingRemainingTime = 0
    IsCellBalancingActive = False
 
-   def __init__(self):
-      self.cellBalancing = CellBalancing()
-      self.cellBalancing.holdSOC =  CellBalancingHoldSOCParam
-      self.cellBalancing.cellBalancingInterval = CellBalancingIntervalParam
-      self.cellBalancing.cellBalancingMinutes = CellBalancingMinutesParam
+   def __init__(self, cellBalancing=None):
+      if cellBalancing is None:
+         cellBalancing = CellBalancing()
+         cellBalancing.applySettings(CurrentSettings)
+      self.cellBalancing = cellBalancing
 
-   def encode(self):
-      # Pack 8 bytes (little endian)   
+   def evaluateSOC(self):
+      # SOC reported to the inverter, held while cell balancing
       if BMSBatteryStatus.initialized:   
          self.InverterFakeoutSOC = self.cellBalancing.evaluateSOC(BMSBatteryStatus.batteryStateOfCharge)
          #self.InverterFakeoutSOC = BMSBatteryStatus.batteryStateOfCharge
@@ -511,6 +1383,13 @@ class PylonBatteryStatus ():
          logger.debug ("PylonBatteryStatus x355, InverterFakeoutSOC:" + str(self.InverterFakeoutSOC) +
                        " CellBalancing Remaining Time:" + str(self.CellBalancingRemainingTime) +
                        " CellBalancing Active: " + str(self.IsCellBalancingActive))
+         return True
+      else:
+         return False
+
+   def encode(self):
+      # Pack 8 bytes (little endian)   
+      if self.evaluateSOC():
          self.message = struct.pack ('<HHHH', int(self.InverterFakeoutSOC), 
                      int(BMSBatteryStatus.batteryStateOfHealth), 
                      0,
@@ -587,9 +1466,7 @@ Example:
 class PylonBatteryAlarms ():
    frame = 0x0359
    message = ""
-
-   def __init__(self):
-      self.inverterOutputProtocol = InverterOutputProtocolParam
+   signature = (0x50, 0x4E) #PN
 
    def __set_bit(self, byteArrayp, byte_index, bit_index):
        byteT = byteArrayp[byte_index]
@@ -649,12 +1526,7 @@ class PylonBatteryAlarms ():
          if Alarm.FAILURE_OTHER in BMSBatteryAlarms.protections: self.__set_bit(alarmsByteArray,3,3)
 
          alarmsByteArray[4] = 1   # module number
-         if self.inverterOutputProtocol == "UZEnergy":
-            alarmsByteArray[5] = 0x55 #U
-            alarmsByteArray[6] = 0x5A #Z
-         else:
-            alarmsByteArray[5] = 0x50 #P
-            alarmsByteArray[6] = 0x4E #N
+         alarmsByteArray[5], alarmsByteArray[6] = self.signature
 
          self.message=alarmsByteArray
 
@@ -662,6 +1534,17 @@ class PylonBatteryAlarms ():
       else:
          return False
 
+'''
+UZEnergy Battery Alarms/Protections (0x359)
+
+Same as Pylontech with a UZ signature
+
+Example: 
+  can0  359   [7]  00 00 00 00 01 55 5A
+'''
+class UZEnergyBatteryAlarms (PylonBatteryAlarms):
+   signature = (0x55, 0x5A) #UZ
+
 '''
 Pylon Battery Manufacturer Name (0x35E)
 
@@ -673,18 +1556,172 @@ Example:
 class PylonBatteryManufacturer ():
    frame = 0x035E
    message = ""
+   revision = 0
 
    def encode(self):
-      # pack 8 bytes 
+      # pack 8 bytes, only when the BMS sent a different name
       if BMSManufacturer.initialized:     
-         self.message = bytearray(BMSManufacturer.manufacturer.encode())
-         #struct.pack('cccccccc',BMSManufacturer.manufacturer)
+         if self.revision != BMSManufacturer.revision:
+            self.message = bytearray(BMSManufacturer.manufacturer.encode())
+            self.revision = BMSManufacturer.revision
+         return True
+      else:
+         return False
+
+'''
+--------------------------------------
+Inverter Classes (SMA / Victron style 0x35x Protocol)
+--------------------------------------
+
+0x351 and 0x356 share the Pylontech layout, 0x355 adds a high resolution SOC
+and 0x35A replaces 0x359 with 2 bit alarm / warning pairs.  No 0x35C frame.
+'''
+
+'''
+SMA Battery Status (0x355)
+
+Example: 
+  can0  355   [6]  4D 00 64 00 14 1E
+  
+  Bytes Value   Dec Value   Converted Value     Description   
+  0-1   004D    77          77%                 Battery State of Charge
+  2-3   0064    100         100%                Battery State of Health
+  4-5   1E14    7700        77.00%              Battery State of Charge (0.01%)
+'''
+class SMABatteryStatus (PylonBatteryStatus):
+
+   def encode(self):
+      # Pack 6 bytes (little endian)   
+      if self.evaluateSOC():
+         if self.IsCellBalancingActive or BMSSOCEstimator is None or not BMSSOCEstimator.initialized:
+            highResolutionSOC = int(self.InverterFakeoutSOC) * 100
+         else:
+            highResolutionSOC = int(BMSSOCEstimator.stateOfCharge * 100)
+         self.message = struct.pack ('<HHH', int(self.InverterFakeoutSOC), 
+                     int(BMSBatteryStatus.batteryStateOfHealth), 
+                     highResolutionSOC)
+         return True
+      else:
+         return False
+
+'''
+SMA Battery Alarms/Warnings (0x35A)
+
+Example: 
+  can0  35A   [8]  AA AA AA 02 AA AA AA 02
+
+  Each condition is a 2 bit pair, least significant pair first:
+  01 = active, 10 = normal, 00 = not supported
+  Bytes 0-3 alarms, bytes 4-7 warnings (same pair order)
+  Pair  Description
+  0     General
+  1     High Voltage
+  2     Low Voltage
+  3     High Temperature
+  4     Low Temperature
+  5     High Temperature Charge
+  6     Low Temperature Charge
+  7     High Discharge Current
+  8     High Charge Current
+  9     Contactor
+  10    Short Circuit
+  11    BMS Internal
+  12    Cell Imbalance
+'''
+class SMABatteryAlarms ():
+   frame = 0x035A
+   message = ""
+   pairs = (
+      (0, Alarm.FAILURE_OTHER),
+      (1, Alarm.PACK_VOLTAGE_HIGH),
+      (2, Alarm.PACK_VOLTAGE_LOW),
+      (3, Alarm.DISCHARGE_TEMPERATURE_HIGH),
+      (4, Alarm.DISCHARGE_TEMPERATURE_LOW),
+      (5, Alarm.CHARGE_TEMPERATURE_HIGH),
+      (6, Alarm.CHARGE_TEMPERATURE_LOW),
+      (7, Alarm.DISCHARGE_CURRENT_HIGH),
+      (8, Alarm.CHARGE_CURRENT_HIGH),
+      (10, Alarm.FAILURE_SHORT_CIRCUIT_PROTECTION),
+      (12, Alarm.CELL_VOLTAGE_DIFFERENCE_HIGH),
+   )
+   # pairs 0-12 normal (10), 13-15 not supported (00)
+   normal = bytes((0xAA, 0xAA, 0xAA, 0x02))
+
+   def __setPairs(self, byteArray, offset, active):
+      for pair, alarm in self.pairs:
+         if alarm in active:
+            shift = (pair % 4) * 2
+            index = offset + pair // 4
+            byteArray[index] = (byteArray[index] & ~(3 << shift)) | (1 << shift)
+
+   def encode(self):
+      if BMSBatteryAlarms.initialized:
+         alarmsByteArray = bytearray(self.normal + self.normal)
+         self.__setPairs(alarmsByteArray, 0, BMSBatteryAlarms.alarms)
+         self.__setPairs(alarmsByteArray, 4, BMSBatteryAlarms.protections)
+         self.message = alarmsByteArray
          return True
       else:
          return False
 
 #endregion
 
+#region ********** Inverter Protocols **********
+'''
+--------------------------------------
+Inverter output protocols
+--------------------------------------
+
+Each protocol declares the frames it sends (encoder classes, in transmit
+order) and its cycle time.  The protocol named by inverter.outputProtocol
+is resolved once at startup (or on a runtime protocol change) and the
+writer just walks its frames, so nothing is looked up by name per cycle.
+
+To add a protocol, subclass InverterProtocol and add it to InverterProtocols.
+'''
+class InverterProtocol ():
+   name = ''
+   frequency = 1        #seconds between frame cycles
+   statusEncoder = PylonBatteryStatus
+   encoders = ()
+
+   def __init__(self, cellBalancing=None):
+      # the status encoder carries cell balancing, which survives a protocol change
+      self.status = self.statusEncoder(cellBalancing)
+      self.frames = tuple(self.status if encoder is self.statusEncoder else encoder()
+                          for encoder in self.encoders)
+
+class PylontechProtocol (InverterProtocol):
+   name = 'pylontech'
+   encoders = (PylonBatteryLimits,        #0x351
+               PylonBatteryStatus,        #0x355
+               PylonBatteryMeasurements,  #0x356
+               PylonBatteryChargeFlags,   #0x35C, to-do: control full charge and force charge flags
+               PylonBatteryManufacturer,  #0x35E
+               PylonBatteryAlarms)        #0x359
+
+class UZEnergyProtocol (InverterProtocol):
+   name = 'UZEnergy'
+   encoders = (PylonBatteryLimits,        #0x351
+               PylonBatteryStatus,        #0x355
+               PylonBatteryMeasurements,  #0x356
+               PylonBatteryChargeFlags,   #0x35C
+               PylonBatteryManufacturer,  #0x35E
+               UZEnergyBatteryAlarms)     #0x359
+
+class SMAProtocol (InverterProtocol):
+   name = 'SMA'
+   statusEncoder = SMABatteryStatus
+   encoders = (PylonBatteryLimits,        #0x351
+               SMABatteryStatus,          #0x355
+               PylonBatteryMeasurements,  #0x356
+               PylonBatteryManufacturer,  #0x35E
+               SMABatteryAlarms)          #0x35A
+
+InverterProtocols = {protocol.name: protocol for protocol in (PylontechProtocol, UZEnergyProtocol, SMAProtocol)}
+
+#endregion
+
 #region ********** Cell Balancing **********
 '''
 Functions to control a CellBalancing capability
@@ -703,6 +1740,7 @@ class CellBalancing ():
    cellBalancingInterval = 1  #day interval to perform cell balancing
    cellBalancingMinutes = 30  #number of minutes to balance
    isCellBalancingActive = False
+   balanceRequested = False   #on demand balance, skips the interval day check once
    remainingTime = 0
    lastBalanceDate = datetime.now()
 
@@ -720,7 +1758,18 @@ class CellBalancing ():
             file.write(self.lastBalanceDate.strftime("%Y-%m-%d"))
             logger.debug("Wrote cellbalance.marker with:" +self.lastBalanceDate.strftime("%Y-%m-%d"))
 
+   def applySettings (self, settings):
+      self.holdSOC = settings.holdSOC
+      self.cellBalancingInterval = settings.cellBalancingInterval
+      self.cellBalancingMinutes = settings.cellBalancingMinutes
+      if settings.balanceRequested:
+         logger.info ('On demand cell balance requested, starts once SOC is above ' + str(self.holdSOC))
+         self.balanceRequested = True
+
    def __evaluateDay (self):
+      if self.balanceRequested:
+         logger.debug ('evaluated day for allowed run as True (on demand request)')
+         return True
       if datetime.now() >= self.lastBalanceDate + timedelta(days=self.cellBalancingInterval):
          logger.debug ('evaluated day for allowed run as True')
          return True
@@ -731,6 +1780,7 @@ class CellBalancing ():
    def __startTimer (self):
       self.__timerStartTime = datetime.now()
       self.isCellBalancingActive = True
+      self.balanceRequested = False
       logger.debug ('starting cell balance timer:' +self.__timerStartTime.strftime("%Y-%m-%d %H:%M:%S"))
 
    def __stopTimer (self):
@@ -741,6 +1791,26 @@ class CellBalancing ():
       self.isCellBalancingActive = False
       logger.debug ('stopping cell balance timer, wrote marker:' +self.lastBalanceDate.strftime("%Y-%m-%d"))
 
+   def handoffState (self):
+      # what a standby bridge needs to carry on a balance the active one started
+      return {'lastBalanceDate': self.lastBalanceDate.isoformat(),
+              'active': self.isCellBalancingActive,
+              'timerStartTime': self.__timerStartTime.isoformat(),
+              'balanceRequested': self.balanceRequested,
+              'lastSOC': self.__lastSOC}
+
+   def applyHandoff (self, state):
+      lastBalanceDate = datetime.fromisoformat(state['lastBalanceDate'])
+      if lastBalanceDate.date() != self.lastBalanceDate.date():
+         #keep the marker in step so a restart does not balance again
+         with open("cellbalance.marker", "w") as file:
+            file.write(lastBalanceDate.strftime("%Y-%m-%d"))
+      self.lastBalanceDate = lastBalanceDate
+      self.__timerStartTime = datetime.fromisoformat(state['timerStartTime'])
+      self.isCellBalancingActive = state['active']
+      self.balanceRequested = state['balanceRequested']
+      self.__lastSOC = state['lastSOC']
+
    def __remainingTime (self):
       elapsedTime = datetime.now() - self.__timerStartTime
       logger.debug ('setting remaining time:' + str((self.cellBalancingMinutes*60)-elapsedTime.seconds))
@@ -758,6 +1828,12 @@ class CellBalancing ():
          else:
             logger.debug ("evaluateSOC hit cell balance time, stopping timer")
             self.__stopTimer()
+      elif self.balanceRequested and SOC > self.holdSOC:
+         #on demand, started straight away even with SOC already high and steady
+         self.__lastSOC = SOC
+         logger.debug ("evaluateSOC on demand balance, starting timer and holding at:" + str(self.holdSOC))
+         self.__startTimer()
+         return self.holdSOC
       else:
          #evaluate if we have reached the start of hold
          if (SOC > self.__lastSOC):
@@ -775,6 +1851,104 @@ class CellBalancing ():
          
 #endregion
 
+#region ********** Runtime Settings **********
+'''
+--------------------------------------
+Runtime adjustable settings
+--------------------------------------
+
+Settings that can be changed while running (MQTT command topic) without a
+restart.  A validated RuntimeSettings object is never modified after it is
+created: a change builds a new object which is posted to PendingSettings and
+swapped in by the inverter writer between frame cycles, so the encoders never
+see a half applied change.  Building on the latest settings and the swap both
+hold SettingsLock, so a command arriving during a swap is never lost.
+'''
+class RuntimeSettings ():
+   # config key -> (attribute, type, minimum, maximum)
+   limits = {
+      'hold-soc': ('holdSOC', int, 1, 100),
+      'interval-days': ('cellBalancingInterval', int, 1, 365),
+      'minutes': ('cellBalancingMinutes', int, 1, 1440),
+      'lowVoltageWarning': ('lowVoltageWarning', float, 40.0, 60.0),
+   }
+   outputProtocols = tuple(InverterProtocols)
+
+   def __init__(self, holdSOC, cellBalancingInterval, cellBalancingMinutes, lowVoltageWarning, outputProtocol, balanceRequested=False):
+      self.holdSOC = holdSOC
+      self.cellBalancingInterval = cellBalancingInterval
+      self.cellBalancingMinutes = cellBalancingMinutes
+      self.lowVoltageWarning = lowVoltageWarning
+      self.outputProtocol = outputProtocol
+      self.balanceRequested = balanceRequested
+
+   def update(self, changes):
+      # returns a new validated RuntimeSettings, raises ValueError on any invalid entry
+      if not isinstance(changes, dict):
+         raise ValueError('command must be a JSON object')
+      values = dict(self.__dict__)
+      for key, value in changes.items():
+         if key in self.limits:
+            attribute, valueType, minimum, maximum = self.limits[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+               raise ValueError(key + ' must be a number')
+            #JSON lets through Infinity, NaN and 1e999, int() of those raises OverflowError / ValueError
+            if not math.isfinite(value):
+               raise ValueError(key + ' must be a finite number')
+            if valueType is int and value != int(value):
+               raise ValueError(key + ' must be a whole number')
+            if not minimum <= value <= maximum:
+               raise ValueError(key + ' must be between ' + str(minimum) + ' and ' + str(maximum))
+            values[attribute] = valueType(value)
+         elif key == 'outputProtocol':
+            if value not in self.outputProtocols:
+               raise ValueError('outputProtocol must be one of ' + ', '.join(self.outputProtocols))
+            values['outputProtocol'] = value
+         elif key == 'balance':
+            if not isinstance(value, bool):
+               raise ValueError('balance must be true or false')
+            values['balanceRequested'] = value
+         else:
+            raise ValueError('unknown setting: ' + str(key))
+      return RuntimeSettings(**values)
+
+   def asDict(self):
+      return {
+         'hold-soc': self.holdSOC,
+         'interval-days': self.cellBalancingInterval,
+         'minutes': self.cellBalancingMinutes,
+         'lowVoltageWarning': self.lowVoltageWarning,
+         'outputProtocol': self.outputProtocol,
+      }
+
+def updateSettings(changes):
+   # returns the new settings posted for writeInverter's next cycle, raises ValueError on any invalid entry
+   global PendingSettings
+   with SettingsLock:
+      settings = (PendingSettings or CurrentSettings).update(changes)
+      PendingSettings = settings
+   return settings
+
+def applyPendingSettings():
+   global CurrentSettings
+   global PendingSettings
+   global InverterOutput
+
+   with SettingsLock:
+      settings = PendingSettings
+      PendingSettings = None
+      #a balance request is handed to cell balancing once, later updates start without it
+      CurrentSettings = settings.update({'balance': False}) if settings.balanceRequested else settings
+   InverterOutput.status.cellBalancing.applySettings(settings)
+   if settings.outputProtocol != InverterOutput.name:
+      #resolved once here, the writer never looks a protocol up by name
+      InverterOutput = InverterProtocols[settings.outputProtocol] (InverterOutput.status.cellBalancing)
+      logger.info ('Inverter output protocol changed to ' + settings.outputProtocol)
+   BMSSignalConditioner.setLowVoltageWarning(settings.lowVoltageWarning)
+   logger.info ('Applied runtime settings: ' + json.dumps(settings.asDict()))
+
+#endregion
+
 #region ********** CAN **********
 '''
 --------------------------------------
@@ -782,10 +1956,11 @@ CAN Methods
 --------------------------------------
 '''
 
-def openCANPort (CANChannel, CANBitrate):
+def openCANPort (CANChannel, CANBitrate, CANInterface='socketcan'):
+   # CANInterface 'virtual' runs the bridge against the in process simulator (BMSSimulator.py)
    try:
       #CANPort = can.interface.Bus(interface='socketcan', channel=CANChannel, bitrate=CANBitrate)
-      CANPort = can.ThreadSafeBus(interface='socketcan', channel=CANChannel, bitrate=CANBitrate)
+      CANPort = can.ThreadSafeBus(interface=CANInterface, channel=CANChannel, bitrate=CANBitrate)
       return CANPort
    except:
       logger.error('Error: Failed to open CAN Port, exiting')
@@ -793,15 +1968,429 @@ def openCANPort (CANChannel, CANBitrate):
 
 #endregion
 
-#region ********** BMS Reader ************
+#region ********** CAN Bus Supervisor **********
 '''
 --------------------------------------
-BMS Reader Methods
+CAN bus health supervisor
 --------------------------------------
+
+One supervisor per bus follows the controller state from the SocketCAN error
+frames python-can delivers on the reader sockets (controller status, TX/RX
+error counters, bus-off and restarted), plus socket and send failures.
+
+  ACTIVE -> WARNING (96+ errors) -> PASSIVE (128+) -> BUS_OFF
+  DOWN     the socket failed, e.g. the interface went down
+
+With restart-ms set (startcan.sh) the kernel restarts a bus-off controller
+by itself and reports it restarted.  A bus still bus-off or down after the
+restart grace has only its own port reopened by the supervisor thread, with
+a backoff between attempts, instead of waiting for the watchdog to rebuild
+everything.  Transition counts and time in each state are kept for MQTT and
+the dashboard.
 '''
 
-def readBMS(runEvent,CANPort):
-   global BMSBatteryLimits
+class CANBusState(Enum):
+
+   ACTIVE, \
+   WARNING, \
+   PASSIVE, \
+   BUS_OFF, \
+   DOWN = range (1,6)
+
+class CANBusSupervisor ():
+   # linux/can/error.h, error class in the id of an error frame
+   ERR_CRTL = 0x004
+   ERR_BUSOFF = 0x040
+   ERR_RESTARTED = 0x100
+   ERR_CNT = 0x200
+   # controller status in data[1]
+   CRTL_RX_WARNING = 0x04
+   CRTL_TX_WARNING = 0x08
+   CRTL_RX_PASSIVE = 0x10
+   CRTL_TX_PASSIVE = 0x20
+   CRTL_ACTIVE = 0x40
+   sendErrorLimit = 3
+
+   def __init__(self, name, reopen, restartGrace=0.3, minReopenInterval=1, maxReopenInterval=30):
+      self.name = name
+      self.reopenPort = reopen
+      self.restartGrace = restartGrace
+      self.minReopenInterval = minReopenInterval
+      self.maxReopenInterval = maxReopenInterval
+      self.state = CANBusState.ACTIVE
+      self.healthy = True
+      self.stateSince = monotonic()
+      self.transitions = {state: 0 for state in CANBusState}
+      self.timeInState = {state: 0.0 for state in CANBusState}
+      self.txErrors = 0
+      self.rxErrors = 0
+      self.errorFrames = 0
+      self.sendErrors = 0
+      self.consecutiveSendErrors = 0
+      self.reopens = 0
+      self.reopenInterval = minReopenInterval
+      self.nextReopen = 0.0
+
+   def __transition(self, state, now):
+      if state is self.state:
+         return
+      logger.warning (self.name + ' CAN bus ' + self.state.name + ' -> ' + state.name +
+                      ' (tx errors ' + str(self.txErrors) + ', rx errors ' + str(self.rxErrors) + ')')
+      if state is CANBusState.ACTIVE and self.state in (CANBusState.BUS_OFF, CANBusState.DOWN):
+         #the controller restarts with cleared error counters
+         self.txErrors = 0
+         self.rxErrors = 0
+      self.timeInState[self.state] += now - self.stateSince
+      self.transitions[state] += 1
+      self.state = state
+      self.stateSince = now
+      self.healthy = state is CANBusState.ACTIVE and self.consecutiveSendErrors == 0
+      if state is CANBusState.ACTIVE:
+         self.reopenInterval = self.minReopenInterval
+      elif state in (CANBusState.BUS_OFF, CANBusState.DOWN):
+         CANSupervisorEvent.set()
+
+   def onErrorFrame(self, message, now):
+      self.errorFrames += 1
+      errorClass = message.arbitration_id
+      data = message.data
+      if errorClass & self.ERR_CNT and len(data) >= 8:
+         self.txErrors = data[6]
+         self.rxErrors = data[7]
+      if errorClass & self.ERR_BUSOFF:
+         self.__transition(CANBusState.BUS_OFF, now)
+      elif errorClass & self.ERR_RESTARTED:
+         self.__transition(CANBusState.ACTIVE, now)
+      elif errorClass & self.ERR_CRTL and len(data) >= 2:
+         status = data[1]
+         if status & (self.CRTL_RX_PASSIVE | self.CRTL_TX_PASSIVE):
+            self.__transition(CANBusState.PASSIVE, now)
+         elif status & (self.CRTL_RX_WARNING | self.CRTL_TX_WARNING):
+            self.__transition(CANBusState.WARNING, now)
+         elif status & self.CRTL_ACTIVE:
+            self.__transition(CANBusState.ACTIVE, now)
+
+   def onFrame(self, now):
+      # a good frame, callers only call this while not healthy
+      self.consecutiveSendErrors = 0
+      if self.state in (CANBusState.BUS_OFF, CANBusState.DOWN):
+         self.__transition(CANBusState.ACTIVE, now)
+      self.healthy = self.state is CANBusState.ACTIVE
+
+   def onSendOK(self, now):
+      # a send only proves the socket works, not that a bus-off controller recovered
+      self.consecutiveSendErrors = 0
+      if self.state is CANBusState.DOWN:
+         self.__transition(CANBusState.ACTIVE, now)
+      self.healthy = self.state is CANBusState.ACTIVE
+
+   def onSendError(self, error, now):
+      self.sendErrors += 1
+      self.consecutiveSendErrors += 1
+      self.healthy = False
+      if self.consecutiveSendErrors == self.sendErrorLimit:
+         logger.error (self.name + ' CAN bus send failing: ' + str(error))
+         self.__transition(CANBusState.DOWN, now)
+
+   def onSocketError(self, error, now):
+      if self.state is not CANBusState.DOWN:
+         logger.error (self.name + ' CAN bus socket error: ' + str(error))
+      self.__transition(CANBusState.DOWN, now)
+
+   def needsReopen(self, now):
+      return (self.state in (CANBusState.BUS_OFF, CANBusState.DOWN) and
+              now - self.stateSince >= self.restartGrace and now >= self.nextReopen)
+
+   def reopen(self, now):
+      logger.warning (self.name + ' CAN bus ' + self.state.name + ' for ' + str(int((now - self.stateSince) * 1000)) +
+                      'ms, reopening the port')
+      self.reopens += 1
+      self.nextReopen = now + self.reopenInterval
+      self.reopenInterval = min(self.reopenInterval * 2, self.maxReopenInterval)
+      try:
+         self.reopenPort()
+      except (Exception, SystemExit) as e:
+         #openCANPort exits on failure, keep supervising and retry after the backoff
+         logger.error (self.name + ' CAN port reopen failed: ' + str(e))
+
+   def summary(self):
+      now = monotonic()
+      timeInState = dict(self.timeInState)
+      timeInState[self.state] += now - self.stateSince
+      return {self.name + "BusState": self.state.name,
+              self.name + "BusTxErrors": self.txErrors,
+              self.name + "BusRxErrors": self.rxErrors,
+              self.name + "BusErrorFrames": self.errorFrames,
+              self.name + "BusSendErrors": self.sendErrors,
+              self.name + "BusReopens": self.reopens,
+              self.name + "BusTransitions": {state.name: count for state, count in self.transitions.items() if count},
+              self.name + "BusSecondsInState": {state.name: round(seconds, 1) for state, seconds in timeInState.items() if seconds}}
+
+def superviseCANBuses ():
+   # runs for the life of the process, reopens need PortLock so they never overlap
+   # a watchdog restart or a config reload
+   while not ShutdownEvent.is_set():
+      CANSupervisorEvent.wait(0.1)
+      CANSupervisorEvent.clear()
+      now = monotonic()
+      for supervisor in (BMSBusSupervisor, InverterBusSupervisor):
+         if supervisor.needsReopen(now):
+            with PortLock:
+               supervisor.reopen(now)
+
+def createCANSupervisors ():
+   global BMSBusSupervisor
+   global InverterBusSupervisor
+   global CANSupervisorEvent
+   global PortLock
+
+   CANSupervisorEvent = threading.Event()
+   PortLock = threading.RLock()
+   BMSBusSupervisor = CANBusSupervisor('BMS', restartBMSPort,
+                                       CANSupervisorParam.get('restart-grace-ms', 300) / 1000,
+                                       CANSupervisorParam.get('min-reopen-interval', 1),
+                                       CANSupervisorParam.get('max-reopen-interval', 30))
+   InverterBusSupervisor = CANBusSupervisor('Inverter', restartInverterPort,
+                                            CANSupervisorParam.get('restart-grace-ms', 300) / 1000,
+                                            CANSupervisorParam.get('min-reopen-interval', 1),
+                                            CANSupervisorParam.get('max-reopen-interval', 30))
+
+#endregion
+
+#region ********** CAN Capture **********
+'''
+--------------------------------------
+Raw CAN frame capture ring
+--------------------------------------
+
+Keeps the last frames seen on both buses for incident analysis.  Records are
+packed into one preallocated bytearray, no objects are kept per frame:
+
+  timestamp (double) | arbitration id (uint32) | bus | flags | dlc | pad | data (8 bytes)
+
+Recording is a counter increment and one struct.pack_into.  The ring is
+written out in candump -L format (readable by can.LogReader) on an alarm
+transition, a watchdog trip or SIGUSR1; the dump copies the buffer and
+formats it on its own thread.
+'''
+
+class CANCaptureRing ():
+   BMS = 0
+   INVERTER = 1
+   TX = 1                                  #flags bit, frame was sent by the bridge
+   record = struct.Struct('<dIBBBx8s')     #24 bytes
+
+   def __init__(self, frames, directory, minInterval=60, channels=('can0', 'can1')):
+      self.frames = frames
+      self.directory = directory
+      self.minInterval = minInterval
+      self.channels = channels
+      self.buffer = bytearray(frames * self.record.size)
+      self.counter = itertools.count()     #next() is atomic, safe across the CAN threads
+      self.lastDump = None
+
+   def capture(self, bus, message, flags=0):
+      index = next(self.counter)
+      self.record.pack_into(self.buffer, (index % self.frames) * self.record.size,
+                            time(), message.arbitration_id, bus, flags, message.dlc, bytes(message.data))
+
+   def snapshot(self):
+      # records oldest first, copied so the CAN threads keep writing
+      total = next(self.counter)
+      start = (total % self.frames) * self.record.size
+      buffer = bytes(self.buffer)
+      if total < self.frames:
+         return buffer[:start]
+      return buffer[start:] + buffer[:start]
+
+   def dump(self, reason, force=False):
+      now = monotonic()
+      if not force and self.lastDump is not None and now - self.lastDump < self.minInterval:
+         return None
+      self.lastDump = now
+      fileName = os.path.join(self.directory, 'capture-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '-' + reason + '.log')
+      threading.Thread(target=self.__write, args=[fileName, self.snapshot()], daemon=True).start()
+      return fileName
+
+   def __write(self, fileName, records):
+      try:
+         os.makedirs(self.directory, exist_ok=True)
+         with open(fileName, 'w') as f:
+            for timestamp, arbitrationId, bus, flags, dlc, data in self.record.iter_unpack(records):
+               f.write('(%.6f) %s %03X#%s %s\n' % (timestamp, self.channels[bus], arbitrationId,
+                                                    data[:dlc].hex().upper(), 'T' if flags & self.TX else 'R'))
+         metrics.CaptureDumps += 1
+         logger.info ('CAN capture of ' + str(len(records) // self.record.size) + ' frames written to ' + fileName)
+      except OSError as e:
+         logger.error ('CAN capture dump to ' + fileName + ' failed: ' + str(e))
+
+def createCANCapture ():
+   global CANCapture
+
+   if CaptureParam.get('enabled', False):
+      CANCapture = CANCaptureRing(CaptureParam.get('frames', 32768),
+                                  CaptureParam.get('directory', '/var/lib/BMS2Inverter/capture'),
+                                  CaptureParam.get('min-interval', 60),
+                                  (BMSCANPortParam, InverterCANPortParam))
+   else:
+      CANCapture = None
+
+def dumpCANCapture (reason, force=False):
+   if CANCapture is not None:
+      CANCapture.dump(reason, force)
+
+#endregion
+
+#region ********** Alarm Events **********
+'''
+--------------------------------------
+Alarm events
+--------------------------------------
+
+Raised / cleared edges of the BMS alarms and protections, found by XOR of the
+decoded alarm mask (BMSAlarmFrame.mask) with the previous one.  Only runs
+when the 0x359 / 0x35A payload changed, an unchanged frame costs the alarm
+decoder one integer compare and this stage another.
+
+Events are kept in a bounded history, published to MQTT one message each
+and handed to the optional notifier, which runs a local command (event JSON
+on stdin), posts to a webhook or appends to a file (a local stand-in for the
+other two when testing) on its own thread so the BMS reader never waits.
+'''
+
+class AlarmEventLog ():
+
+   def __init__(self, historySize=256):
+      self.mask = 0
+      self.history = deque(maxlen=historySize)     #newest last
+      self.unpublished = deque(maxlen=historySize)
+
+   def update(self, mask, wallTime):
+      # events for every bit that changed, in Alarm order
+      edges = mask ^ self.mask
+      self.mask = mask
+      timestamp = datetime.fromtimestamp(wallTime).isoformat()
+      events = []
+      while edges:
+         bit = edges & -edges
+         edges ^= bit
+         index = bit.bit_length() - 1
+         events.append({
+            "time": timestamp,
+            "alarm": Alarm(index % 64 + 1).name,
+            "level": "protection" if index >= 64 else "alarm",
+            "event": "raised" if mask & bit else "cleared",
+         })
+      self.history.extend(events)
+      self.unpublished.extend(events)
+      return events
+
+   def takeUnpublished(self):
+      events = []
+      while self.unpublished:
+         events.append(self.unpublished.popleft())
+      return events
+
+class AlarmNotifier ():
+
+   def __init__(self, command=None, webhook=None, fileName=None, timeout=5, queueSize=100):
+      self.command = shlex.split(command) if isinstance(command, str) else command
+      self.webhook = webhook
+      self.fileName = fileName
+      self.timeout = timeout
+      self.queue = queue.Queue(queueSize)
+      threading.Thread(target=self.__notifier, daemon=True).start()
+
+   def notify(self, events):
+      try:
+         self.queue.put_nowait(events)
+      except queue.Full:
+         metrics.AlarmNotifyErrors += 1
+
+   def __notifier(self):
+      while True:
+         payload = json.dumps(self.queue.get())
+         try:
+            if self.command:
+               subprocess.run(self.command, input=payload.encode(), timeout=self.timeout, check=True)
+            if self.webhook:
+               request = urllib.request.Request(self.webhook, data=payload.encode(), method='POST',
+                                                headers={'Content-Type': 'application/json'})
+               urllib.request.urlopen(request, timeout=self.timeout).close()
+            if self.fileName:
+               with open(self.fileName, 'a') as f:
+                  f.write(payload + '\n')
+            metrics.AlarmNotifications += 1
+         except Exception as e:
+            metrics.AlarmNotifyErrors += 1
+            logger.error ('Alarm notification failed: ' + str(e))
+
+def createAlarmEvents():
+   global BMSAlarmEvents
+   global BMSAlarmNotifier
+
+   BMSAlarmEvents = AlarmEventLog(AlarmEventsParam.get('history', 256))
+   BMSAlarmNotifier = None
+   if AlarmEventsParam.get('command') or AlarmEventsParam.get('webhook') or AlarmEventsParam.get('file'):
+      BMSAlarmNotifier = AlarmNotifier(AlarmEventsParam.get('command'),
+                                       AlarmEventsParam.get('webhook'),
+                                       AlarmEventsParam.get('file'),
+                                       AlarmEventsParam.get('timeout', 5))
+
+#endregion
+
+#region ********** BMS Reader ************
+'''
+--------------------------------------
+BMS Reader Methods
+--------------------------------------
+'''
+
+def createSOCEstimator():
+   if SOCEstimatorParam.get('enabled', False):
+      return SOCEstimator(SOCEstimatorParam.get('max-gap-seconds', 10),
+                          SOCEstimatorParam.get('current-alpha', 0.1))
+   return None
+
+def onBMSCapacity(buffer, now):
+   if BMSSOCEstimator is not None:
+      BMSSOCEstimator.anchorCapacity(BMSBatteryCapacity.batteryRemainingCapacity, BMSBatteryCapacity.batteryNominalCapacity)
+
+def onBMSStatus(buffer, now):
+   BMSSignalConditioner.conditionStatus(BMSBatteryStatus, buffer, now)
+   if BMSSOCEstimator is not None:
+      BMSSOCEstimator.anchorSOC(BMSBatteryStatus.batteryStateOfCharge)
+
+def onBMSMeasurements(buffer, now):
+   BMSSignalConditioner.conditionMeasurements(BMSBatteryMeasurements, buffer, now)
+   if BMSSOCEstimator is not None:
+      BMSSOCEstimator.update(BMSBatteryMeasurements.batteryCurrent, now)
+   if BMSEnergy is not None:
+      BMSEnergy.update(BMSBatteryMeasurements.batteryVoltage, BMSBatteryMeasurements.batteryCurrent, now, time())
+
+def onBMSAlarms(buffer, now):
+   if BMSBatteryAlarms.mask == BMSAlarmEvents.mask:
+      return
+   events = BMSAlarmEvents.update(BMSBatteryAlarms.mask, time())
+   for event in events:
+      logger.warning ('BMS ' + event['level'] + ' ' + event['alarm'] + ' ' + event['event'])
+   if BMSAlarmNotifier is not None and (Redundancy is None or Redundancy.sending.is_set()):
+      BMSAlarmNotifier.notify(events)
+   dumpCANCapture('alarm')
+
+# bridge stages run after a decode, keyed by the shared state they consume
+BMSDecodeHooks = {
+   'BMSBatteryCapacity': onBMSCapacity,
+   'BMSBatteryStatus': onBMSStatus,
+   'BMSBatteryMeasurements': onBMSMeasurements,
+   'BMSBatteryAlarms': onBMSAlarms,
+}
+
+def createBMSState():
+   # BMS state lives outside readBMS so the BMS port can be reopened without
+   # the inverter writer losing the last decoded values
+   global BMSInput
+   global BMSBatteryLimits
    global BMSBatteryCapacity
    global BMSBatteryStatus
    global BMSBatteryMeasurements
@@ -811,79 +2400,156 @@ def readBMS(runEvent,CANPort):
    global BMSModelNameLower
    global BMSLynxFirmware
    global BMSProtocolVersion
+   global BMSModules
+   global BMSSOCEstimator
+   global BMSSignalConditioner
+
+   BMSInput = BMSProtocols[BMSInputProtocolParam] (BMSDecodeHooks, ModulesParam.get('enabled', False))
+   BMSBatteryLimits = BMSInput.state['BMSBatteryLimits']
+   BMSBatteryCapacity = BMSInput.state['BMSBatteryCapacity']
+   BMSBatteryStatus = BMSInput.state['BMSBatteryStatus']
+   BMSBatteryMeasurements = BMSInput.state['BMSBatteryMeasurements']
+   BMSBatteryAlarms = BMSInput.state['BMSBatteryAlarms']
+   BMSManufacturer = BMSInput.state['BMSManufacturer']
+   BMSModelNameUpper = BMSInput.state['BMSModelNameUpper']
+   BMSModelNameLower = BMSInput.state['BMSModelNameLower']
+   BMSLynxFirmware = BMSInput.state['BMSLynxFirmware']
+   BMSProtocolVersion = BMSInput.state['BMSProtocolVersion']
+   BMSModules = BMSInput.state['BMSModules']
+
+   BMSSignalConditioner = SignalConditioner(SignalConditioningParam, CurrentSettings.lowVoltageWarning)
+   BMSSOCEstimator = createSOCEstimator()
 
-   BMSBatteryLimits = BMSDiscoverSCBatteryLimits ()
-   BMSBatteryCapacity = BMSDiscoverSCBatteryCapacity ()
-   BMSBatteryStatus = BMSDiscoverSCBatteryStatus ()
-   BMSBatteryMeasurements = BMSDiscoverSCBatteryMeasurements ()
-   BMSBatteryAlarms = BMSDiscoverSCBatteryAlarms ()
-   BMSManufacturer = BMSDiscoverSCBatteryManufacturer ()
-   BMSModelNameUpper = BMSDiscoverSCModelNameUpper ()
-   BMSModelNameLower = BMSDiscoverSCModelNameLower ()
-   BMSLynxFirmware = BMSDiscoverSCLynxFirmware ()
-   BMSProtocolVersion = BMSDiscoverSCProtocolVersion ()
-
-   BMSBatteryMeasurements.lowVoltageWarning = LowVoltageWarningParam
+def readBMS(runEvent,CANPort):
+   dispatch = BMSInput.dispatch
+   relay = InverterRelay
 
-      
    while runEvent.is_set():
-      # Check if active (ACTIVE=1, ERROR=3, PASSIVE=2)
-      if CANPort.state != can.BusState.ACTIVE:
-         logger.error('BMS CAN Port reports state of:' +str(CANPort.state))
-
-      message = CANPort.recv(timeout=5)
+      try:
+         message = CANPort.recv(timeout=5)
+      except can.CanError as e:
+         #the supervisor reopens the port, this thread is stopped then
+         BMSBusSupervisor.onSocketError(e, monotonic())
+         sleep(0.1)
+         continue
       if message is not None:
+         now = monotonic()
+         if message.is_error_frame:
+            BMSBusSupervisor.onErrorFrame(message, now)
+            continue
+         if not BMSBusSupervisor.healthy:
+            BMSBusSupervisor.onFrame(now)
          #update metrics
          metrics.lastBMSRead = datetime.now()
          metrics.BMSBytesRead += len(message.data)
-
-         if message.arbitration_id == 0x35E:
-            BMSManufacturer.decode(message.data)
-            #logger.debug('Read 0x35E - Manufacturer: %s', BMSManufacturer.manufacturer)
-         elif message.arbitration_id == 0x351:
-            #sys.stdout.write('\r\033[31mBMS \033[0mInverter')
-            #sys.stdout.flush()
-            BMSBatteryLimits.decode(message.data)
-            #logger.debug('Read 0x351 - Requested Charge Voltage: %s', BMSBatteryLimits.requestedChargeVoltage)
-            #logger.debug('Read 0x351 - Requested Charge Current: %s',BMSBatteryLimits.requestedChargeCurrent)
-            #logger.debug('Read 0x351 - Requested Max Discharge Current: %s',BMSBatteryLimits.requestedMaximumDischargeCurrent)
-            #logger.debug('Read 0x351 - Low Battery Cutout Voltage: %s',BMSBatteryLimits.lowBatteryCutOutVoltage)
-         elif message.arbitration_id == 0x354:
-            BMSBatteryCapacity.decode(message.data)
-            #logger.debug('Read 0x354 - Battery Nominal Capacity: %s', BMSBatteryCapacity.batteryNominalCapacity)
-            #logger.debug('Read 0x354 - Battery Remaining Capacity: %s', BMSBatteryCapacity.batteryRemainingCapacity)
-         elif message.arbitration_id == 0x355:
-            BMSBatteryStatus.decode(message.data)
-            #logger.debug('Read 0x355 - Battery State of Charge: %s', BMSBatteryStatus.batteryStateOfCharge)
-            #logger.debug('Read 0x355 - Battery State of Health: %s', BMSBatteryStatus.batteryStateOfHealth)
-         elif message.arbitration_id == 0x356:
-            BMSBatteryMeasurements.decode(message.data)
-            #logger.debug('Read 0x356 - Battery Voltage: %s', BMSBatteryMeasurements.batteryVoltage)
-            #logger.debug('Read 0x356 - Battery Current: %s', BMSBatteryMeasurements.batteryCurrent)
-            #logger.debug('Read 0x356 - Battery Temperature: %s', BMSBatteryMeasurements.batteryTemperature)
-            #logger.debug('Read 0x356 - Battery Temperature ºF: %s', BMSBatteryMeasurements.batteryTemperatureF)
-         elif message.arbitration_id == 0x35A:
-            BMSBatteryAlarms.decode(message.data)
-            #logger.debug('Read 0x35A - Battery Alarms: %s', BMSBatteryAlarms.alarms)
-            #logger.debug('Read 0x35A - Battery Protections (Warnings): %s', BMSBatteryAlarms.protections)
-         elif message.arbitration_id == 0x370:
-            BMSModelNameUpper.decode(message.data)
-            #logger.debug('Read 0x370 - Battery Model Name: %s', BMSModelNameUpper.modelName)
-         elif message.arbitration_id == 0x371:
-            BMSModelNameLower.decode(message.data)
-            #logger.debug('Read 0x371 - Battery Model Name (Lower): %s', BMSModelNameLower.modelName)
-         elif message.arbitration_id == 0x372:
-            BMSLynxFirmware.decode(message.data)
-            #logger.debug('Read 0x372 - Lynx Firmware Version: %s', BMSLynxFirmware.versionString)
-         elif message.arbitration_id == 0x373:
-            BMSProtocolVersion.decode(message.data)
-            #logger.debug('Read 0x373 - Battery Protocol Version: %s', BMSProtocolVersion.versionString)
-         else:
-            logger.error ("reading unhandled message: " + str(message.arbitration_id) + ", message: " + str(message.data))
+         if CANCapture is not None:
+            CANCapture.capture(CANCaptureRing.BMS, message)
+
+         handler = dispatch.get(message.arbitration_id)
+         if handler is not None:
+            decode, hook = handler
+            try:
+               decode(message.data)
+               if hook is not None:
+                  hook(message.data, now)
+            except (struct.error, ValueError) as e:
+               #short or malformed frame (e.g. a third party BMS), skipped rather than stopping the reader
+               metrics.BMSDecodeErrors += 1
+               logger.warning ("Malformed BMS frame " + hex(message.arbitration_id) + " [" + message.data.hex(' ') + "]: " + str(e))
+               continue
+            if message.arbitration_id in relay.frames:
+               relay.arrived(message.arbitration_id, now)
+            if StateExport is not None:
+               exportState()
+         elif message.arbitration_id not in InverterForwardIdsParam:
+            #heartbeats forwarded by a peer bridge are expected on the BMS bus
+            logger.error ("reading unhandled message: " + hex(message.arbitration_id) + ", message: " + message.data.hex(' '))
       else:
          logger.warning ("time > 5 seconds to read CAN message from BMS")
 #endregion
 
+#region ************ Inverter Frame Timing *************
+'''
+--------------------------------------
+Inverter frame timing monitor
+--------------------------------------
+
+Inverters such as the Midnite AIO go to standby when frames arrive late.
+Every transmitted frame is timestamped per id; the interval since the
+previous send of the same id goes into a ring of recent intervals.  A frame
+whose interval exceeds the output period plus tolerance is counted late and
+warned about (at most once per warningInterval).  Period, jitter and p99
+lateness are computed from the rings on demand, off the send path.
+'''
+
+class FrameTimingMonitor ():
+
+   def __init__(self, period, tolerance, window=300, warningInterval=60):
+      self.period = period
+      self.periods = {}          #frame id -> period when it differs from period (inverter.cadence-ms)
+      self.tolerance = tolerance
+      self.window = window
+      self.warningInterval = warningInterval
+      self.lastSent = {}         #frame id -> monotonic time of the last send
+      self.intervals = {}        #frame id -> RingBuffer of intervals
+      self.late = 0
+      self.lastWarning = None
+      self.lateSinceWarning = 0
+
+   def record(self, frameId, now):
+      last = self.lastSent.get(frameId)
+      self.lastSent[frameId] = now
+      if last is None:
+         return
+      interval = now - last
+      intervals = self.intervals.get(frameId)
+      if intervals is None:
+         intervals = self.intervals[frameId] = RingBuffer(self.window)
+      intervals.append(interval)
+      if interval > self.periods.get(frameId, self.period) + self.tolerance:
+         self.__late(frameId, interval, now)
+
+   def __late(self, frameId, interval, now):
+      self.late += 1
+      self.lateSinceWarning += 1
+      metrics.InverterLateFrames += 1
+      if self.lastWarning is None or now - self.lastWarning >= self.warningInterval:
+         logger.warning ('Inverter frame ' + hex(frameId) + ' sent ' + str(int(interval * 1000)) + 'ms after the previous one (period ' +
+                         str(int(self.periods.get(frameId, self.period) * 1000)) + 'ms, tolerance ' + str(int(self.tolerance * 1000)) + 'ms), ' +
+                         str(self.lateSinceWarning) + ' late frames since the last warning')
+         self.lastWarning = now
+         self.lateSinceWarning = 0
+
+   def statistics(self):
+      # frame id -> (mean period, jitter, p99 lateness, max period) in ms over the window
+      statistics = {}
+      for frameId, intervals in list(self.intervals.items()):
+         samples = sorted(intervals.samples())
+         if not samples:
+            continue
+         mean = sum(samples) / len(samples)
+         jitter = math.sqrt(sum((sample - mean) ** 2 for sample in samples) / len(samples))
+         p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+         statistics[frameId] = (round(mean * 1000, 1), round(jitter * 1000, 1),
+                                round(max(0.0, p99 - self.periods.get(frameId, self.period)) * 1000, 1), round(samples[-1] * 1000, 1))
+      return statistics
+
+   def summary(self):
+      # worst case over all frame ids, for MQTT and the dashboard; period and max
+      # period only over the frames sent at the protocol frequency
+      statistics = self.statistics()
+      if not statistics:
+         return {}
+      summary = {"InverterJitterMs": max(jitter for _, jitter, _, _ in statistics.values()),
+                 "InverterP99LatenessMs": max(lateness for _, _, lateness, _ in statistics.values())}
+      base = [values for frameId, values in statistics.items() if self.periods.get(frameId, self.period) == self.period]
+      if base:
+         summary["InverterPeriodMs"] = max(mean for mean, _, _, _ in base)
+         summary["InverterMaxPeriodMs"] = max(maxPeriod for _, _, _, maxPeriod in base)
+      return summary
+
+#endregion
+
 #region ************ Inverter Writer *************
 '''
 --------------------------------------
@@ -891,60 +2557,509 @@ inverterWriter Methods
 --------------------------------------
 '''
 
-def writeInverter (runEvent,CANPort,frequency):
-   global InvBatteryStatus
+def createInverterState():
+   # the output protocol (and the cell balancing state its status encoder carries)
+   # lives outside writeInverter so the inverter port can be reopened without
+   # resetting cell balancing
+   global InverterOutput
+   global InverterTiming
+   global InverterFeedback
+   global InverterRelay
+
+   InverterOutput = InverterProtocols[CurrentSettings.outputProtocol] ()
+   InverterTiming = FrameTimingMonitor(InverterOutput.frequency, InverterTimingToleranceParam)
+   InverterFeedback = InverterFeedbackState()
+   InverterRelay = CutThroughRelay(InverterCutThroughParam, InverterCutThroughMinIntervalParam)
+   InverterRelay.setOutput(InverterOutput)
+
+'''
+The transmit plan is built once per output protocol and cadence: the frame
+order, one can.Message per frame refreshed in place from its encoder, and
+each frame's period (inverter.cadence-ms, else the protocol frequency).  A
+heap of (due time, frame) wakes the writer only when the next frame is due,
+frames due together are sent as one burst through the public
+ThreadSafeBus.send (its send lock is uncontended, the writer is the only
+sender on the inverter port), and the time the burst takes is reported.  Each frame is
+rescheduled on its own absolute deadline so send time does not add up to
+drift.
+
+The socketcan broadcast manager (BCM) was not used, a multi frame TX_SETUP
+spaces its frames one interval apart rather than sending them together.
+'''
+class InverterFramePlan ():
+   groupWindow = 0.005     #frames due this close together go in one burst
+   retryDelay = 0.05       #no BMS state yet, the frame is tried again this soon
+   fallbackFactor = 1.1    #after a cut-through send, the schedule only sends if the next BMS frame is this late
+
+   def __init__(self, output, cadence, now):
+      self.output = output
+      self.cadence = cadence
+      self.entries = tuple((encoder, can.Message(arbitration_id=encoder.frame, is_extended_id=False),
+                            cadence.get(encoder.frame, output.frequency))
+                           for encoder in output.frames)
+      self.periods = {encoder.frame: period for encoder, _, period in self.entries}
+      self.indexes = {encoder.frame: index for index, (encoder, _, _) in enumerate(self.entries)}
+      self.lastSent = [-math.inf] * len(self.entries)
+      self.pulled = set()   #entries pulled forward by cut-through
+      #(due, entry index), equal due times keep the protocol frame order
+      self.schedule = [(now, index) for index in range(len(self.entries))]
+      heapq.heapify(self.schedule)
+      self.ready = []       #messages encoded this burst, reused
+
+   def nextDue(self):
+      return self.schedule[0][0]
+
+   def encodeDue(self, now):
+      # messages with fresh data for the frames due now
+      ready = self.ready
+      ready.clear()
+      schedule = self.schedule
+      while schedule[0][0] <= now + self.groupWindow:
+         due, index = schedule[0]
+         encoder, message, period = self.entries[index]
+         if encoder.encode():
+            message.data = encoder.message
+            message.dlc = len(encoder.message)
+            ready.append(message)
+            self.lastSent[index] = now
+            due += period
+            if index in self.pulled:
+               self.pulled.discard(index)
+               due = now + period * self.fallbackFactor
+            elif due <= now:
+               #a whole period overran, start again from now rather than sending a burst to catch up
+               metrics.InverterOverruns += 1
+               due = now + period
+         else:
+            due = now + self.retryDelay
+         heapq.heapreplace(schedule, (due, index))
+      return ready
+
+   def pullForward(self, frameIds, now, minInterval):
+      # make frames due now (cut-through), no sooner than minInterval after their last send
+      schedule = self.schedule
+      for frameId in frameIds:
+         index = self.indexes.get(frameId)
+         if index is None:
+            continue
+         due = max(now, self.lastSent[index] + minInterval)
+         for position, (scheduled, scheduledIndex) in enumerate(schedule):
+            if scheduledIndex == index:
+               if due < scheduled:
+                  schedule[position] = (due, index)
+                  self.pulled.add(index)
+               break
+      heapq.heapify(schedule)
+
+'''
+Cut-through relay
 
-   InvBatteryLimits = PylonBatteryLimits ()
-   InvBatteryStatus = PylonBatteryStatus ()
-   InvBatteryMeasurements = PylonBatteryMeasurements ()
-   InvBatteryChargeFlags = PylonBatteryChargeFlags ()
-   InvBatteryManufacturer = PylonBatteryManufacturer () 
-   InvBatteryAlarms = PylonBatteryAlarms ()
+0x351, 0x355 and 0x356 are transcoded almost one to one from the BMS frames
+of the same id, so with inverter.cut-through the reader asks the writer to
+send the re-encoded frame as soon as the BMS frame is decoded instead of at
+the next scheduled time, never more often than the minimum interval.  The
+writer stays the only sender on the inverter port, it is woken through
+wakeup and pulls the frame forward in its schedule.
 
+The latency from a BMS frame arriving to its counterpart being sent is
+measured in either mode, to compare the two.
+'''
+class CutThroughRelay ():
+   transcodedFrames = (0x351, 0x355, 0x356)
+
+   def __init__(self, enabled, minInterval, window=300):
+      self.enabled = enabled
+      self.minInterval = minInterval
+      self.frames = frozenset()        #transcoded frames the current output protocol sends
+      self.arrivals = {}               #frame id -> monotonic arrival of the BMS frame
+      self.pending = deque()           #frame ids the reader asked to send now
+      self.wakeup = threading.Event()
+      self.latencies = RingBuffer(window)
+
+   def setOutput(self, output):
+      self.frames = frozenset(self.transcodedFrames) & {encoder.frame for encoder in output.frames}
+
+   def arrived(self, frameId, now):
+      self.arrivals[frameId] = now
+      if self.enabled:
+         self.pending.append(frameId)
+         self.wakeup.set()
+
+   def takePending(self):
+      frameIds = []
+      while self.pending:
+         frameIds.append(self.pending.popleft())
+      return frameIds
+
+   def sent(self, frameId, now):
+      arrival = self.arrivals.pop(frameId, None)
+      if arrival is not None:
+         self.latencies.append(now - arrival)
+
+   def summary(self):
+      samples = self.latencies.samples()
+      if not samples:
+         return {}
+      return {"BMSToInverterLatencyMs": round(sum(samples) / len(samples) * 1000, 1),
+              "BMSToInverterLatencyMaxMs": round(max(samples) * 1000, 1)}
+
+def sendBurst (CANPort, messages):
+   # the frames due this cycle back to back, returns the messages sent
+   sent = 0
+   for message in messages:
+      try:
+         CANPort.send(message)
+      except can.CanError as e:
+         InverterBusSupervisor.onSendError(e, monotonic())
+         break
+      sent += 1
+   return messages[:sent]
+
+def writeInverter (runEvent,CANPort):
+   plan = None
+   relay = InverterRelay
+   redundancy = Redundancy
    while runEvent.is_set():
-      #0x351
-      if (InvBatteryLimits.encode()):
-         msg = can.Message(arbitration_id=InvBatteryLimits.frame, data=InvBatteryLimits.message,is_extended_id=False)
-         CANPort.send(msg)
-         #update metrics
-         metrics.lastInverterWrite = datetime.now()
-         metrics.InverterBytesWritten += len(msg.data)
-      #0x355
-      if (InvBatteryStatus.encode()):
-         msg = can.Message(arbitration_id=InvBatteryStatus.frame, data=InvBatteryStatus.message, is_extended_id=False)
-         CANPort.send(msg)
-         #update metrics
-         metrics.lastInverterWrite = datetime.now()
-         metrics.InverterBytesWritten += len(msg.data)
-      # 0x356
-      if (InvBatteryMeasurements.encode()):
-         msg = can.Message(arbitration_id=InvBatteryMeasurements.frame, data=InvBatteryMeasurements.message, is_extended_id=False)
-         CANPort.send(msg)
-         #update metrics
-         metrics.lastInverterWrite = datetime.now()
-         metrics.InverterBytesWritten += len(msg.data)
-      # 0x35C --- #to-do need to find some may to control full charge and maybe force charge flags
-      if (InvBatteryChargeFlags.encode()):
-         msg = can.Message(arbitration_id=InvBatteryChargeFlags.frame, data=InvBatteryChargeFlags.message, is_extended_id=False)
-         CANPort.send(msg)
-         #update metrics
-         metrics.lastInverterWrite = datetime.now()
-         metrics.InverterBytesWritten += len(msg.data)
-      # 0x35E
-      if (InvBatteryManufacturer.encode()):
-         msg = can.Message(arbitration_id=InvBatteryManufacturer.frame, data=InvBatteryManufacturer.message, is_extended_id=False) 
-         CANPort.send(msg)
-         #update metrics
-         metrics.lastInverterWrite = datetime.now()
-         metrics.InverterBytesWritten += len(msg.data)
-      # 0x359
-      if (InvBatteryAlarms.encode()):
-         msg = can.Message(arbitration_id=InvBatteryAlarms.frame, data=InvBatteryAlarms.message, is_extended_id=False) 
-         CANPort.send(msg)
-         #update metrics
-         metrics.lastInverterWrite = datetime.now()
-         metrics.InverterBytesWritten += len(msg.data)
-      sleep(frequency)      
+      #swap in settings changed at runtime between bursts
+      if PendingSettings is not None:
+         applyPendingSettings()
+      if redundancy is not None and not redundancy.sending.is_set():
+         #standby, nothing is encoded (cell balancing comes from the peer) and the
+         #plan is rebuilt on takeover so every frame goes out at once
+         plan = None
+         relay.takePending()
+         redundancy.sending.wait(1)
+         continue
+      if plan is None or plan.output is not InverterOutput or plan.cadence is not InverterCadenceParam:
+         plan = InverterFramePlan(InverterOutput, InverterCadenceParam, monotonic())
+         InverterTiming.period = InverterOutput.frequency
+         InverterTiming.periods = plan.periods
+         relay.setOutput(InverterOutput)
+      if relay.pending:
+         plan.pullForward(relay.takePending(), monotonic(), relay.minInterval)
+      messages = plan.encodeDue(monotonic())
+      if messages:
+         sendStart = perf_counter()
+         messages = sendBurst(CANPort, messages)
+         now = monotonic()
+         sendUs = int((perf_counter() - sendStart) * 1000000)
+         metrics.InverterSendUs = sendUs
+         if sendUs > metrics.InverterSendMaxUs:
+            metrics.InverterSendMaxUs = sendUs
+         if messages:
+            if not InverterBusSupervisor.healthy:
+               InverterBusSupervisor.onSendOK(now)
+            #update metrics
+            metrics.lastInverterWrite = datetime.now()
+         for message in messages:
+            InverterTiming.record(message.arbitration_id, now)
+            relay.sent(message.arbitration_id, now)
+            if CANCapture is not None:
+               CANCapture.capture(CANCaptureRing.INVERTER, message, CANCaptureRing.TX)
+            metrics.InverterBytesWritten += message.dlc
+      #sleep until the next frame is due or a cut-through frame arrives, waking
+      #at least every second to notice a stop
+      delay = plan.nextDue() - monotonic()
+      if delay > 0:
+         relay.wakeup.wait(min(delay, 1))
+         relay.wakeup.clear()
+#endregion
+
+#region ************ RS485 Inverter Output *************
+'''
+--------------------------------------
+Pylontech RS485 console protocol output
+--------------------------------------
+
+For inverters that only poll a Pylontech battery over RS485.  Frames are
+ASCII hex:
+
+  ~ VER ADR CID1 CID2 LENGTH INFO CHKSUM \r
+    20  02  46   42   E002   02   FD33
+
+  LENGTH = 4 bit length checksum + 12 bit count of INFO characters
+  CHKSUM = two's complement of the sum of all characters between ~ and CHKSUM
+
+Answers 0x42 (analog values), 0x44 (alarm info) and 0x47 (system parameters)
+from the same decoded BMS state as the CAN output.  Responses are rendered
+ahead of time (at most every refresh seconds, never on the poll path) and
+cached per address, so answering a poll is only a lookup and a write.
+'''
+
+def pylonRS485LengthChecksum(lenid):
+   return (-((lenid & 0xF) + ((lenid >> 4) & 0xF) + ((lenid >> 8) & 0xF))) & 0xF
+
+def pylonRS485Frame(address, cid2, info=b''):
+   infoHex = info.hex().upper().encode()
+   lenid = len(infoHex)
+   body = b'%02X%02X%02X%02X%04X' % (0x20, address, 0x46, cid2, (pylonRS485LengthChecksum(lenid) << 12) | lenid) + infoHex
+   return b'~' + body + b'%04X' % ((-sum(body)) & 0xFFFF) + b'\r'
+
+def pylonRS485Parse(frame):
+   # returns (address, cid1, cid2, info) or raises ValueError
+   if len(frame) < 17 or frame[0:1] != b'~':
+      raise ValueError('short or unframed request')
+   body = frame[1:-4]
+   if int(frame[-4:], 16) != (-sum(body)) & 0xFFFF:
+      raise ValueError('checksum error')
+   address = int(body[2:4], 16)
+   cid1 = int(body[4:6], 16)
+   cid2 = int(body[6:8], 16)
+   length = int(body[8:12], 16)
+   lenid = length & 0x0FFF
+   if cid1 != 0x46:
+      #0x46 is the battery device type, other devices share the bus
+      raise ValueError('not a battery request, CID1 ' + hex(cid1))
+   if length >> 12 != pylonRS485LengthChecksum(lenid) or len(body) != 12 + lenid:
+      raise ValueError('LENGTH error')
+   return address, cid1, cid2, bytes.fromhex(body[12:].decode())
+
+class PylonRS485Output ():
+   RTN_NORMAL = 0x00
+   RTN_CID2_INVALID = 0x04
+
+   def __init__(self, cells=15, refresh=1):
+      self.cells = cells
+      self.refresh = refresh
+      self.responses = {}      #(address, cid2) -> rendered response bytes
+      self.lastRender = 0.0
+      self.renderers = {0x42: self.__analog, 0x44: self.__alarms, 0x47: self.__parameters}
+
+   def __analog(self, address):
+      info = bytearray(struct.pack('>BBB', 0, address, self.cells))
+      cellVoltage = int(BMSBatteryMeasurements.batteryVoltage * 1000 / self.cells)
+      info += struct.pack('>H', cellVoltage) * self.cells
+      info += struct.pack('>BH', 1, int(BMSBatteryMeasurements.batteryTemperature * 10) + 2731)
+      #10mA signed, clamped so an out of range reading cannot fail the render
+      current = max(-32768, min(32767, int(BMSBatteryMeasurements.batteryCurrent * 100)))
+      info += struct.pack('>hH', current, int(BMSBatteryMeasurements.batteryVoltage * 1000))
+      remaining = BMSBatteryCapacity.batteryRemainingCapacity * 100    #10mAh
+      total = BMSBatteryCapacity.batteryNominalCapacity * 100
+      if total <= 0xFFFF:
+         info += struct.pack('>HBHH', remaining, 2, total, 0)
+      else:
+         #capacities over 655Ah use the 3 byte mAh extension
+         info += struct.pack('>HBHH', 0xFFFF, 4, 0xFFFF, 0)
+         info += (remaining * 10).to_bytes(3, 'big') + (total * 10).to_bytes(3, 'big')
+      return bytes(info)
+
+   def __alarms(self, address):
+      alarms = BMSBatteryAlarms.alarms
+      info = bytearray(struct.pack('>BBB', 0, address, self.cells))
+      info += bytes(self.cells)                 #per cell status, not reported by the BMS
+      temperatureStatus = 0
+      if Alarm.DISCHARGE_TEMPERATURE_HIGH in alarms or Alarm.CHARGE_TEMPERATURE_HIGH in alarms:
+         temperatureStatus = 2
+      elif Alarm.DISCHARGE_TEMPERATURE_LOW in alarms or Alarm.CHARGE_TEMPERATURE_LOW in alarms:
+         temperatureStatus = 1
+      voltageStatus = 2 if Alarm.PACK_VOLTAGE_HIGH in alarms else 1 if Alarm.PACK_VOLTAGE_LOW in alarms else 0
+      status1 = ((Alarm.PACK_VOLTAGE_LOW in alarms) << 7 |
+                 (Alarm.CHARGE_TEMPERATURE_HIGH in alarms) << 6 |
+                 (Alarm.DISCHARGE_TEMPERATURE_HIGH in alarms) << 5 |
+                 (Alarm.DISCHARGE_CURRENT_HIGH in alarms) << 4 |
+                 (Alarm.CHARGE_CURRENT_HIGH in alarms) << 2 |
+                 (Alarm.PACK_VOLTAGE_HIGH in alarms))
+      info += struct.pack('>BBBBBBBBBBB', 1, temperatureStatus,
+                          2 if Alarm.CHARGE_CURRENT_HIGH in alarms else 0,
+                          voltageStatus,
+                          2 if Alarm.DISCHARGE_CURRENT_HIGH in alarms else 0,
+                          status1, 0x06, 0, 0, 0, 0)   #status2: charge and discharge MOSFET on
+      return bytes(info)
+
+   def __parameters(self, address):
+      chargeVoltage = int(BMSBatteryLimits.requestedChargeVoltage * 1000)
+      cutOutVoltage = int(BMSBatteryLimits.lowBatteryCutOutVoltage * 1000)
+      return struct.pack('>BHHHHHhHHHHHh', 0,
+                         chargeVoltage // self.cells, cutOutVoltage // self.cells, cutOutVoltage // self.cells,
+                         3181, 2731,                                              #charge temperature limits 45C / 0C
+                         int(BMSBatteryLimits.requestedChargeCurrent * 10),
+                         chargeVoltage, cutOutVoltage, cutOutVoltage,
+                         3281, 2531,                                              #discharge temperature limits 55C / -20C
+                         -int(BMSBatteryLimits.requestedMaximumDischargeCurrent * 10))
+
+   def render(self, now):
+      # rebuild every cached response, called off the poll path
+      if not (BMSBatteryMeasurements.initialized and BMSBatteryLimits.initialized):
+         return
+      for address, cid2 in list(self.responses):
+         self.responses[(address, cid2)] = pylonRS485Frame(address, self.RTN_NORMAL, self.renderers[cid2](address))
+      self.lastRender = now
+
+   def respond(self, request):
+      try:
+         address, cid1, cid2, info = pylonRS485Parse(request)
+      except ValueError:
+         metrics.RS485Errors += 1
+         return None
+      response = self.responses.get((address, cid2))
+      if response is None:
+         if cid2 not in self.renderers or not BMSBatteryMeasurements.initialized:
+            return pylonRS485Frame(address, self.RTN_CID2_INVALID)
+         #first poll for this address, render once and cache
+         response = pylonRS485Frame(address, self.RTN_NORMAL, self.renderers[cid2](address))
+         self.responses[(address, cid2)] = response
+      return response
+
+def openSerialPort (device, baudrate):
+   # raw termios so a pty pair can stand in for the RS485 adapter
+   fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+   attributes = termios.tcgetattr(fd)
+   attributes[0] = 0                                      #iflag
+   attributes[1] = 0                                      #oflag
+   attributes[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+   attributes[3] = 0                                      #lflag
+   speed = getattr(termios, 'B' + str(baudrate))
+   attributes[4] = speed
+   attributes[5] = speed
+   termios.tcsetattr(fd, termios.TCSANOW, attributes)
+   return fd
+
+def writeInverterRS485 (runEvent, device, baudrate, cells):
+   output = PylonRS485Output(cells)
+   fd = openSerialPort(device, baudrate)
+   request = bytearray()
+   try:
+      while runEvent.is_set():
+         readable, _, _ = select.select([fd], [], [], 0.2)
+         if readable:
+            request += os.read(fd, 256)
+            while b'\r' in request:
+               end = request.index(b'\r')
+               start = request.rfind(b'~', 0, end)
+               frame = bytes(request[start:end]) if start >= 0 else b''
+               del request[:end + 1]
+               response = output.respond(frame)
+               if response is not None:
+                  os.write(fd, response)
+                  metrics.RS485Polls += 1
+                  metrics.lastRS485Write = datetime.now()
+            if len(request) > 4096:
+               del request[:]
+         now = monotonic()
+         if now - output.lastRender >= output.refresh:
+            output.render(now)
+   finally:
+      os.close(fd)
+
+#endregion
+
+#region ************ Inverter Feedback ************
+'''
+--------------------------------------
+Inverter feedback frames
+--------------------------------------
+
+Frames the inverter sends on its own bus.  Pylontech style inverters only
+send an all zero 0x305 keep alive, SMA Sunny Island style inverters report
+their own view of the battery in 0x305 and their charge state in 0x306.
+Known frames are decoded into InverterFeedback for MQTT, only the ids in
+inverter.forward-ids (the keep alive the BMS needs) are forwarded to it.
+
+To decode another frame add a class with fields / layout and decode, and
+add it to InverterFeedbackDecoders.
+'''
+
+'''
+Inverter Battery Report (0x305), SMA Sunny Island style, all zero keep alive
+from Pylontech style inverters
+
+  Bytes Value   Dec Value   Converted Value     Description   
+  0-1   0211    529         52.9 V              Battery Voltage
+  2-3   FFBB    65444       -9.2 A              Battery Current
+  4-5   00F0    240         24 ºC               Battery Temperature
+  6-7   0302    770         77.0%               State of Charge
+'''
+class InverterBatteryReport ():
+   initialized = False
+   batteryVoltage = 0.0
+   batteryCurrent = 0.0
+   batteryTemperature = 0.0
+   stateOfCharge = 0.0
+
+   fields = (('batteryVoltage', 'H', 10),
+             ('batteryCurrent', 'h', 10),
+             ('batteryTemperature', 'h', 10),
+             ('stateOfCharge', 'H', 10))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
+
+   def decode(self, buffer):
+      #keep alive only
+      if len(buffer) != 8 or not any(buffer):
+         return
+      unpackedBuffer = self.layout.unpack(buffer)
+
+      self.batteryVoltage = unpackedBuffer[0]/10
+      self.batteryCurrent = unpackedBuffer[1]/10
+      self.batteryTemperature = unpackedBuffer[2]/10
+      self.stateOfCharge = unpackedBuffer[3]/10
+      self.initialized = True
+
+'''
+Inverter Charge State (0x306), SMA Sunny Island style
+
+  Bytes Value   Dec Value   Converted Value     Description   
+  0-1   0064    100         100%                State of Health
+  2     01      1           1                   Charging Procedure
+  3     02      2           2                   Operating State
+  4-5   0000    0           0                   Active Error Message
+  6-7   022F    559         55.9v               Charge Voltage Setpoint
+'''
+class InverterChargeState ():
+   initialized = False
+   stateOfHealth = 0
+   chargingProcedure = 0
+   operatingState = 0
+   activeError = 0
+   chargeVoltageSetpoint = 0.0
+
+   fields = (('stateOfHealth', 'H', 1),
+             ('chargingProcedure', 'B', 1),
+             ('operatingState', 'B', 1),
+             ('activeError', 'H', 1),
+             ('chargeVoltageSetpoint', 'H', 10))
+   layout = struct.Struct('<' + ''.join(code for _, code, _ in fields))
+
+   def decode(self, buffer):
+      if len(buffer) != 8:
+         return
+      unpackedBuffer = self.layout.unpack(buffer)
+
+      self.stateOfHealth = unpackedBuffer[0]
+      self.chargingProcedure = unpackedBuffer[1]
+      self.operatingState = unpackedBuffer[2]
+      self.activeError = unpackedBuffer[3]
+      self.chargeVoltageSetpoint = unpackedBuffer[4]/10
+      self.initialized = True
+
+InverterFeedbackDecoders = {
+   0x305: InverterBatteryReport,
+   0x306: InverterChargeState,
+}
+
+class InverterFeedbackState ():
+
+   def __init__(self):
+      # arbitration id -> decoder instance, filled as frames are decoded
+      self.frames = {frameId: decoder() for frameId, decoder in InverterFeedbackDecoders.items()}
+      self.dispatch = {frameId: frame.decode for frameId, frame in self.frames.items()}
+      self.batteryReport = self.frames[0x305]
+      self.chargeState = self.frames[0x306]
+
+   def summary(self):
+      data = {}
+      if self.batteryReport.initialized:
+         data["inverterBatteryVoltage"] = self.batteryReport.batteryVoltage
+         data["inverterBatteryCurrent"] = self.batteryReport.batteryCurrent
+         data["inverterBatteryTemperature"] = self.batteryReport.batteryTemperature
+         data["inverterStateOfCharge"] = self.batteryReport.stateOfCharge
+      if self.chargeState.initialized:
+         data["inverterStateOfHealth"] = self.chargeState.stateOfHealth
+         data["inverterChargingProcedure"] = self.chargeState.chargingProcedure
+         data["inverterOperatingState"] = self.chargeState.operatingState
+         data["inverterActiveError"] = self.chargeState.activeError
+         data["inverterChargeVoltageSetpoint"] = self.chargeState.chargeVoltageSetpoint
+      return data
+
 #endregion
 
 #region ************ Inverter->BMS Heartbeat ************
@@ -955,14 +3070,52 @@ inverter Heartbeat Methods
 '''
 
 def inverterHeartbeat (runEvent,InverterCANPort, BMSCANPort):
-   #forward heartbeat events to BMS
+   #decode inverter feedback, forward only the heartbeat ids the BMS needs
+   dispatch = InverterFeedback.dispatch
+   redundancy = Redundancy
+   timeout = 1 if redundancy is None else redundancy.pollInterval
+
    while runEvent.is_set():
-      message = InverterCANPort.recv()
+      if redundancy is not None:
+         redundancy.check(monotonic())
+      #timeout so the thread can be stopped when the inverter is quiet
+      try:
+         message = InverterCANPort.recv(timeout=timeout)
+      except can.CanError as e:
+         InverterBusSupervisor.onSocketError(e, monotonic())
+         sleep(0.1)
+         continue
       if message is not None:
-         BMSCANPort.send(message)
+         if message.is_error_frame:
+            InverterBusSupervisor.onErrorFrame(message, monotonic())
+            continue
+         if not InverterBusSupervisor.healthy:
+            InverterBusSupervisor.onFrame(monotonic())
+         metrics.InverterBytesRead += len(message.data)
+         decode = dispatch.get(message.arbitration_id)
+         if decode is not None:
+            decode(message.data)
+         if redundancy is not None and not redundancy.sending.is_set():
+            #standby, the sending bridge forwards
+            if message.arbitration_id in redundancy.peerFrames:
+               redundancy.peerFrame(monotonic())
+            continue
+         #the global is read per frame so a config reload applies without a restart
+         if message.arbitration_id not in InverterForwardIdsParam:
+            metrics.InverterFramesFiltered += 1
+            if CANCapture is not None:
+               CANCapture.capture(CANCaptureRing.INVERTER, message)
+            continue
+         try:
+            BMSCANPort.send(message)
+         except can.CanError as e:
+            BMSBusSupervisor.onSendError(e, monotonic())
+            continue
+         if CANCapture is not None:
+            CANCapture.capture(CANCaptureRing.INVERTER, message)
+            CANCapture.capture(CANCaptureRing.BMS, message, CANCaptureRing.TX)
          #update metrics
          metrics.lastHeartbeat = datetime.now()
-         metrics.InverterBytesRead += len(message.data)
          metrics.BMSBytesWritten += len(message.data)
 
 #endregion
@@ -975,15 +3128,17 @@ Periodic info messages
 '''
 
 def infoMessage(runEvent,frequency):
+   #let the first BMS frames arrive before the first table, without holding up startup
+   sleep (1)
 
    while runEvent.is_set():
       logger.info ('')
 
-      if 'InvBatteryStatus' in globals():
-         if InvBatteryStatus.IsCellBalancingActive:
+      if 'InverterOutput' in globals():
+         if InverterOutput.status.IsCellBalancingActive:
             CellBalanceActiveStatus = 'Active'
-            InverterFakeoutSOC = InvBatteryStatus.InverterFakeoutSOC
-            CellBalancingRemainingTime = InvBatteryStatus.CellBalancingRemainingTime
+            InverterFakeoutSOC = InverterOutput.status.InverterFakeoutSOC
+            CellBalancingRemainingTime = InverterOutput.status.CellBalancingRemainingTime
          else:
             CellBalanceActiveStatus = 'Inactive'
             InverterFakeoutSOC = 'N/A'
@@ -1024,124 +3179,1370 @@ MQTT Methods
 --------------------------------------
 '''
 
-# mqtt on connect event
-def MQTTOnConnect(client, userdata, flags, rc):
-   logger.info ('MQTT Connection Acknowledgment received')
+'''
+MQTT publisher with a bounded queue
+
+MQTTWriter only ever enqueues, so a slow or missing broker can not block the
+writer or grow memory.  The queue either coalesces by topic (only the newest
+payload per topic is kept) or drops the oldest message when full.  A
+publisher thread hands messages to paho while fewer than inflight messages
+are waiting on an acknowledgment, and paho reconnects in the background with
+exponential backoff between reconnect-min-delay and reconnect-max-delay.
+Messages not acknowledged within ack-timeout seconds, or unacknowledged when
+the connection drops (the clean session loses them), stop counting against
+the inflight window.
+'''
+class MQTTPublisher ():
+
+   def __init__(self, hostname, port, qos=2, queueSize=100, queueMode='coalesce', inflight=10,
+                reconnectMinDelay=1, reconnectMaxDelay=120, ackTimeout=30):
+      self.hostname = hostname
+      self.port = port
+      self.qos = qos
+      self.queueSize = queueSize
+      self.coalesce = queueMode == 'coalesce'
+      self.inflightWindow = inflight
+      self.ackTimeout = ackTimeout
+      self.connected = False
+      self.__queue = OrderedDict() if self.coalesce else deque()
+      self.__sequence = itertools.count()
+      self.__queueLock = threading.Lock()
+      self.__wakeup = threading.Event()
+      self.__inflight = {}      #mid -> monotonic publish time
+      self.__ackTimes = {}      #mid -> monotonic ack time, set from the paho network thread
+      self.__running = False
+      self.__subscriptions = {}  #topic -> callback(payload)
+
+      #paho is imported on first use so it does not delay the CAN ports at startup
+      global mqtt
+      import paho.mqtt.client as mqtt
+      self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+      self.client.on_connect = self.__onConnect
+      self.client.on_disconnect = self.__onDisconnect
+      self.client.on_publish = self.__onPublish
+      self.client.on_message = self.__onMessage
+      self.client.reconnect_delay_set(reconnectMinDelay, reconnectMaxDelay)
+      #hard cap on paho's own queue in case a publish races a disconnect
+      self.client.max_queued_messages_set(queueSize)
+
+   def __onConnect(self, client, userdata, flags, reasonCode, properties):
+      logger.info ('MQTT Connection Acknowledgment received: ' + str(reasonCode))
+      self.connected = not reasonCode.is_failure
+      metrics.MQTTConnected = self.connected
+      metrics.MQTTConnects += 1
+      #subscriptions do not survive a reconnect with a clean session
+      for topic in self.__subscriptions:
+         self.client.subscribe(topic, qos=1)
+      self.__wakeup.set()
+
+   def __onDisconnect(self, client, userdata, flags, reasonCode, properties):
+      self.connected = False
+      if self.__running:
+         logger.warning ('MQTT disconnected: ' + str(reasonCode) + ', reconnecting with backoff')
+      metrics.MQTTConnected = False
+      #the publisher thread drops the inflight messages, they are lost with the session
+      self.__wakeup.set()
+
+   def __onPublish(self, client, userdata, mid, reasonCode, properties):
+      self.__ackTimes[mid] = monotonic()
+      self.__wakeup.set()
+
+   def __onMessage(self, client, userdata, message):
+      callback = self.__subscriptions.get(message.topic)
+      if callback is not None:
+         callback(message.payload)
+
+   def subscribe(self, topic, callback):
+      self.__subscriptions[topic] = callback
+      if self.connected:
+         self.client.subscribe(topic, qos=1)
+
+   def start(self):
+      #connect_async never raises if the broker is not up yet, loop_start retries with backoff
+      self.client.connect_async(self.hostname, self.port)
+      self.client.loop_start()
+      self.__running = True
+      self.__thread = threading.Thread(target=self.__publisher, daemon=True)
+      self.__thread.start()
+
+   def stop(self):
+      self.__running = False
+      self.__wakeup.set()
+      self.__thread.join()
+      self.client.disconnect()
+      self.client.loop_stop()
+
+   def reconnect(self, hostname, port):
+      # point the client at a new broker, queued messages are kept
+      logger.info ('MQTT broker changed to ' + hostname + ':' + str(port))
+      self.hostname = hostname
+      self.port = port
+      self.connected = False
+      self.client.disconnect()
+      self.client.loop_stop()
+      self.client.connect_async(hostname, port)
+      self.client.loop_start()
+
+   def publish(self, topic, payload, retain=False, coalesce=True):
+      # returns False if an older message had to be dropped to make room,
+      # coalesce=False keeps every message on the topic (events)
+      dropped = False
+      with self.__queueLock:
+         if self.coalesce:
+            key = topic if coalesce else (topic, next(self.__sequence))
+            if key in self.__queue:
+               self.__queue[key] = (topic, payload, retain)
+               metrics.MQTTCoalesced += 1
+            else:
+               if len(self.__queue) >= self.queueSize:
+                  self.__queue.popitem(last=False)
+                  dropped = True
+               self.__queue[key] = (topic, payload, retain)
+         else:
+            if len(self.__queue) >= self.queueSize:
+               self.__queue.popleft()
+               dropped = True
+            self.__queue.append((topic, payload, retain))
+         metrics.MQTTQueueDepth = len(self.__queue)
+      if dropped:
+         metrics.MQTTDropped += 1
+      self.__wakeup.set()
+      return not dropped
+
+   def __next(self):
+      with self.__queueLock:
+         if not self.__queue:
+            return None
+         if self.coalesce:
+            message = self.__queue.popitem(last=False)[1]
+         else:
+            message = self.__queue.popleft()
+         metrics.MQTTQueueDepth = len(self.__queue)
+         return message
+
+   def __reapAcks(self):
+      # publisher thread only, the paho thread only adds to __ackTimes
+      if not self.connected:
+         self.__inflight.clear()
+         self.__ackTimes.clear()
+      for mid in [mid for mid in self.__inflight if mid in self.__ackTimes]:
+         latency = int((self.__ackTimes.pop(mid) - self.__inflight.pop(mid)) * 1000)
+         metrics.MQTTAckLatencyMs = latency
+         if latency > metrics.MQTTAckLatencyMaxMs:
+            metrics.MQTTAckLatencyMaxMs = latency
+      #acks for messages no longer tracked (publish failed after paho queued it)
+      if len(self.__ackTimes) > self.inflightWindow:
+         self.__ackTimes.clear()
+      expired = monotonic() - self.ackTimeout
+      for mid in [mid for mid, sendTime in self.__inflight.items() if sendTime < expired]:
+         del self.__inflight[mid]
+         metrics.MQTTAckTimeouts += 1
+      metrics.MQTTInflight = len(self.__inflight)
+
+   def __publisher(self):
+      while self.__running:
+         self.__wakeup.wait(1)
+         self.__wakeup.clear()
+         self.__reapAcks()
+         while self.connected and len(self.__inflight) < self.inflightWindow:
+            message = self.__next()
+            if message is None:
+               break
+            sendTime = monotonic()
+            info = self.client.publish(message[0], message[1], qos=self.qos, retain=message[2])
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+               metrics.MQTTPublishErrors += 1
+               logger.debug ('MQTT publish to ' + message[0] + ' failed: ' + mqtt.error_string(info.rc))
+            else:
+               self.__inflight[info.mid] = sendTime
+         self.__reapAcks()
+
+'''
+Runtime command channel
+
+Accepts a JSON object on the command topic, for example:
+  {"hold-soc": 98, "minutes": 40, "interval-days": 3, "lowVoltageWarning": 48.0,
+   "outputProtocol": "pylontech", "balance": true}
+The whole command is validated before anything is applied and the outcome is
+published to <command topic>/result.
+'''
+def MQTTCommand (payload):
+   try:
+      changes = json.loads(payload)
+      settings = updateSettings(changes)
+   except ValueError as e:
+      logger.warning ('Rejected MQTT command ' + payload.decode('utf-8', 'replace') + ': ' + str(e))
+      MQTTClient.publish(MQTTCommandTopicParam + "/result", json.dumps({"status": "rejected", "error": str(e)}))
+      return
+   logger.info ('Accepted MQTT command: ' + json.dumps(changes))
+   MQTTClient.publish(MQTTCommandTopicParam + "/result", json.dumps({"status": "accepted", "settings": settings.asDict(),
+                                                                     "balance": settings.balanceRequested}))
+
+def startMQTT ():
+   global MQTTClient
+   MQTTClient = MQTTConnect(MQTTHostParam, MQTTPortParam)
 
 def MQTTConnect (hostname, port):
-   client = mqtt.Client()
-   client.on_connect = MQTTOnConnect
-   client.connect(hostname, port)
-   client.loop_start()
+   client = MQTTPublisher(hostname, port,
+                          MQTTQoSParam,
+                          MQTTQueueSizeParam,
+                          MQTTQueueModeParam,
+                          MQTTInflightParam,
+                          MQTTReconnectMinDelayParam,
+                          MQTTReconnectMaxDelayParam,
+                          MQTTAckTimeoutParam)
+   client.subscribe(MQTTCommandTopicParam, MQTTCommand)
+   client.start()
    return client
 
+def stateSnapshot ():
+   # decoded BMS state, cell balancing and bus metrics, shared by MQTT and the dashboard
+   data = {
+      "lowBatteryCutOutVoltage": BMSBatteryLimits.lowBatteryCutOutVoltage,
+      "requestedChargeCurrent": BMSBatteryLimits.requestedChargeCurrent,
+      "requestedChargeVoltage": BMSBatteryLimits.requestedChargeVoltage,
+      "requestedMaximumDischargeCurrent": BMSBatteryLimits.requestedMaximumDischargeCurrent,
+      "stateOfCharge": BMSBatteryStatus.batteryStateOfCharge,
+      "inverterFakeoutSOC": InverterOutput.status.InverterFakeoutSOC,
+      "cellBalancingRemainingTime": InverterOutput.status.CellBalancingRemainingTime,
+      "isCellBalancingActive": InverterOutput.status.IsCellBalancingActive,
+      "stateOfHealth": BMSBatteryStatus.batteryStateOfHealth,
+      "batteryNominalCapacity":BMSBatteryCapacity.batteryNominalCapacity,
+      "batteryRemainingCapacity":BMSBatteryCapacity.batteryRemainingCapacity,
+      "batteryCurrent":BMSBatteryMeasurements.batteryCurrent,
+      "batteryTemperature":BMSBatteryMeasurements.batteryTemperature,
+      "batteryTemperatureF":BMSBatteryMeasurements.batteryTemperatureF,
+      "batteryVoltage":BMSBatteryMeasurements.batteryVoltage,
+      "BMSLastReadTime":metrics.lastBMSRead.isoformat(),
+      "InverterLastWriteTime":metrics.lastInverterWrite.isoformat(),
+      "LastHeartbeatTime":metrics.lastHeartbeat.isoformat(),
+      "BMSLastReadMSAgo": metrics.millisecondsAgo(metrics.lastBMSRead),
+      "InverterLastWriteMSAgo": metrics.millisecondsAgo(metrics.lastInverterWrite),
+      "LastHeartbeatMSAgo": metrics.millisecondsAgo(metrics.lastHeartbeat),
+      "BMSBytesRead":metrics.BMSBytesRead,
+      "BMSBytesWritten":metrics.BMSBytesWritten,
+      "InverterReadBytes":metrics.InverterBytesRead,
+      "InverterWriteBytes":metrics.InverterBytesWritten,
+      "InverterFramesFiltered":metrics.InverterFramesFiltered,
+      "BMSDecodeErrors":metrics.BMSDecodeErrors,
+      "MQTTConnected":metrics.MQTTConnected,
+      "MQTTQueueDepth":metrics.MQTTQueueDepth,
+      "MQTTInflight":metrics.MQTTInflight,
+      "MQTTDropped":metrics.MQTTDropped,
+      "MQTTCoalesced":metrics.MQTTCoalesced,
+      "MQTTPublishErrors":metrics.MQTTPublishErrors,
+      "MQTTConnects":metrics.MQTTConnects,
+      "MQTTAckLatencyMs":metrics.MQTTAckLatencyMs,
+      "MQTTAckLatencyMaxMs":metrics.MQTTAckLatencyMaxMs,
+      "MQTTAckTimeouts":metrics.MQTTAckTimeouts,
+      "RS485Polls":metrics.RS485Polls,
+      "RS485Errors":metrics.RS485Errors,
+      "ConfigReloads":metrics.ConfigReloads,
+      "ConfigReloadErrors":metrics.ConfigReloadErrors,
+      "ConfigReloadLatencyMs":metrics.ConfigReloadLatencyMs,
+      "StartupMs":metrics.StartupMs,
+      "InverterLateFrames":metrics.InverterLateFrames,
+      "InverterOverruns":metrics.InverterOverruns,
+      "AlarmNotifications":metrics.AlarmNotifications,
+      "AlarmNotifyErrors":metrics.AlarmNotifyErrors,
+      "InverterSendUs":metrics.InverterSendUs,
+      "InverterSendMaxUs":metrics.InverterSendMaxUs,
+      "alarms":sorted(alarm.name for alarm in list(BMSBatteryAlarms.alarms)),
+      "protections":sorted(protection.name for protection in list(BMSBatteryAlarms.protections))
+
+      }
+   if BMSSOCEstimator is not None and BMSSOCEstimator.initialized:
+      data["estimatedStateOfCharge"] = round(BMSSOCEstimator.stateOfCharge, 2)
+      data["estimatedRemainingCapacity"] = round(BMSSOCEstimator.remainingCapacity, 3)
+      data["timeToEmptyMinutes"] = BMSSOCEstimator.timeToEmpty
+      data["timeToFullMinutes"] = BMSSOCEstimator.timeToFull
+   if BMSEnergy is not None:
+      data.update(BMSEnergy.summary(BMSBatteryCapacity.batteryNominalCapacity))
+   data.update(InverterFeedback.summary())
+   data.update(InverterTiming.summary())
+   data.update(InverterRelay.summary())
+   if Redundancy is not None:
+      data.update(Redundancy.summary())
+   data.update(BMSBusSupervisor.summary())
+   data.update(InverterBusSupervisor.summary())
+   return data
+
+def identitySnapshot ():
+   # BMS identity, published retained on change instead of with every state
+   return {
+      "manufacturer":BMSManufacturer.manufacturer,
+      "lynxFirmwareVersion":BMSLynxFirmware.versionString,
+      "lynxFirmwareVersionInt":BMSLynxFirmware.versionInt,
+      "BMSModelNameUpper":BMSModelNameUpper.modelName,
+      "BMSModelNameLower":BMSModelNameLower.modelName,
+      "protocolVersion":BMSProtocolVersion.versionString,
+   }
+
+def identityRevision ():
+   return (BMSManufacturer.revision, BMSModelNameUpper.revision, BMSModelNameLower.revision,
+           BMSLynxFirmware.revision, BMSProtocolVersion.revision)
+
 def MQTTWriter (runEvent, frequency):
+   #per module telemetry changes slowly and is much larger, it goes out less often
+   modulesDue = monotonic()
+   energyDue = monotonic()
+   publishedIdentity = None
+
    while runEvent.is_set():
 
-      if 'InvBatteryStatus' in globals():       
-         data= {
-            "lowBatteryCutOutVoltage": BMSBatteryLimits.lowBatteryCutOutVoltage,
-            "requestedChargeCurrent": BMSBatteryLimits.requestedChargeCurrent,
-            "requestedChargeVoltage": BMSBatteryLimits.requestedChargeVoltage,
-            "requestedMaximumDischargeCurrent": BMSBatteryLimits.requestedMaximumDischargeCurrent,
-            "stateOfCharge": BMSBatteryStatus.batteryStateOfCharge,
-            "inverterFakeoutSOC": InvBatteryStatus.InverterFakeoutSOC,
-            "cellBalancingRemainingTime": InvBatteryStatus.CellBalancingRemainingTime,
-            "isCellBalancingActive": InvBatteryStatus.IsCellBalancingActive,
-            "stateOfHealth": BMSBatteryStatus.batteryStateOfHealth,
-            "batteryNominalCapacity":BMSBatteryCapacity.batteryNominalCapacity,
-            "batteryRemainingCapacity":BMSBatteryCapacity.batteryRemainingCapacity,
-            "batteryCurrent":BMSBatteryMeasurements.batteryCurrent,
-            "batteryTemperature":BMSBatteryMeasurements.batteryTemperature,
-            "batteryTemperatureF":BMSBatteryMeasurements.batteryTemperatureF,
-            "batteryVoltage":BMSBatteryMeasurements.batteryVoltage,
-            "manufacturer":BMSManufacturer.manufacturer,
-            "lynxFirmwareVersion":BMSLynxFirmware.versionString,
-            "BMSModelNameUpper":BMSModelNameUpper.modelName,
-            "BMSModelNameLower":BMSModelNameLower.modelName,
-            "protocolVersion":BMSProtocolVersion.versionString,
-            "BMSLastReadTime":metrics.lastBMSRead.isoformat(),
-            "InverterLastWriteTime":metrics.lastInverterWrite.isoformat(),
-            "LastHeartbeatTime":metrics.lastHeartbeat.isoformat(),
-            "BMSLastReadMSAgo": metrics.millisecondsAgo(metrics.lastBMSRead),
-            "InverterLastWriteMSAgo": metrics.millisecondsAgo(metrics.lastInverterWrite),
-            "LastHeartbeatMSAgo": metrics.millisecondsAgo(metrics.lastHeartbeat),
-            "BMSBytesRead":metrics.BMSBytesRead,
-            "BMSBytesWritten":metrics.BMSBytesWritten,
-            "InverterReadBytes":metrics.InverterBytesRead,
-            "InverterWriteBytes":metrics.InverterBytesWritten
-
-            }
-         (rc, mid) = MQTTClient.publish("DiscoverStorage", json.dumps(data, indent=2), qos=2)
+      #a standby bridge leaves publishing to the sending one
+      standby = Redundancy is not None and not Redundancy.sending.is_set()
+      if standby:
+         BMSAlarmEvents.takeUnpublished()
+
+      if 'InverterOutput' in globals() and MQTTClient is not None and not standby:
+         data = stateSnapshot()
+         MQTTClient.publish("DiscoverStorage", json.dumps(data, indent=2))
+
+         revision = identityRevision()
+         if revision != publishedIdentity:
+            publishedIdentity = revision
+            MQTTClient.publish("DiscoverStorage/identity", json.dumps(identitySnapshot(), indent=2), retain=True)
 
          AGSData = BMSBatteryStatus.batteryStateOfCharge
-         (rc, mid) = MQTTClient.publish("ags/soc", AGSData, qos=2)
+         MQTTClient.publish("ags/soc", AGSData)
 
          AGSData = BMSBatteryMeasurements.batteryVoltage
-         (rc, mid) = MQTTClient.publish("ags/voltage", AGSData, qos=2)
+         MQTTClient.publish("ags/voltage", AGSData)
 
          AGSData = BMSBatteryMeasurements.batteryTemperature
-         (rc, mid) = MQTTClient.publish("ags/temperature", AGSData, qos=2)
+         MQTTClient.publish("ags/temperature", AGSData)
 
          AGSData = "Inverting"
-         (rc, mid) = MQTTClient.publish("ags/status", AGSData, qos=2)
+         MQTTClient.publish("ags/status", AGSData)
+
+         #one message per alarm event, never coalesced with the previous one
+         events = BMSAlarmEvents.takeUnpublished()
+         for event in events:
+            MQTTClient.publish("DiscoverStorage/alarms/events", json.dumps(event), coalesce=False)
+         if events:
+            MQTTClient.publish("DiscoverStorage/alarms/history", json.dumps(list(BMSAlarmEvents.history)), retain=True)
+
+         if BMSModules.initialized and monotonic() >= modulesDue:
+            modulesDue = monotonic() + ModulesParam.get('interval', 10)
+            MQTTClient.publish("DiscoverStorage/modules", json.dumps(BMSModules.snapshot(), indent=2))
+
+         if BMSEnergy is not None and monotonic() >= energyDue:
+            energyDue = monotonic() + EnergyParam.get('interval', 60)
+            MQTTClient.publish("DiscoverStorage/energy", json.dumps(BMSEnergy.buckets(), indent=2))
 
 
     
       sleep(frequency)
 # endregion
 
+#region ************** Dashboard **************
+'''
+--------------------------------------
+Debug web dashboard
+--------------------------------------
+
+Optional embedded HTTP server with a single page that follows the bridge
+state over Server-Sent Events (GET /events).  One publisher thread takes a
+stateSnapshot() every interval, diffs it against the previous one and
+serializes only the changed fields, once, into an SSE event shared by every
+client.  Each client has a small bounded queue; a client that can not keep
+up is disconnected (the browser reconnects and receives a full snapshot)
+rather than slowing anything down.  Nothing here runs on the CAN threads.
+'''
+
+DashboardPage = b"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>BMS2Inverter</title>
+<style>body{font-family:monospace;margin:1em}td{padding:2px 12px}tr:nth-child(odd){background:#eee}.changed{color:#c00}</style>
+</head><body><h3>BMS2Inverter</h3><table id="state"></table>
+<script>
+var rows = {};
+var source = new EventSource("events");
+source.onmessage = function(event) {
+   var changes = JSON.parse(event.data);
+   for (var key in changes) {
+      if (!(key in rows)) {
+         var row = document.getElementById("state").insertRow(-1);
+         row.insertCell(0).textContent = key;
+         rows[key] = row.insertCell(1);
+      }
+      rows[key].textContent = JSON.stringify(changes[key]);
+      rows[key].className = "changed";
+      setTimeout(function(cell) { cell.className = ""; }, 800, rows[key]);
+   }
+};
+</script></body></html>
+"""
+
+class DashboardPublisher ():
+
+   def __init__(self, interval=1, maxClients=8, clientQueueSize=16):
+      self.interval = interval
+      self.maxClients = maxClients
+      self.clientQueueSize = clientQueueSize
+      self.clients = []
+      self.clientsLock = threading.Lock()
+      self.snapshot = {}
+      self.snapshotEvent = b''     #full snapshot for newly connected clients
+      self.__running = False
+
+   def addClient(self):
+      # returns a queue of ready to write SSE events and the current full snapshot, or None if full
+      with self.clientsLock:
+         if len(self.clients) >= self.maxClients:
+            return None, b''
+         clientQueue = queue.Queue(self.clientQueueSize)
+         self.clients.append(clientQueue)
+         metrics.DashboardClients = len(self.clients)
+         return clientQueue, self.snapshotEvent
+
+   def removeClient(self, clientQueue):
+      with self.clientsLock:
+         if clientQueue in self.clients:
+            self.clients.remove(clientQueue)
+         metrics.DashboardClients = len(self.clients)
+
+   def publish(self):
+      if 'InverterOutput' not in globals():
+         return
+      snapshot = stateSnapshot()
+      snapshot.update(identitySnapshot())
+      changes = {key: value for key, value in snapshot.items() if self.snapshot.get(key, self) != value}
+      self.snapshot = snapshot
+      self.snapshotEvent = b'data: ' + json.dumps(snapshot).encode() + b'\n\n'
+      if not changes:
+         return
+      #serialized once, the same bytes go to every client
+      event = b'data: ' + json.dumps(changes).encode() + b'\n\n'
+      with self.clientsLock:
+         clients = list(self.clients)
+      for clientQueue in clients:
+         try:
+            clientQueue.put_nowait(event)
+         except queue.Full:
+            #slow client, drop it, the browser reconnects and resyncs from a full snapshot
+            self.removeClient(clientQueue)
+            #nothing adds to a removed client's queue, emptied it has room for the stop marker
+            with contextlib.suppress(queue.Empty):
+               while True:
+                  clientQueue.get_nowait()
+            clientQueue.put_nowait(None)
+            metrics.DashboardDroppedClients += 1
+
+   def __publisher(self):
+      while self.__running:
+         self.publish()
+         sleep(self.interval)
+
+   def start(self):
+      self.__running = True
+      threading.Thread(target=self.__publisher, daemon=True).start()
+
+   def stop(self):
+      self.__running = False
+
+def dashboardRequestHandler ():
+   # http.server is only imported when the dashboard is enabled
+   from http.server import BaseHTTPRequestHandler
+
+   class DashboardRequestHandler (BaseHTTPRequestHandler):
+
+      def log_message(self, format, *args):
+         logger.debug ('Dashboard: ' + format % args)
+
+      def do_GET(self):
+         if self.path in ('/', '/index.html'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(DashboardPage)))
+            self.end_headers()
+            self.wfile.write(DashboardPage)
+         elif self.path == '/events':
+            self.__events()
+         else:
+            self.send_error(404)
+
+      def __events(self):
+         clientQueue, snapshotEvent = self.server.publisher.addClient()
+         if clientQueue is None:
+            self.send_error(503, 'too many dashboard clients')
+            return
+         try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(b'retry: 2000\n\n' + snapshotEvent)
+            self.wfile.flush()
+            while True:
+               try:
+                  event = clientQueue.get(timeout=15)
+               except queue.Empty:
+                  event = b': keepalive\n\n'
+               if event is None:
+                  break
+               self.wfile.write(event)
+               self.wfile.flush()
+         except (BrokenPipeError, ConnectionResetError):
+            pass
+         finally:
+            self.server.publisher.removeClient(clientQueue)
+
+   return DashboardRequestHandler
+
+def startDashboard (host, port, interval, maxClients):
+   from http.server import ThreadingHTTPServer
+
+   publisher = DashboardPublisher(interval, maxClients)
+   server = ThreadingHTTPServer((host, port), dashboardRequestHandler())
+   server.daemon_threads = True
+   server.publisher = publisher
+   publisher.start()
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   logger.info ('Dashboard listening on http://' + host + ':' + str(port) + '/')
+   return server
+
+#endregion
+
+#region ************** Shared Memory State Export **************
+'''
+--------------------------------------
+Shared memory state export
+--------------------------------------
+
+The decoded state is written after every BMS frame into a fixed layout file
+in /dev/shm (see BMSStateReader.py for the layout and the reader), so local
+processes can map it and read consistent snapshots without the MQTT broker.
+Writes are guarded by a seqlock: the sequence is odd while the record is
+being updated.  Only readBMS writes, so there is a single writer.
+'''
+
+class SharedStateExport ():
+
+   def __init__(self, path):
+      self.path = path
+      self.sequence = 0
+      size = BMSStateReader.Header.size + BMSStateReader.State.size
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+         os.ftruncate(fd, size)
+         self.map = mmap.mmap(fd, size)
+      finally:
+         os.close(fd)
+      BMSStateReader.Header.pack_into(self.map, 0, BMSStateReader.Magic, BMSStateReader.LayoutVersion,
+                                      BMSStateReader.State.size, self.sequence)
+
+   def write(self, values):
+      self.sequence += 1
+      BMSStateReader.Sequence.pack_into(self.map, BMSStateReader.SequenceOffset, self.sequence)
+      BMSStateReader.State.pack_into(self.map, BMSStateReader.Header.size, *values)
+      self.sequence += 1
+      BMSStateReader.Sequence.pack_into(self.map, BMSStateReader.SequenceOffset, self.sequence)
+
+def createStateExport ():
+   global StateExport
+
+   StateExport = None
+   if SharedStateParam.get('enabled', False):
+      path = SharedStateParam.get('path', '/dev/shm/BMS2Inverter.state')
+      try:
+         StateExport = SharedStateExport(path)
+         logger.info ('Exporting state to ' + path)
+      except OSError as e:
+         logger.error ('State export to ' + path + ' disabled: ' + str(e))
+
+def exportState ():
+   # values in BMSStateReader.StateFields order
+   nan = math.nan
+   estimator = BMSSOCEstimator if BMSSOCEstimator is not None and BMSSOCEstimator.initialized else None
+   status = InverterOutput.status if 'InverterOutput' in globals() else None
+   StateExport.write((
+      time(),
+      BMSBatteryStatus.batteryStateOfCharge if BMSBatteryStatus.initialized else nan,
+      estimator.stateOfCharge if estimator is not None else nan,
+      BMSBatteryStatus.batteryStateOfHealth if BMSBatteryStatus.initialized else nan,
+      BMSBatteryMeasurements.batteryVoltage if BMSBatteryMeasurements.initialized else nan,
+      BMSBatteryMeasurements.batteryCurrent if BMSBatteryMeasurements.initialized else nan,
+      BMSBatteryMeasurements.batteryTemperature if BMSBatteryMeasurements.initialized else nan,
+      BMSBatteryLimits.requestedChargeVoltage if BMSBatteryLimits.initialized else nan,
+      BMSBatteryLimits.requestedChargeCurrent if BMSBatteryLimits.initialized else nan,
+      BMSBatteryLimits.requestedMaximumDischargeCurrent if BMSBatteryLimits.initialized else nan,
+      BMSBatteryLimits.lowBatteryCutOutVoltage if BMSBatteryLimits.initialized else nan,
+      BMSBatteryCapacity.batteryNominalCapacity if BMSBatteryCapacity.initialized else nan,
+      BMSBatteryCapacity.batteryRemainingCapacity if BMSBatteryCapacity.initialized else nan,
+      status.InverterFakeoutSOC if status is not None else nan,
+      BMSModules.cellSpread() if BMSModules.initialized else nan,
+      BMSModules.weakestModule,
+      status.IsCellBalancingActive if status is not None else False,
+      BMSBatteryAlarms.mask & 0xFFFFFFFFFFFFFFFF,
+      BMSBatteryAlarms.mask >> 64,
+      BMSEnergy.chargeWh / 1000 if BMSEnergy is not None else nan,
+      BMSEnergy.dischargeWh / 1000 if BMSEnergy is not None else nan))
+
+#endregion
+
+#region ************** Redundancy **************
+'''
+--------------------------------------
+Active / standby redundancy
+--------------------------------------
+
+Two bridges on the same BMS and inverter buses, so a crashed or wedged
+bridge does not leave the inverter without battery frames.  Only the
+sending bridge writes to either bus (inverter frames, forwarded heartbeats)
+and publishes to MQTT.  The standby reads both buses and keeps its own
+decoded state, and watches the inverter bus for the battery frames of the
+sending bridge; once none have been seen for takeover-ms it starts sending
+itself, with every frame due at once.
+
+Cell balancing and energy totals can not be rebuilt from the buses, the
+sending bridge hands them to its peer about once a second over a Unix
+datagram socket and the standby replaces its own with them.  A bridge
+starting up asks its peer first (hello) and stays standby whatever its
+configured role when the peer is already sending, so a restarted bridge
+never takes the bus back.  Should both end up sending (a stalled bridge
+that recovers) the one that started sending later stands down.
+
+Sends never block, a peer that is gone or not reading just misses state.
+
+The sockets live in a directory only the bridge user can enter
+($XDG_RUNTIME_DIR/BMS2Inverter, else ~/.cache/BMS2Inverter), a bridge refuses
+to start on one that is shared, and messages from any other uid than its own
+(the kernel supplied SCM_CREDENTIALS) are dropped, so no other local user can
+stand a bridge down or feed it state.
+'''
+
+class GatewayRedundancy ():
+   #battery frame ids any output protocol sends, seeing one means the peer is sending
+   peerFrames = frozenset(encoder.frame for protocol in InverterProtocols.values() for encoder in protocol.encoders)
+   pollInterval = 0.1      #heartbeat receive timeout while redundant, bounds the takeover check
+
+   def __init__(self, role, socketPath, peerPath, takeover):
+      self.role = role                  #configured role, the startup role unless the peer is sending
+      self.peerPath = peerPath
+      self.takeover = takeover
+      self.sending = threading.Event()
+      self.since = None                 #wall clock time this bridge started sending
+      self.lastPeerFrame = monotonic()  #a lone standby takes over takeover after startup
+      self.lastHandoff = None
+      self.pendingHandoff = None        #state received before the bridge state exists
+      self.takeovers = 0
+      self.takeoverSilenceMs = 0
+      self.handoffsSent = 0
+      self.handoffsReceived = 0
+      self.rejected = 0
+      self.__checkDirectory(os.path.dirname(socketPath))
+      with contextlib.suppress(FileNotFoundError):
+         os.unlink(socketPath)          #left behind by a killed bridge
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self.sock.bind(socketPath)
+      #the kernel attaches the sender's pid, uid and gid to every message received
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+      if role == 'active':
+         self.startSending()
+
+   def __checkDirectory(self, directory):
+      os.makedirs(directory, mode=0o700, exist_ok=True)
+      status = os.stat(directory)
+      if status.st_uid != os.getuid() or status.st_mode & 0o077:
+         raise PermissionError('redundancy socket directory ' + directory + ' must be owned by this user with mode 0700')
+
+   def startSending(self):
+      self.since = time()
+      self.sending.set()
+
+   def standDown(self, now):
+      self.sending.clear()
+      self.since = None
+      self.lastPeerFrame = now
+
+   def send(self, message):
+      # False when the peer is not running or not keeping up
+      try:
+         self.sock.sendto(json.dumps(message).encode(), socket.MSG_DONTWAIT, self.peerPath)
+         return True
+      except OSError:
+         return False
+
+   def sendState(self):
+      if self.send({'type': 'state', 'role': self.role, 'sending': self.sending.is_set(),
+                    'since': self.since, 'state': handoffState()}):
+         self.handoffsSent += 1
+
+   def __receive(self):
+      # the next message from a bridge running as this user, None for anyone else's
+      data, ancillary, _, _ = self.sock.recvmsg(65536, socket.CMSG_SPACE(struct.calcsize('3i')))
+      uid = None
+      for level, kind, value in ancillary:
+         if level == socket.SOL_SOCKET and kind == socket.SCM_CREDENTIALS:
+            _, uid, _ = struct.unpack('3i', value[:struct.calcsize('3i')])
+      if uid != os.getuid():
+         self.rejected += 1
+         logger.warning ('Redundancy message from uid ' + str(uid) + ' dropped, only uid ' + str(os.getuid()) + ' is accepted')
+         return None
+      return json.loads(data)
+
+   def probe(self, timeout):
+      # before any thread starts: stay standby if the peer is already sending
+      if not self.send({'type': 'hello'}):
+         return
+      self.sock.settimeout(timeout)
+      try:
+         message = self.__receive()
+      except (OSError, ValueError):
+         return
+      finally:
+         self.sock.settimeout(None)
+      if message is not None and message.get('type') == 'state' and message['sending']:
+         logger.warning ('Peer bridge (' + message['role'] + ') is sending, starting as standby')
+         self.sending.clear()
+         self.since = None
+         self.pendingHandoff = message['state']
+
+   def start(self):
+      # bridge state exists now, apply what the probe received and listen to the peer
+      if self.pendingHandoff is not None:
+         applyHandoff(self.pendingHandoff)
+         self.pendingHandoff = None
+      threading.Thread(target=self.__receiver, daemon=True).start()
+
+   def peerFrame(self, now):
+      self.lastPeerFrame = now
+
+   def check(self, now):
+      # standby takes over after takeover seconds without the peer's battery frames
+      if self.sending.is_set() or now - self.lastPeerFrame < self.takeover:
+         return
+      self.takeoverSilenceMs = int((now - self.lastPeerFrame) * 1000)
+      self.takeovers += 1
+      self.startSending()
+      logger.warning ('No battery frames from the peer bridge for ' + str(self.takeoverSilenceMs) + 'ms, taking over sending')
+
+   def __receiver(self):
+      while True:
+         try:
+            message = self.__receive()
+            if message is not None:
+               self.__handle(message)
+         except Exception as e:
+            logger.error ('Redundancy message from the peer bridge dropped: ' + str(e))
+
+   def __handle(self, message):
+      if message['type'] == 'hello':
+         self.sendState()
+         return
+      if not message['sending']:
+         return
+      if self.sending.is_set():
+         if self.since < message['since'] or (self.since == message['since'] and self.role == 'active'):
+            return
+         logger.warning ('Peer bridge (' + message['role'] + ') has been sending longer, standing down to standby')
+         self.standDown(monotonic())
+      applyHandoff(message['state'])
+      self.lastHandoff = monotonic()
+      self.handoffsReceived += 1
+
+   def summary(self):
+      summary = {"RedundancyRole": self.role,
+                 "RedundancySending": self.sending.is_set(),
+                 "RedundancyTakeovers": self.takeovers,
+                 "RedundancyHandoffsSent": self.handoffsSent,
+                 "RedundancyHandoffsReceived": self.handoffsReceived,
+                 "RedundancyRejected": self.rejected}
+      if self.takeovers:
+         summary["RedundancyTakeoverSilenceMs"] = self.takeoverSilenceMs
+      if self.lastHandoff is not None:
+         summary["RedundancyHandoffAgeMs"] = int((monotonic() - self.lastHandoff) * 1000)
+      return summary
+
+def handoffState ():
+   # cell balancing and energy state the peer bridge can not rebuild from the buses
+   return {'cellBalancing': InverterOutput.status.cellBalancing.handoffState(),
+           'energy': BMSEnergy.handoffState() if BMSEnergy is not None else None}
+
+def applyHandoff (state):
+   InverterOutput.status.cellBalancing.applyHandoff(state['cellBalancing'])
+   if BMSEnergy is not None and state['energy'] is not None:
+      BMSEnergy.applyHandoff(state['energy'])
+
+def redundancyDirectory ():
+   # shared by both bridges as long as they run as the same user
+   return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.cache'), 'BMS2Inverter')
+
+def createRedundancy ():
+   global Redundancy
+
+   Redundancy = None
+   if RedundancyParam.get('enabled', False):
+      role = RedundancyParam.get('role', 'active')
+      peer = 'standby' if role == 'active' else 'active'
+      Redundancy = GatewayRedundancy(role,
+                                     RedundancyParam.get('socket', os.path.join(redundancyDirectory(), role + '.sock')),
+                                     RedundancyParam.get('peer-socket', os.path.join(redundancyDirectory(), peer + '.sock')),
+                                     RedundancyParam.get('takeover-ms', 2500) / 1000)
+      Redundancy.probe(0.3)
+      logger.info ('Redundancy: configured ' + Redundancy.role + ', starting ' +
+                   ('active' if Redundancy.sending.is_set() else 'standby'))
+
+#endregion
+
+#region ************** Configuration **************
+'''
+--------------------------------------
+Configuration
+--------------------------------------
+'''
+
+ConfigFileName = "config/BMS2Inverter.yaml"
+
+'''
+Schema for config/BMS2Inverter.yaml
+
+section -> key -> (type(s), required, allowed values)
+'''
+ConfigSchema = {
+   'BMS': {
+      'port': (str, True, None),
+      'portrate': (int, True, None),
+      'interface': (str, False, None),
+      'lowVoltageWarning': ((int, float), True, None),
+      'readtimeout': (int, True, None),
+      'inputProtocol': (str, False, tuple(BMSProtocols)),
+   },
+   'inverter': {
+      'port': (str, True, None),
+      'portrate': (int, True, None),
+      'interface': (str, False, None),
+      'outputProtocol': (str, True, RuntimeSettings.outputProtocols),
+      'timing-tolerance-ms': (int, False, None),
+      'forward-ids': (list, False, None),
+      'cadence-ms': (dict, False, None),
+      'cut-through': (bool, False, None),
+      'cut-through-min-interval-ms': (int, False, None),
+   },
+   'cellbalancing': {
+      'interval-days': (int, True, None),
+      'hold-soc': (int, True, None),
+      'minutes': (int, True, None),
+   },
+   'mqtt': {
+      'host': (str, True, None),
+      'port': (int, True, None),
+      'qos': (int, False, (0, 1, 2)),
+      'queue-size': (int, False, None),
+      'queue-mode': (str, False, ('coalesce', 'drop-oldest')),
+      'inflight': (int, False, None),
+      'reconnect-min-delay': (int, False, None),
+      'reconnect-max-delay': (int, False, None),
+      'ack-timeout': (int, False, None),
+      'command-topic': (str, False, None),
+   },
+   'logging': {
+      'loglevel': (str, True, ('info', 'warning', 'debug')),
+      'logfile': (str, True, None),
+   },
+   'signalconditioning': {
+      'voltage': (dict, False, None),
+      'current': (dict, False, None),
+      'temperature': (dict, False, None),
+      'soc': (dict, False, None),
+   },
+   'rs485': {
+      'enabled': (bool, False, None),
+      'port': (str, False, None),
+      'baudrate': (int, False, (1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200)),
+      'cells': (int, False, None),
+   },
+   'service': {
+      'startup-budget-ms': (int, False, None),
+   },
+   'cansupervisor': {
+      'restart-grace-ms': (int, False, None),
+      'min-reopen-interval': ((int, float), False, None),
+      'max-reopen-interval': ((int, float), False, None),
+   },
+   'capture': {
+      'enabled': (bool, False, None),
+      'frames': (int, False, None),
+      'directory': (str, False, None),
+      'min-interval': ((int, float), False, None),
+   },
+   'dashboard': {
+      'enabled': (bool, False, None),
+      'host': (str, False, None),
+      'port': (int, False, None),
+      'interval': ((int, float), False, None),
+      'max-clients': (int, False, None),
+   },
+   'alarmevents': {
+      'history': (int, False, None),
+      'command': ((str, list), False, None),
+      'webhook': (str, False, None),
+      'file': (str, False, None),
+      'timeout': ((int, float), False, None),
+   },
+   'sharedstate': {
+      'enabled': (bool, False, None),
+      'path': (str, False, None),
+   },
+   'redundancy': {
+      'enabled': (bool, False, None),
+      'role': (str, False, ('active', 'standby')),
+      'socket': (str, False, None),
+      'peer-socket': (str, False, None),
+      'takeover-ms': (int, False, None),
+   },
+   'energy': {
+      'enabled': (bool, False, None),
+      'file': (str, False, None),
+      'checkpoint-interval': ((int, float), False, None),
+      'hours': (int, False, None),
+      'days': (int, False, None),
+      'interval': ((int, float), False, None),
+   },
+   'modules': {
+      'enabled': (bool, False, None),
+      'interval': ((int, float), False, None),
+   },
+   'socestimator': {
+      'enabled': (bool, False, None),
+      'max-gap-seconds': ((int, float), False, None),
+      'current-alpha': ((int, float), False, None),
+   },
+}
+
+def validateConfig (config):
+   # raises ValueError listing every problem found
+   problems = []
+   if not isinstance(config, dict):
+      raise ValueError('config file is not a YAML mapping')
+   for sectionName, schema in ConfigSchema.items():
+      section = config.get(sectionName) or {}
+      if not isinstance(section, dict):
+         problems.append(sectionName + ' must be a mapping')
+         continue
+      for key, (valueType, required, allowed) in schema.items():
+         if section.get(key) is None:
+            if required:
+               problems.append(sectionName + '.' + key + ' is required')
+            continue
+         value = section[key]
+         if not isinstance(value, valueType) or (isinstance(value, bool) and valueType is not bool):
+            problems.append(sectionName + '.' + key + ' has an invalid type')
+         elif allowed is not None and value not in allowed:
+            problems.append(sectionName + '.' + key + ' must be one of ' + ', '.join(str(a) for a in allowed))
+   cadence = (config.get('inverter') or {}).get('cadence-ms') or {}
+   if isinstance(cadence, dict):
+      for frameId, period in cadence.items():
+         if not isinstance(frameId, int) or not isinstance(period, (int, float)) or isinstance(period, bool) or period <= 0:
+            problems.append('inverter.cadence-ms entries must map a frame id to a positive number of ms')
+            break
+   if not problems:
+      try:
+         RuntimeSettings(0, 0, 0, 0, 'pylontech').update(runtimeSettingsFromConfig(config))
+      except ValueError as e:
+         problems.append(str(e))
+   if problems:
+      raise ValueError('; '.join(problems))
+
+def readConfig (fileName):
+   with open (fileName) as f:
+      config = yaml.load(f, Loader=yaml.FullLoader)
+   validateConfig(config)
+   return config
+
+def runtimeSettingsFromConfig (config):
+   return {
+      'hold-soc': config['cellbalancing']['hold-soc'],
+      'interval-days': config['cellbalancing']['interval-days'],
+      'minutes': config['cellbalancing']['minutes'],
+      'lowVoltageWarning': config['BMS']['lowVoltageWarning'],
+      'outputProtocol': config['inverter']['outputProtocol'],
+   }
+
+def setConfigParams (config):
+   global BMSCANPortParam
+   global BMSCANPortRateParam
+   global BMSCANInterfaceParam
+   global BMSReadTimeoutParam
+   global BMSInputProtocolParam
+   global InverterCANPortParam
+   global InverterCANPortRateParam
+   global InverterCANInterfaceParam
+   global InverterTimingToleranceParam
+   global InverterForwardIdsParam
+   global InverterCadenceParam
+   global InverterCutThroughParam
+   global InverterCutThroughMinIntervalParam
+   global InverterOutputProtocolParam
+   global LogLevelParam
+   global LogFileParam
+   global CellBalancingIntervalParam
+   global CellBalancingHoldSOCParam
+   global CellBalancingMinutesParam
+   global LowVoltageWarningParam
+   global SignalConditioningParam
+   global SOCEstimatorParam
+   global ModulesParam
+   global EnergyParam
+   global SharedStateParam
+   global AlarmEventsParam
+   global RedundancyParam
+   global MQTTPortParam
+   global MQTTHostParam
+   global MQTTQoSParam
+   global MQTTQueueSizeParam
+   global MQTTQueueModeParam
+   global MQTTInflightParam
+   global MQTTAckTimeoutParam
+   global MQTTReconnectMinDelayParam
+   global MQTTReconnectMaxDelayParam
+   global MQTTCommandTopicParam
+   global RS485Param
+   global DashboardParam
+   global CaptureParam
+   global CANSupervisorParam
+   global StartupBudgetParam
+
+   BMSCANPortParam = config["BMS"]["port"]
+   BMSCANPortRateParam = config["BMS"]["portrate"]
+   BMSCANInterfaceParam = config["BMS"].get("interface", "socketcan")
+   BMSReadTimeoutParam = config['BMS']['readtimeout']
+   BMSInputProtocolParam = config['BMS'].get('inputProtocol', 'discover')
+   InverterCANPortParam = config["inverter"]["port"]
+   InverterCANPortRateParam = config["inverter"]["portrate"]
+   InverterCANInterfaceParam = config["inverter"].get("interface", "socketcan")
+   InverterTimingToleranceParam = config["inverter"].get("timing-tolerance-ms", 250) / 1000
+   InverterForwardIdsParam = frozenset(config["inverter"].get("forward-ids") or [0x305])
+   InverterCutThroughParam = config["inverter"].get("cut-through", False)
+   InverterCutThroughMinIntervalParam = config["inverter"].get("cut-through-min-interval-ms", 100) / 1000
+   # frame id -> seconds, the writer rebuilds its frame plan when this is a new dict
+   InverterCadenceParam = {int(frameId): period / 1000 for frameId, period in (config["inverter"].get("cadence-ms") or {}).items()}
+   InverterOutputProtocolParam = config["inverter"]["outputProtocol"]
+   LogLevelParam = config["logging"]["loglevel"]
+   LogFileParam = config["logging"]["logfile"]
+   CellBalancingIntervalParam = config['cellbalancing']['interval-days']
+   CellBalancingHoldSOCParam = config['cellbalancing']['hold-soc']
+   CellBalancingMinutesParam = config['cellbalancing']['minutes']
+   LowVoltageWarningParam = config['BMS']['lowVoltageWarning']
+   SignalConditioningParam = config.get('signalconditioning') or {}
+   SOCEstimatorParam = config.get('socestimator') or {}
+   ModulesParam = config.get('modules') or {}
+   EnergyParam = config.get('energy') or {}
+   SharedStateParam = config.get('sharedstate') or {}
+   AlarmEventsParam = config.get('alarmevents') or {}
+   RedundancyParam = config.get('redundancy') or {}
+   MQTTHostParam = config['mqtt']['host']
+   MQTTPortParam = config['mqtt']['port']
+   MQTTQoSParam = config['mqtt'].get('qos', 2)
+   MQTTQueueSizeParam = config['mqtt'].get('queue-size', 100)
+   MQTTQueueModeParam = config['mqtt'].get('queue-mode', 'coalesce')
+   MQTTInflightParam = config['mqtt'].get('inflight', 10)
+   MQTTAckTimeoutParam = config['mqtt'].get('ack-timeout', 30)
+   MQTTReconnectMinDelayParam = config['mqtt'].get('reconnect-min-delay', 1)
+   MQTTReconnectMaxDelayParam = config['mqtt'].get('reconnect-max-delay', 120)
+   MQTTCommandTopicParam = config['mqtt'].get('command-topic', 'DiscoverStorage/command')
+   RS485Param = config.get('rs485') or {}
+   DashboardParam = config.get('dashboard') or {}
+   CaptureParam = config.get('capture') or {}
+   CANSupervisorParam = config.get('cansupervisor') or {}
+   StartupBudgetParam = (config.get('service') or {}).get('startup-budget-ms', 3000)
+
+def setLogLevel (logLevel):
+   if logLevel == 'info':
+      logger.setLevel(logging.INFO)
+   elif logLevel == 'warning':
+      logger.setLevel(logging.WARNING)
+   elif logLevel == 'debug':
+      logger.setLevel(logging.DEBUG)
+
+'''
+Config file hot reload
+
+Polled from the main loop (a stat() per second).  A changed file is
+validated in full before anything is applied, then only the changed parts
+are applied: log level, MQTT broker, cell balancing / runtime settings,
+signal conditioning, SOC estimator, and a CAN port is only reopened when its
+port or bitrate changed.  The other port keeps streaming throughout.
+'''
+class ConfigWatcher ():
+
+   def __init__(self, fileName, config):
+      self.fileName = fileName
+      self.config = config
+      self.__mtime = self.__modifiedTime()
+
+   def __modifiedTime(self):
+      try:
+         return os.stat(self.fileName).st_mtime_ns
+      except OSError:
+         return None
+
+   def poll(self):
+      mtime = self.__modifiedTime()
+      if mtime is None or mtime == self.__mtime:
+         return False
+      self.__mtime = mtime
+      startTime = monotonic()
+      try:
+         config = readConfig(self.fileName)
+      except (OSError, yaml.YAMLError, ValueError) as e:
+         metrics.ConfigReloadErrors += 1
+         logger.error ('Config reload rejected, keeping current config: ' + str(e))
+         return False
+      self.__apply(self.config, config)
+      self.config = config
+      metrics.ConfigReloads += 1
+      metrics.ConfigReloadLatencyMs = int((monotonic() - startTime) * 1000)
+      logger.info ('Config reloaded from ' + self.fileName + ' in ' + str(metrics.ConfigReloadLatencyMs) + 'ms')
+      return True
+
+   def __apply(self, old, new):
+      global BMSSignalConditioner
+      global BMSSOCEstimator
+      global InverterCadenceParam
+
+      def changed(section, *keys):
+         oldSection = old.get(section) or {}
+         newSection = new.get(section) or {}
+         if not keys:
+            return oldSection != newSection
+         return any(oldSection.get(key) != newSection.get(key) for key in keys)
+
+      cadence = InverterCadenceParam
+      setConfigParams(new)
+      if not changed('inverter', 'cadence-ms'):
+         #same dict kept so the writer does not rebuild its frame plan
+         InverterCadenceParam = cadence
+
+      if changed('logging', 'loglevel'):
+         setLogLevel(LogLevelParam)
+         logger.info ('Log level changed to ' + LogLevelParam)
+      if changed('logging', 'logfile'):
+         logger.warning ('logging.logfile change requires a restart')
+
+      runtimeChanges = runtimeSettingsFromConfig(new)
+      if runtimeChanges != runtimeSettingsFromConfig(old):
+         updateSettings(runtimeChanges)
+
+      if changed('signalconditioning'):
+         #the effective warning, set over MQTT or queued for the writer's next swap, not the config file's
+         with SettingsLock:
+            lowVoltageWarning = (PendingSettings or CurrentSettings).lowVoltageWarning
+         BMSSignalConditioner = SignalConditioner(SignalConditioningParam, lowVoltageWarning)
+         logger.info ('Signal conditioning rebuilt')
+      if changed('inverter', 'timing-tolerance-ms'):
+         InverterTiming.tolerance = InverterTimingToleranceParam
+      if changed('inverter', 'cut-through', 'cut-through-min-interval-ms'):
+         InverterRelay.enabled = InverterCutThroughParam
+         InverterRelay.minInterval = InverterCutThroughMinIntervalParam
+         logger.info ('Inverter cut-through ' + ('enabled' if InverterCutThroughParam else 'disabled'))
+      if changed('socestimator'):
+         BMSSOCEstimator = createSOCEstimator()
+         logger.info ('SOC estimator rebuilt')
+
+      if changed('rs485') or changed('dashboard') or changed('capture') or changed('cansupervisor') or changed('modules', 'enabled') or changed('energy', 'enabled', 'file', 'checkpoint-interval', 'hours', 'days') or changed('sharedstate') or changed('alarmevents') or changed('redundancy'):
+         logger.warning ('rs485, dashboard, capture, cansupervisor, modules.enabled, energy, sharedstate, alarmevents and redundancy changes require a restart')
+      if changed('BMS', 'inputProtocol'):
+         logger.warning ('BMS.inputProtocol change requires a restart')
+      if changed('mqtt', 'host', 'port'):
+         MQTTClient.reconnect(MQTTHostParam, MQTTPortParam)
+      if changed('mqtt', 'qos', 'queue-size', 'queue-mode', 'inflight', 'ack-timeout', 'reconnect-min-delay', 'reconnect-max-delay', 'command-topic'):
+         logger.warning ('mqtt queue, backoff and command-topic changes require a restart')
+
+      if changed('BMS', 'port', 'portrate', 'interface'):
+         logger.info ('BMS port changed to ' + BMSCANPortParam + ' at ' + str(BMSCANPortRateParam) + ', reopening')
+         restartBMSPort()
+      if changed('inverter', 'port', 'portrate', 'interface'):
+         logger.info ('Inverter port changed to ' + InverterCANPortParam + ' at ' + str(InverterCANPortRateParam) + ', reopening')
+         restartInverterPort()
+
+#endregion
+
+#region ************** Service **************
+'''
+--------------------------------------
+systemd service integration
+--------------------------------------
+
+With Type=notify the service is only reported started (READY=1) once both
+CAN ports are open and the first BMS frame has been read, and WatchdogSec
+pings (WATCHDOG=1) are only sent while the BMS reader and the inverter
+writer are actually making progress, so systemd restarts a wedged bridge.
+Nothing is sent when not started by systemd (no NOTIFY_SOCKET).
+
+Startup phases are measured from process start against a time budget.
+'''
+
+class ServiceNotifier ():
+
+   def __init__(self):
+      self.address = os.environ.get('NOTIFY_SOCKET')
+      if self.address and self.address.startswith('@'):
+         self.address = '\0' + self.address[1:]       #abstract namespace socket
+      watchdogUsec = os.environ.get('WATCHDOG_USEC')
+      self.watchdogInterval = int(watchdogUsec) / 1000000 if watchdogUsec else None
+      self.lastPing = 0.0
+
+   def notify(self, state):
+      if not self.address:
+         return
+      try:
+         with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), self.address)
+      except OSError as e:
+         logger.warning ('sd_notify ' + state + ' failed: ' + str(e))
+
+   def ready(self, status):
+      self.notify('READY=1\nSTATUS=' + status)
+
+   def status(self, status):
+      self.notify('STATUS=' + status)
+
+   def watchdog(self, healthy, now):
+      # pings at half the watchdog interval, withheld while unhealthy
+      if self.watchdogInterval is None or not healthy or now - self.lastPing < self.watchdogInterval / 2:
+         return
+      self.notify('WATCHDOG=1')
+      self.lastPing = now
+
+def bridgeHealthy ():
+   # readBMS and writeInverter both recently made progress, a standby only reads
+   if metrics.millisecondsAgo(metrics.lastBMSRead) > BMSReadTimeoutParam:
+      return False
+   if Redundancy is not None and not Redundancy.sending.is_set():
+      return True
+   return metrics.millisecondsAgo(metrics.lastInverterWrite) <= max(3000, InverterOutput.frequency * 3000)
+
+def awaitFirstFrames (timeout, sending=True):
+   # startup phases in ms from process start, until the first BMS frame has been
+   # read and the first inverter frame sent (when sending), or timeout seconds
+   phases = {'ports': int((monotonic() - StartTime) * 1000)}
+   deadline = monotonic() + timeout
+   while monotonic() < deadline and len(phases) < (3 if sending else 2):
+      if 'firstBMSFrame' not in phases and metrics.BMSBytesRead > 0:
+         phases['firstBMSFrame'] = int((monotonic() - StartTime) * 1000)
+      if 'firstInverterFrame' not in phases and InverterTiming.lastSent:
+         phases['firstInverterFrame'] = int((monotonic() - StartTime) * 1000)
+      sleep(0.01)
+   return phases
+
+#endregion
+
 #region ************** main **************
 
-def startThreads ():
-   global runEvent
+def startBMSReader ():
+   global BMSCANPort
+   global BMSRunEvent
    global readBMSThread
-   global MQTTWriterThread
+
+   BMSCANPort = openCANPort (BMSCANPortParam,BMSCANPortRateParam,BMSCANInterfaceParam) 
+   BMSRunEvent = threading.Event()
+   BMSRunEvent.set()
+   readBMSThread = threading.Thread(target = readBMS, args=[BMSRunEvent,BMSCANPort])
+   readBMSThread.start()
+
+def stopBMSReader ():
+   BMSRunEvent.clear()
+   readBMSThread.join()
+   BMSCANPort.shutdown()
+
+def startInverterWriter ():
+   global InverterCANPort
+   global InverterRunEvent
    global writeInverterThread
+
+   InverterCANPort = openCANPort (InverterCANPortParam, InverterCANPortRateParam, InverterCANInterfaceParam)
+   InverterRunEvent = threading.Event()
+   InverterRunEvent.set()
+   writeInverterThread = threading.Thread(target = writeInverter, args=[InverterRunEvent,InverterCANPort])
+   writeInverterThread.start ()
+
+def stopInverterWriter ():
+   InverterRunEvent.clear()
+   writeInverterThread.join()
+   InverterCANPort.shutdown()
+
+def startHeartbeat ():
+   global HeartbeatRunEvent
    global inverterHeartbeatThread
+
+   HeartbeatRunEvent = threading.Event()
+   HeartbeatRunEvent.set()
+   inverterHeartbeatThread = threading.Thread(target=inverterHeartbeat, args=[HeartbeatRunEvent,InverterCANPort, BMSCANPort])
+   inverterHeartbeatThread.start ()
+
+def stopHeartbeat ():
+   HeartbeatRunEvent.clear()
+   inverterHeartbeatThread.join()
+
+def restartBMSPort ():
+   # the inverter writer keeps sending the last decoded BMS state meanwhile
+   stopHeartbeat()
+   stopBMSReader()
+   startBMSReader()
+   startHeartbeat()
+
+def restartInverterPort ():
+   stopHeartbeat()
+   stopInverterWriter()
+   startInverterWriter()
+   startHeartbeat()
+
+def startThreads ():
+   global runEvent
+   global MQTTWriterThread
    global infoMessageThread
-   global BMSCANPort
-   global InverterCANPort
+   global RS485Thread
 
    logger.info ('Starting program threads...')
-   BMSCANPort = openCANPort (BMSCANPortParam,BMSCANPortRateParam) 
-   InverterCANPort = openCANPort (InverterCANPortParam, InverterCANPortRateParam)
+   createBMSState()
+   createInverterState()
 
    runEvent = threading.Event()
    runEvent.set()
 
    #start continuous BMS Reader
-   readBMSThread = threading.Thread(target = readBMS, args=[runEvent,BMSCANPort])
-   readBMSThread.start()
+   startBMSReader()
 
    #start continuous timed MQTT Writer
    MQTTWriterThread = threading.Thread(target = MQTTWriter, args=[runEvent,5])
    MQTTWriterThread.start()
 
    #write to Inverter
-   writeInverterThread = threading.Thread(target = writeInverter, args=[runEvent,InverterCANPort,1])
-   writeInverterThread.start ()
+   startInverterWriter()
 
    #inverter heartbeat
-   inverterHeartbeatThread = threading.Thread(target=inverterHeartbeat, args=[runEvent,InverterCANPort, BMSCANPort])
-   inverterHeartbeatThread.start ()
+   startHeartbeat()
+
+   #optional RS485 Pylontech console output
+   if RS485Param.get('enabled', False):
+      RS485Thread = threading.Thread(target = writeInverterRS485, args=[runEvent,
+                                                                       RS485Param.get('port', '/dev/ttyUSB0'),
+                                                                       RS485Param.get('baudrate', 9600),
+                                                                       RS485Param.get('cells', 15)])
+      RS485Thread.start()
+   else:
+      RS485Thread = None
 
    #Periodic info messages
-   sleep (1)
    infoMessageThread = threading.Thread(target=infoMessage, args=[runEvent,10])
    infoMessageThread.start ()
 
 def stopThreads():
    logger.info ('Stopping program threads...')
    runEvent.clear()
-   readBMSThread.join()
+   stopHeartbeat()
+   stopBMSReader()
    MQTTWriterThread.join()
-   writeInverterThread.join()
+   stopInverterWriter()
+   if RS485Thread is not None:
+      RS485Thread.join()
    infoMessageThread.join()
-   inverterHeartbeatThread.join()
-      
-   BMSCANPort.shutdown()
-   InverterCANPort.shutdown()
+
+def requestShutdown():
+   # stops main() from another thread, e.g. the simulator or a signal handler
+   ShutdownEvent.set()
 
 def watchDog():
    if metrics.millisecondsAgo(metrics.lastBMSRead) > BMSReadTimeoutParam:
@@ -1149,25 +4550,26 @@ def watchDog():
    else:
       return True
    
-def main():
-   global BMSCANPortParam
-   global BMSCANPortRateParam
-   global BMSReadTimeoutParam
-   global InverterCANPortParam
-   global InverterCANPortRateParam
-   global InverterOutputProtocolParam
-   global LogLevelParam
-   global CellBalancingIntervalParam
-   global CellBalancingHoldSOCParam
-   global CellBalancingMinutesParam
-   global LowVoltageWarningParam
-   global MQTTPortParam
-   global MQTTHostParam
+def main(config):
+   global CurrentSettings
+   global PendingSettings
+   global SettingsLock
    global metrics
 
    global MQTTClient
+   global ShutdownEvent
+   global BMSEnergy
 
    metrics = BMStoInverterMetrics ()
+   ShutdownEvent = threading.Event()
+
+   CurrentSettings = RuntimeSettings(CellBalancingHoldSOCParam,
+                                     CellBalancingIntervalParam,
+                                     CellBalancingMinutesParam,
+                                     LowVoltageWarningParam,
+                                     InverterOutputProtocolParam)
+   PendingSettings = None
+   SettingsLock = threading.Lock()
 
    #start logger
    logFormat = '%(asctime)s %(message)s'
@@ -1175,31 +4577,85 @@ def main():
    logger = logging.getLogger()
    logger.setLevel(logging.DEBUG)
 
-   MQTTClient = MQTTConnect(MQTTHostParam, MQTTPortParam)
+   #CAN first, MQTT connects while the first frames are awaited, the dashboard
+   #only once the inverter is being fed
+   MQTTClient = None
+   service = ServiceNotifier()
+
+   createCANCapture()
+   createCANSupervisors()
+   createStateExport()
+   createRedundancy()
+   #once, the watchdog restarts rebuild the decoded BMS state but the totals, the alarm
+   #history and mask, and the notifier thread carry on
+   BMSEnergy = createEnergyAccumulator()
+   createAlarmEvents()
+   #kill -USR1 dumps the capture ring on demand, signals can only be set up from the main thread
+   if threading.current_thread() is threading.main_thread():
+      signal.signal(signal.SIGUSR1, lambda signalNumber, frame: dumpCANCapture('signal', True))
 
    startThreads()
+   if Redundancy is not None:
+      Redundancy.start()
+   threading.Thread(target=superviseCANBuses, daemon=True).start()
+   sending = Redundancy is None or Redundancy.sending.is_set()
+   #in parallel, a BMS that is slow to appear does not hold MQTT (and its alarms) back
+   mqttStart = threading.Thread(target=startMQTT, daemon=True)
+   mqttStart.start()
+   startupPhases = awaitFirstFrames(BMSReadTimeoutParam / 1000, sending)
+   mqttStart.join()
+
+   if DashboardParam.get('enabled', False):
+      startDashboard(DashboardParam.get('host', '127.0.0.1'),
+                     DashboardParam.get('port', 8080),
+                     DashboardParam.get('interval', 1),
+                     DashboardParam.get('max-clients', 8))
+
+   startupPhases['ready'] = int((monotonic() - StartTime) * 1000)
+   metrics.StartupMs = startupPhases['ready']
+   startupReport = ', '.join(phase + ' ' + str(ms) + 'ms' for phase, ms in startupPhases.items())
+   if 'firstBMSFrame' in startupPhases and (not sending or startupPhases.get('firstInverterFrame', math.inf) <= StartupBudgetParam):
+      logger.info ('Startup: ' + startupReport)
+   else:
+      logger.warning ('Startup over the ' + str(StartupBudgetParam) + 'ms budget: ' + startupReport)
+   service.ready('BMS ' + BMSCANPortParam + ', inverter ' + InverterCANPortParam + (', standby' if not sending else '') +
+                 ', ready in ' + str(startupPhases['ready']) + 'ms')
 
+   configWatcher = ConfigWatcher(ConfigFileName, config)
 
    try:
       #main loop with watchdog
-      while True:
-        sleep(1)
-        #if watchdog failure, stop and restart CAN port and threads
-        if watchDog() == False:
-           logger.warning ('Watchdog determined excessive read times on BMS, restarting...')
-           stopThreads()
-           startThreads()
+      while not ShutdownEvent.wait(1):
+        with PortLock:
+           #if watchdog failure, stop and restart CAN port and threads
+           if watchDog() == False:
+              logger.warning ('Watchdog determined excessive read times on BMS, restarting...')
+              dumpCANCapture('watchdog')
+              stopThreads()
+              startThreads()
+           #apply config file changes
+           configWatcher.poll()
+        #the standby's totals are the active bridge's, only the sending bridge writes the file
+        if BMSEnergy is not None and (Redundancy is None or Redundancy.sending.is_set()):
+           BMSEnergy.checkpoint(monotonic())
+        if Redundancy is not None and Redundancy.sending.is_set():
+           Redundancy.sendState()
+        service.watchdog(bridgeHealthy(), monotonic())
    except KeyboardInterrupt:
       logger.info('Keyboard Interrupt Received')
    finally:
+      service.notify('STOPPING=1')
       stopThreads()
+      if BMSEnergy is not None and (Redundancy is None or Redundancy.sending.is_set()):
+         BMSEnergy.checkpoint(monotonic(), force=True)
+      if MQTTClient is not None:
+         MQTTClient.stop()
       
 
 
 #application entry point:
 if __name__ == "__main__":
-   with open ("config/BMS2Inverter.yaml") as f:
-      config = yaml.load(f, Loader=yaml.FullLoader)
+   config = readConfig(ConfigFileName)
 
     
    #parser = argparse.ArgumentParser()
@@ -1210,32 +4666,14 @@ if __name__ == "__main__":
    #parser.add_argument("-l", "--loglevel", default = "info", choices=["info", "warning", "debug"], help="log level: info, warning, debug")
    #args = parser.parse_args()
 
-   BMSCANPortParam = config["BMS"]["port"]
-   BMSCANPortRateParam = config["BMS"]["portrate"]
-   BMSReadTimeoutParam = config['BMS']['readtimeout']
-   InverterCANPortParam = config["inverter"]["port"]
-   InverterCANPortRateParam = config["inverter"]["portrate"]
-   InverterOutputProtocolParam = config["inverter"]["outputProtocol"]
-   LogLevelParam = config["logging"]["loglevel"]
-   LogFileParam = config["logging"]["logfile"]
-   CellBalancingIntervalParam = config['cellbalancing']['interval-days']
-   CellBalancingHoldSOCParam = config['cellbalancing']['hold-soc']
-   CellBalancingMinutesParam = config['cellbalancing']['minutes']
-   LowVoltageWarningParam = config['BMS']['lowVoltageWarning']
-   MQTTHostParam = config['mqtt']['host']
-   MQTTPortParam = config['mqtt']['port']
+   setConfigParams(config)
     
    #start logger
    logFormat = '%(asctime)s %(levelname)s %(message)s'
    formatter = logging.Formatter(logFormat)
    logging.basicConfig(format=logFormat)
    logger = logging.getLogger(__name__)
-   if LogLevelParam == 'info':
-      logger.setLevel(logging.INFO)
-   elif LogLevelParam == 'warning':
-      logger.setLevel(logging.WARNING)
-   elif LogLevelParam == 'debug':
-      logger.setLevel(logging.DEBUG)
+   setLogLevel(LogLevelParam)
 
    #start logger for CAN module
    logger2 = logging.getLogger('can')
@@ -1253,5 +4691,5 @@ if __name__ == "__main__":
    logger.info("Log Level: " + LogLevelParam)
    logger.info("Current working directory:" + os.getcwd())
 
-   main()                  # call the main function:
-#endregion
\ No newline at end of file
+   main(config)                  # call the main function:
+#endregion
@@ -0,0 +1,492 @@
+#!
+
+'''
+Service: BMSSimulator.py
+
+Purpose:
+    Load and regression testing of the bridge without batteries
+    1) Emulates Discover Lynk II gateways sending 0x351-0x373 and the per
+       module 0x3C0/0x3D0 frames at the real 1s / 10s cadences from a battery
+       model (SOC curve, current profile, temperature, alarm injection)
+    2) Emulates inverters that send heartbeats and check the timing of the
+       frames the bridge sends them
+    3) Optionally runs BMS2Inverter in the same process on python-can virtual
+       buses (--bridge), otherwise drives real or vcan interfaces for a bridge
+       started separately
+    4) With --failover runs an active and a standby bridge as separate
+       processes (redundancy in BMS2Inverter.yaml), kills the active one and
+       reports the longest time the inverters went without battery frames.
+       Processes need buses that cross them: udp_multicast (an IPv4 group for
+       the BMS bus and an IPv6 group for the inverter bus, two groups of one
+       family on the same port would see each other's frames) or vcan.
+Feature Details:
+    Every bank and inverter is driven from one scheduler thread and one
+    receive thread per bus, so hundreds of emulated banks fit in one process.
+    Banks share the BMS bus, raising banks or speed multiplies the frame rate
+    offered to the bridge until it can no longer keep up.
+
+Example:
+    python BMSSimulator.py --bridge --banks 20 --speed 10 --duration 60
+    python BMSSimulator.py --failover 20 --duration 40
+'''
+
+import argparse
+import heapq
+import logging
+import math
+import os
+import random
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import can
+import yaml
+from time import monotonic
+
+import BMS2Inverter
+from BMS2Inverter import (BMSDiscoverSCBatteryLimits, BMSDiscoverSCBatteryCapacity,
+                          BMSDiscoverSCBatteryStatus, BMSDiscoverSCBatteryMeasurements,
+                          BMSDiscoverSCBatteryAlarms, BMSDiscoverModuleCells, BMSDiscoverModuleTemperatures,
+                          BMSDiscoverModuleTelemetry, Alarm, InverterProtocols)
+
+SimulatorConfigFileName = 'config/BMSSimulator.yaml'
+
+logger = logging.getLogger('BMSSimulator')
+
+
+#region ********** Battery Model **********
+'''
+--------------------------------------
+Battery Model
+--------------------------------------
+
+SOC is integrated from a repeating current profile (positive charges),
+voltage follows an open circuit voltage curve plus an IR drop.  Alarms are
+injected for a window of model time.
+'''
+
+class BatteryModel ():
+   # open circuit voltage of a 48V LiFePO4 bank by SOC
+   ocv = ((0, 44.0), (5, 48.0), (10, 49.6), (20, 50.8), (50, 51.8), (80, 52.8), (95, 53.6), (100, 55.2))
+
+   def __init__(self, config, seed=0):
+      self.random = random.Random(seed)
+      self.capacity = config.get('capacity', 300)
+      self.stateOfCharge = float(config.get('soc', 60))
+      self.baseTemperature = config.get('temperature', 24)
+      self.temperatureNoise = config.get('temperature-noise', 0.2)
+      self.resistance = config.get('resistance', 0.01)
+      self.profile = [tuple(step) for step in config.get('profile', [[3600, 40], [3600, -25]])]
+      self.profileLength = sum(seconds for seconds, _ in self.profile)
+      self.alarms = [self.__alarmPair(alarm) for alarm in config.get('alarms', [])]
+      #per module cell voltage offsets (V) and balancing, 16 cells per module
+      self.moduleOffsets = [self.random.gauss(0, 0.01) for _ in range(config.get('modules', 4))]
+      self.current = 0.0
+      self.voltage = self.__openCircuitVoltage()
+      self.temperature = self.baseTemperature
+      self.modelTime = 0.0
+
+   def __alarmPair(self, alarm):
+      # (pair index, start, end) for an {alarm, protection, start, duration} entry
+      name, protection = Alarm[alarm['alarm']], alarm.get('protection', False)
+      indexes = [index for index, pairAlarm, pairProtection in BMSDiscoverSCBatteryAlarms.pairs
+                 if pairAlarm is name and pairProtection == protection]
+      if not indexes:
+         raise ValueError('alarm ' + alarm['alarm'] + ' is not sent by the Discover protocol')
+      return indexes[-1], alarm.get('start', 0), alarm.get('start', 0) + alarm.get('duration', 60)
+
+   def __openCircuitVoltage(self):
+      for (soc0, voltage0), (soc1, voltage1) in zip(self.ocv, self.ocv[1:]):
+         if self.stateOfCharge <= soc1:
+            return voltage0 + (voltage1 - voltage0) * (self.stateOfCharge - soc0) / (soc1 - soc0)
+      return self.ocv[-1][1]
+
+   def __profileCurrent(self):
+      position = self.modelTime % self.profileLength
+      for seconds, amps in self.profile:
+         if position < seconds:
+            return amps
+         position -= seconds
+      return 0.0
+
+   def step(self, seconds):
+      self.modelTime += seconds
+      current = self.__profileCurrent()
+      #the BMS stops charge at full and discharge at empty
+      if (current > 0 and self.stateOfCharge >= 100) or (current < 0 and self.stateOfCharge <= 0):
+         current = 0.0
+      self.current = current
+      self.stateOfCharge = min(100.0, max(0.0, self.stateOfCharge + current * seconds / 3600 / self.capacity * 100))
+      self.voltage = self.__openCircuitVoltage() + current * self.resistance
+      self.temperature = self.baseTemperature + abs(current) * 0.02 + self.random.gauss(0, self.temperatureNoise)
+
+   def activeAlarmPairs(self):
+      return [index for index, start, end in self.alarms if start <= self.modelTime < end]
+
+#endregion
+
+#region ********** BMS Emulator **********
+'''
+--------------------------------------
+Discover BMS emulator
+--------------------------------------
+
+Frames are packed with the same layouts the bridge decodes them with.
+'''
+
+def encodeLayout(decoderClass, values):
+   return decoderClass.layout.pack(*(int(round(values.get(name, 0) * divisor)) if name else 0
+                                     for name, _, divisor in decoderClass.fields))
+
+def encodeAlarms(pairs):
+   # 2 bits per pair from the high bits of byte 0, 01 alarm, 10 normal
+   buffer = bytearray(b'\xAA' * 7)
+   for index in pairs:
+      shift = 6 - 2 * (index % 4)
+      buffer[index // 4] = (buffer[index // 4] & ~(3 << shift)) | (1 << shift)
+   return bytes(buffer)
+
+class DiscoverBMSEmulator ():
+   fastPeriod = 1         #0x351-0x35A
+   slowPeriod = 10        #0x35E-0x373, 0x3C0, 0x3D0
+
+   def __init__(self, model, limits):
+      self.model = model
+      self.limits = limits
+
+   def fastFrames(self):
+      model = self.model
+      return ((0x351, encodeLayout(BMSDiscoverSCBatteryLimits, self.limits)),
+              (0x354, encodeLayout(BMSDiscoverSCBatteryCapacity, {
+                 'batteryNominalCapacity': model.capacity,
+                 'batteryRemainingCapacity': int(model.capacity * model.stateOfCharge / 100)})),
+              (0x355, encodeLayout(BMSDiscoverSCBatteryStatus, {
+                 'batteryStateOfCharge': int(model.stateOfCharge),
+                 'batteryStateOfHealth': 100})),
+              (0x356, encodeLayout(BMSDiscoverSCBatteryMeasurements, {
+                 'batteryVoltage': model.voltage,
+                 'batteryCurrent': model.current,
+                 'batteryTemperature': model.temperature})),
+              (0x35A, encodeAlarms(model.activeAlarmPairs())))
+
+   def moduleFrames(self):
+      model = self.model
+      frames = []
+      for module, offset in enumerate(model.moduleOffsets):
+         cell = model.voltage / 16 + offset
+         balancing = 0x2004 if offset > 0.01 and model.current > 0 else 0
+         frames.append((BMSDiscoverModuleTelemetry.cellFrames + module, encodeLayout(BMSDiscoverModuleCells, {
+            'minCellVoltage': cell - 0.008, 'maxCellVoltage': cell + 0.008,
+            'minCellNumber': 3, 'maxCellNumber': 14, 'moduleVoltage': cell * 16})))
+         frames.append((BMSDiscoverModuleTelemetry.temperatureFrames + module, encodeLayout(BMSDiscoverModuleTemperatures, {
+            'minTemperature': model.temperature - 1 + module * 0.1, 'maxTemperature': model.temperature + 1 + module * 0.1,
+            'balancingCells': balancing})))
+      return tuple(frames)
+
+   def slowFrames(self):
+      return ((0x35E, b'DISCOVER'),
+              (0x370, bytes(8)),
+              (0x371, bytes(8)),
+              (0x372, bytes([0, 0, 1, 2])),
+              (0x373, bytes([1, 0, 0, 0]))) + self.moduleFrames()
+
+#endregion
+
+#region ********** Inverter Emulator **********
+'''
+--------------------------------------
+Inverter emulator
+--------------------------------------
+
+Sends a heartbeat and checks every frame the output protocol should carry
+arrives each protocol frequency, or its own cadence-ms period.  A frame is
+late when its interval exceeds lateFactor times its period.
+'''
+
+class InverterEmulator ():
+   lateFactor = 1.5
+
+   def __init__(self, protocol, heartbeatId, name, cadence={}):
+      self.name = name
+      self.heartbeatId = heartbeatId
+      self.period = InverterProtocols[protocol].frequency
+      #frame id -> period for frames the bridge sends at their own cadence
+      self.periods = {int(frameId): period / 1000 for frameId, period in cadence.items()}
+      self.expected = {encoder.frame for encoder in InverterProtocols[protocol].encoders}
+      self.lastSeen = {}
+      self.received = 0
+      self.late = 0
+      self.unexpected = 0
+      self.maxInterval = 0.0
+      self.lastFrame = None
+      self.maxSilence = 0.0      #longest time without any expected frame, e.g. across a failover
+      self.stateOfCharge = None
+
+   def heartbeat(self):
+      return self.heartbeatId, bytes(8)
+
+   def receive(self, message, now):
+      frameId = message.arbitration_id
+      if frameId not in self.expected:
+         self.unexpected += 1
+         return
+      self.received += 1
+      if self.lastFrame is not None:
+         self.maxSilence = max(self.maxSilence, now - self.lastFrame)
+      self.lastFrame = now
+      last = self.lastSeen.get(frameId)
+      if last is not None:
+         interval = now - last
+         self.maxInterval = max(self.maxInterval, interval)
+         if interval > self.periods.get(frameId, self.period) * self.lateFactor:
+            self.late += 1
+      self.lastSeen[frameId] = now
+      if frameId == 0x355:
+         self.stateOfCharge = struct.unpack_from('<H', message.data)[0]
+
+   def missing(self, now):
+      # expected frames never seen or not seen for lateFactor periods
+      return sorted(frameId for frameId in self.expected
+                    if now - self.lastSeen.get(frameId, -math.inf) > self.periods.get(frameId, self.period) * self.lateFactor)
+
+#endregion
+
+#region ********** Simulation **********
+'''
+--------------------------------------
+Simulation
+--------------------------------------
+
+One scheduler thread sends every emulated frame on absolute deadlines, one
+thread per bus receives.  speed divides every cadence and multiplies model
+time.
+'''
+
+class Simulation ():
+
+   def __init__(self, config, interface, bmsChannel, inverterChannel, banks, inverters, speed):
+      self.speed = speed
+      self.bmsBus = can.ThreadSafeBus(interface=interface, channel=bmsChannel, bitrate=250000)
+      self.inverterBus = can.ThreadSafeBus(interface=interface, channel=inverterChannel, bitrate=500000)
+      limits = config.get('limits', {'requestedChargeVoltage': 55.9, 'requestedChargeCurrent': 282.0,
+                                     'requestedMaximumDischargeCurrent': 282.0, 'lowBatteryCutOutVoltage': 43.2})
+      self.banks = [DiscoverBMSEmulator(BatteryModel(config.get('battery', {}), seed), limits) for seed in range(banks)]
+      inverterConfig = config.get('inverter', {})
+      self.inverters = [InverterEmulator(inverterConfig.get('protocol', 'UZEnergy'),
+                                         inverterConfig.get('heartbeat-id', 0x305),
+                                         'inverter' + str(i),
+                                         inverterConfig.get('cadence-ms') or {}) for i in range(inverters)]
+      self.heartbeatInterval = inverterConfig.get('heartbeat-interval', 1)
+      self.runEvent = threading.Event()
+      self.schedule = []
+      self.sequence = 0
+      self.framesSent = 0
+      self.sendErrors = 0
+      self.bmsFramesSeen = 0
+      self.startTime = None
+
+   def every(self, period, callback, offset=0.0):
+      heapq.heappush(self.schedule, (monotonic() + offset, self.sequence, period, callback))
+      self.sequence += 1
+
+   def send(self, bus, frames):
+      for frameId, data in frames:
+         try:
+            bus.send(can.Message(arbitration_id=frameId, data=data, is_extended_id=False))
+            self.framesSent += 1
+         except can.CanError:
+            self.sendErrors += 1
+
+   def __bankFast(self, bank):
+      bank.model.step(bank.fastPeriod)
+      self.send(self.bmsBus, bank.fastFrames())
+
+   def __scheduler(self):
+      while self.runEvent.is_set() and self.schedule:
+         due, sequence, period, callback = self.schedule[0]
+         wait = due - monotonic()
+         if wait > 0:
+            self.runEvent.wait(min(wait, 0.5))
+            continue
+         heapq.heapreplace(self.schedule, (due + period, sequence, period, callback))
+         callback()
+
+   def __receiver(self, bus, handler):
+      while self.runEvent.is_set():
+         message = bus.recv(timeout=0.5)
+         if message is not None:
+            handler(message, monotonic())
+
+   def __inverterReceive(self, message, now):
+      for inverter in self.inverters:
+         inverter.receive(message, now)
+
+   def __bmsReceive(self, message, now):
+      #heartbeats forwarded by the bridge
+      self.bmsFramesSeen += 1
+
+   def start(self):
+      self.runEvent.set()
+      self.startTime = monotonic()
+      spread = 1.0 / max(len(self.banks), 1)
+      for i, bank in enumerate(self.banks):
+         #banks are spread over the cadence instead of bursting together
+         self.every(bank.fastPeriod / self.speed, lambda bank=bank: self.__bankFast(bank), i * spread / self.speed)
+         self.every(bank.slowPeriod / self.speed, lambda bank=bank: self.send(self.bmsBus, bank.slowFrames()), i * spread / self.speed)
+      for inverter in self.inverters:
+         self.every(self.heartbeatInterval, lambda inverter=inverter: self.send(self.inverterBus, (inverter.heartbeat(),)))
+      self.threads = [threading.Thread(target=self.__scheduler, daemon=True),
+                      threading.Thread(target=self.__receiver, args=[self.inverterBus, self.__inverterReceive], daemon=True),
+                      threading.Thread(target=self.__receiver, args=[self.bmsBus, self.__bmsReceive], daemon=True)]
+      for thread in self.threads:
+         thread.start()
+
+   def stop(self):
+      self.runEvent.clear()
+      for thread in self.threads:
+         thread.join()
+      self.bmsBus.shutdown()
+      self.inverterBus.shutdown()
+
+   def report(self):
+      now = monotonic()
+      elapsed = now - self.startTime
+      lines = ['offered ' + str(round(self.framesSent / elapsed, 1)) + ' frames/s from ' + str(len(self.banks)) +
+               ' banks (' + str(self.framesSent) + ' sent, ' + str(self.sendErrors) + ' errors), ' +
+               str(self.bmsFramesSeen) + ' heartbeats forwarded to the BMS bus']
+      for inverter in self.inverters:
+         lines.append(inverter.name + ': ' + str(inverter.received) + ' frames, ' + str(inverter.late) + ' late, max interval ' +
+                      str(round(inverter.maxInterval * 1000)) + 'ms, longest silence ' +
+                      str(round(inverter.maxSilence * 1000)) + 'ms, SOC ' + str(inverter.stateOfCharge) +
+                      ', missing ' + (', '.join(hex(frameId) for frameId in inverter.missing(now)) or 'none') +
+                      ', unexpected ' + str(inverter.unexpected))
+      return lines
+
+#endregion
+
+#region ********** main **********
+
+def startBridge (interface, bmsChannel, inverterChannel):
+   # BMS2Inverter in this process, its ports pointed at the simulated buses
+   config = BMS2Inverter.readConfig(BMS2Inverter.ConfigFileName)
+   config['BMS'].update({'interface': interface, 'port': bmsChannel})
+   config['inverter'].update({'interface': interface, 'port': inverterChannel})
+   BMS2Inverter.setConfigParams(config)
+   BMS2Inverter.logger = logging.getLogger('BMS2Inverter')
+   BMS2Inverter.setLogLevel(BMS2Inverter.LogLevelParam)
+   logging.getLogger('can').setLevel(logging.INFO)
+   thread = threading.Thread(target=BMS2Inverter.main, args=[config])
+   thread.start()
+   return thread
+
+def startBridgeProcesses (interface, bmsChannel, inverterChannel, directory=None):
+   # an active and a standby BMS2Inverter as separate processes, each in its own
+   # working directory since config, cellbalance.marker, energy.json and logs are
+   # relative to it, the redundancy sockets go in directory (private, mode 0700)
+   directory = directory or tempfile.mkdtemp(prefix='BMS2Inverter-failover-')
+   processes = {}
+   for role, peer in (('active', 'standby'), ('standby', 'active')):
+      config = BMS2Inverter.readConfig(BMS2Inverter.ConfigFileName)
+      config['BMS'].update({'interface': interface, 'port': bmsChannel})
+      config['inverter'].update({'interface': interface, 'port': inverterChannel})
+      config['redundancy'] = dict(config.get('redundancy') or {}, enabled=True, role=role,
+                                  socket=os.path.join(directory, role + '.sock'),
+                                  **{'peer-socket': os.path.join(directory, peer + '.sock')})
+      config['sharedstate'] = {'enabled': False}
+      config['dashboard'] = {'enabled': False}
+      workingDirectory = os.path.join(directory, role)
+      #energy totals are part of the handoff, kept with each bridge
+      config['energy'] = dict(config.get('energy') or {}, enabled=True, file=os.path.join(workingDirectory, 'energy.json'))
+      os.makedirs(os.path.join(workingDirectory, 'config'))
+      os.makedirs(os.path.join(workingDirectory, os.path.dirname(config['logging']['logfile']) or '.'), exist_ok=True)
+      with open(os.path.join(workingDirectory, BMS2Inverter.ConfigFileName), 'w') as f:
+         yaml.safe_dump(config, f)
+      processes[role] = subprocess.Popen([sys.executable, os.path.abspath(BMS2Inverter.__file__)], cwd=workingDirectory,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   logger.info ('Started active and standby bridges, logs in ' + directory)
+   return processes
+
+def main():
+   parser = argparse.ArgumentParser(description='Discover BMS and inverter simulator for BMS2Inverter')
+   parser.add_argument('-c', '--config', default=SimulatorConfigFileName, help='simulator configuration file')
+   parser.add_argument('--bridge', action='store_true', help='run BMS2Inverter in this process')
+   parser.add_argument('--banks', type=int, help='emulated Lynk II gateways on the BMS bus')
+   parser.add_argument('--inverters', type=int, help='emulated inverters on the inverter bus')
+   parser.add_argument('--speed', type=float, help='cadence and model time multiplier')
+   parser.add_argument('--duration', type=float, help='seconds to run, 0 until interrupted')
+   parser.add_argument('--failover', type=float, metavar='SECONDS',
+                       help='run an active and a standby BMS2Inverter process, kill the active one after SECONDS')
+   args = parser.parse_args()
+
+   with open(args.config) as f:
+      config = yaml.safe_load(f) or {}
+   simulation = config.get('simulation', {})
+   interface = simulation.get('interface', 'virtual')
+   bmsChannel = simulation.get('bms-channel', 'can0')
+   inverterChannel = simulation.get('inverter-channel', 'can1')
+   banks = args.banks or simulation.get('banks', 1)
+   inverters = args.inverters if args.inverters is not None else simulation.get('inverters', 1)
+   speed = args.speed or simulation.get('speed', 1)
+   duration = args.duration if args.duration is not None else simulation.get('duration', 0)
+   reportInterval = simulation.get('report', 10)
+
+   logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+   bridgeThread = None
+   if args.bridge:
+      bridgeThread = startBridge(interface, bmsChannel, inverterChannel)
+   bridgeProcesses = {}
+   if args.failover:
+      if interface == 'virtual':
+         parser.error('--failover runs the bridges as processes, virtual buses do not reach them (use udp_multicast or vcan)')
+      bridgeProcesses = startBridgeProcesses(interface, bmsChannel, inverterChannel)
+
+   sim = Simulation(config, interface, bmsChannel, inverterChannel, banks, inverters, speed)
+   sim.start()
+   logger.info ('Simulating ' + str(banks) + ' banks and ' + str(inverters) + ' inverters at ' + str(speed) + 'x on ' +
+                interface + ' ' + bmsChannel + '/' + inverterChannel)
+   stopEvent = threading.Event()
+   startTime = monotonic()
+   if bridgeProcesses:
+      def killActive():
+         #a crash, the inverters' longest silence is the failover time they see
+         bridgeProcesses['active'].kill()
+         logger.info ('Killed the active bridge')
+      failover = threading.Timer(args.failover, killActive)
+      failover.daemon = True
+      failover.start()
+   try:
+      while not stopEvent.wait(reportInterval):
+         for line in sim.report():
+            logger.info (line)
+         if bridgeThread is not None:
+            metrics = BMS2Inverter.metrics
+            #compare with the offered rate, the bridge is saturated when it falls behind
+            logger.info ('bridge: read ' + str(round(metrics.BMSBytesRead / (monotonic() - startTime))) + ' bytes/s (' +
+                         str(metrics.BMSBytesRead) + ' bytes), wrote ' + str(metrics.InverterBytesWritten) +
+                         ' bytes, last BMS read ' + str(metrics.millisecondsAgo(metrics.lastBMSRead)) + 'ms ago')
+         if duration and monotonic() - startTime >= duration:
+            break
+   except KeyboardInterrupt:
+      pass
+   finally:
+      sim.stop()
+      for line in sim.report():
+         logger.info (line)
+      if bridgeThread is not None:
+         BMS2Inverter.requestShutdown()
+         bridgeThread.join()
+      for process in bridgeProcesses.values():
+         if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+               process.wait(10)
+            except subprocess.TimeoutExpired:
+               process.kill()
+
+if __name__ == "__main__":
+   main()
+#endregion
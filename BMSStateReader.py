@@ -0,0 +1,145 @@
+#!
+
+'''
+Service: BMSStateReader.py
+
+Purpose:
+    Reads the battery state BMS2Inverter exports to shared memory, for
+    processes on the same gateway (EMS controller, logger) that need it
+    without going through the MQTT broker
+    1) StateReader maps the export file once, every read after that is a
+       struct unpack from the mapping, no system call and no broker
+    2) As a script prints the state, or measures read latency (--benchmark)
+Feature Details:
+    The export is a fixed layout: a 16 byte header (magic, layout version,
+    payload size, sequence) followed by the State record.  The writer makes
+    the sequence odd before it updates the record and even again after, a
+    reader retries until it sees the same even sequence before and after its
+    copy (a seqlock), so it never returns a half written record and never
+    blocks the writer.
+
+    alarms / protections are bitmasks, bit n set for the BMS2Inverter Alarm
+    with value n + 1.
+
+    Only the standard library is used, the reader does not need python-can.
+
+Example:
+    python BMSStateReader.py --path /dev/shm/BMS2Inverter.state
+    python BMSStateReader.py --benchmark
+'''
+
+import argparse
+import json
+import math
+import mmap
+import os
+import struct
+from time import sleep, perf_counter
+
+StatePath = '/dev/shm/BMS2Inverter.state'
+Magic = b'BMS2'
+LayoutVersion = 1
+
+# magic, layout version, payload size, sequence (odd while the writer is mid update)
+Header = struct.Struct('<4sHHQ')
+Sequence = struct.Struct('<Q')
+SequenceOffset = 8
+
+# (field, struct code), floats are nan until the bridge has a value
+StateFields = (('updated', 'd'),                   #wall clock time of the last update
+               ('stateOfCharge', 'f'),
+               ('estimatedStateOfCharge', 'f'),
+               ('stateOfHealth', 'f'),
+               ('batteryVoltage', 'f'),
+               ('batteryCurrent', 'f'),
+               ('batteryTemperature', 'f'),
+               ('requestedChargeVoltage', 'f'),
+               ('requestedChargeCurrent', 'f'),
+               ('requestedMaximumDischargeCurrent', 'f'),
+               ('lowBatteryCutOutVoltage', 'f'),
+               ('batteryNominalCapacity', 'f'),
+               ('batteryRemainingCapacity', 'f'),
+               ('inverterFakeoutSOC', 'f'),
+               ('cellSpreadMv', 'f'),
+               ('weakestModule', 'h'),
+               ('isCellBalancingActive', '?'),
+               ('reserved', 'x'),
+               ('alarms', 'Q'),
+               ('protections', 'Q'),
+               ('chargeKWh', 'd'),
+               ('dischargeKWh', 'd'))
+State = struct.Struct('<' + ''.join(code for _, code in StateFields))
+StateNames = tuple(name for name, code in StateFields if code != 'x')
+
+
+class StateReader ():
+
+   def __init__(self, path=StatePath):
+      fd = os.open(path, os.O_RDONLY)
+      try:
+         self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+      finally:
+         os.close(fd)
+      magic, version, size, _ = Header.unpack_from(self.map)
+      if magic != Magic or version != LayoutVersion or size != State.size:
+         self.map.close()
+         raise ValueError(path + ' is not a version ' + str(LayoutVersion) + ' BMS2Inverter state export')
+
+   def sequence(self):
+      # changes on every update, a reader polling for new data compares it
+      return Sequence.unpack_from(self.map, SequenceOffset)[0]
+
+   def read(self, retries=1000):
+      # consistent tuple of the StateNames values
+      for _ in range(retries):
+         before = Sequence.unpack_from(self.map, SequenceOffset)[0]
+         if before & 1:
+            continue
+         values = State.unpack_from(self.map, Header.size)
+         if Sequence.unpack_from(self.map, SequenceOffset)[0] == before:
+            return values
+      raise TimeoutError('state export kept changing for ' + str(retries) + ' reads')
+
+   def readDict(self):
+      return dict(zip(StateNames, self.read()))
+
+   def close(self):
+      self.map.close()
+
+
+def benchmark(reader, seconds):
+   reads = 0
+   start = perf_counter()
+   end = start + seconds
+   while perf_counter() < end:
+      for _ in range(1000):
+         reader.read()
+      reads += 1000
+   elapsed = perf_counter() - start
+   print(str(reads) + ' consistent reads in ' + str(round(elapsed, 2)) + 's, ' +
+         str(round(elapsed / reads * 1e6, 3)) + ' us per read')
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Read the BMS2Inverter shared memory state export')
+   parser.add_argument('--path', default=StatePath)
+   parser.add_argument('--interval', type=float, default=1, help='seconds between prints')
+   parser.add_argument('--benchmark', type=float, nargs='?', const=5, metavar='SECONDS',
+                       help='measure read latency instead of printing')
+   args = parser.parse_args()
+
+   reader = StateReader(args.path)
+   if args.benchmark:
+      benchmark(reader, args.benchmark)
+      return
+   try:
+      while True:
+         state = {name: (None if isinstance(value, float) and math.isnan(value) else value)
+                  for name, value in reader.readDict().items()}
+         print(json.dumps(state))
+         sleep(args.interval)
+   except KeyboardInterrupt:
+      pass
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,395 @@
+#!
+
+'''
+Service: BMSTraceAnalytics.py
+
+Purpose:
+    Offline analysis of recorded CAN traces (candump -L logs such as the
+    BMS2Inverter capture dumps, Vector ASC or BLF)
+    1) Decodes the Discover BMS frames (0x351/0x354/0x355/0x356/0x35A) with
+       NumPy structured dtypes built from the BMSDiscoverSC* field layouts
+    2) Writes a BMS time series, alarm timeline, cell balancing episodes and
+       inverter frame cadence statistics as CSV (or Parquet)
+Feature Details:
+    candump logs are parsed a block at a time with array operations, no object
+    is created per frame.  ASC and BLF files (and candump lines the fast path
+    does not understand) are read through can.LogReader into the same record
+    array.  Every analysis works on whole columns, there is no per frame loop.
+
+    Requires numpy, and pyarrow for --format parquet:
+      pip install numpy pyarrow
+
+Example:
+    python BMSTraceAnalytics.py --output analysis capture/*.log
+'''
+
+import argparse
+import csv
+import os
+import can
+import numpy as np
+from datetime import datetime
+
+from BMS2Inverter import (BMSDiscoverSCBatteryLimits, BMSDiscoverSCBatteryCapacity,
+                          BMSDiscoverSCBatteryStatus, BMSDiscoverSCBatteryMeasurements,
+                          BMSDiscoverSCBatteryAlarms)
+
+
+#region ********** Trace Loading **********
+'''
+--------------------------------------
+Trace Loading
+--------------------------------------
+'''
+
+# one record per CAN frame, same fields as the BMS2Inverter capture ring
+Frame = np.dtype([('timestamp', '<f8'),
+                  ('id', '<u4'),
+                  ('channel', 'u1'),
+                  ('tx', '?'),
+                  ('dlc', 'u1'),
+                  ('data', 'u1', (8,))])
+
+BlockSize = 64 * 1024 * 1024
+
+# ascii hex digit -> nibble value
+HexNibble = np.zeros(256, dtype=np.uint8)
+for i, c in enumerate(b'0123456789ABCDEF'):
+   HexNibble[c] = i
+   HexNibble[ord(chr(c).lower())] = i
+
+class TraceReader ():
+   '''
+   Collects frames from any number of trace files into one Frame array.
+   Channel names are mapped to small integers shared across files.
+   '''
+
+   def __init__(self):
+      self.channels = []
+      self.blocks = []
+
+   def channelIndex(self, name):
+      if name not in self.channels:
+         self.channels.append(name)
+      return self.channels.index(name)
+
+   def read(self, fileName):
+      if fileName.lower().endswith('.log'):
+         self.readCandump(fileName)
+      else:
+         self.readLogReader(fileName)
+
+   def readCandump(self, fileName):
+      with open(fileName, 'rb') as f:
+         remainder = b''
+         while True:
+            block = f.read(BlockSize)
+            if not block:
+               break
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            if end == 0:
+               remainder = block
+               continue
+            remainder = block[end:]
+            self.__parseCandump(block[:end], fileName)
+         if remainder.strip():
+            self.__parseCandump(remainder + b'\n', fileName)
+
+   def __parseCandump(self, block, fileName):
+      text = np.frombuffer(block, dtype=np.uint8)
+      #block local positions fit in int32, which halves the index matrices
+      lineEnds = np.flatnonzero(text == ord('\n')).astype(np.int32)
+      lineStarts = np.concatenate(([0], lineEnds[:-1] + 1))
+      ends = lineEnds - (text[np.maximum(lineEnds - 1, 0)] == ord('\r'))
+      keep = ends > lineStarts
+      lineStarts, ends = lineStarts[keep], ends[keep]
+
+      opens = np.flatnonzero(text == ord('(')).astype(np.int32)
+      closes = np.flatnonzero(text == ord(')')).astype(np.int32)
+      hashes = np.flatnonzero(text == ord('#')).astype(np.int32)
+      spaces = np.flatnonzero(text == ord(' ')).astype(np.int32)
+      n = len(lineStarts)
+      if (len(opens) != n or len(closes) != n or len(hashes) != n
+          or not np.array_equal(opens, lineStarts)):
+         #CAN FD, remote frames or comments, let python-can sort it out
+         self.readLogReader(fileName, block)
+         return
+
+      # ID is between the last space before '#' and '#', data runs to the next space or the line end
+      idStarts = spaces[np.searchsorted(spaces, hashes) - 1] + 1
+      nextSpace = np.searchsorted(spaces, hashes)
+      nextSpace = np.where(nextSpace < len(spaces), spaces[np.minimum(nextSpace, len(spaces) - 1)], ends)
+      dataEnds = np.minimum(nextSpace, ends)
+      hasDirection = dataEnds < ends
+
+      padded = np.concatenate((np.zeros(GatherPad, dtype=np.uint8), text, np.zeros(GatherPad, dtype=np.uint8)))
+      frames = np.zeros(n, dtype=Frame)
+      frames['timestamp'] = gather(padded, opens + 1, closes, 20).view('S20').ravel().astype(np.float64)
+      frames['id'] = hexValue(gather(padded, idStarts, hashes, 8, right=True))
+      nibbles = HexNibble[gather(padded, hashes + 1, dataEnds, 16)]
+      frames['data'] = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+      frames['dlc'] = np.minimum((dataEnds - hashes - 1) // 2, 8)
+      frames['tx'] = hasDirection & (text[np.minimum(dataEnds + 1, len(text) - 1)] == ord('T'))
+
+      #channel names are unique'd on a 64 bit key of their characters, a sort of strings is far slower
+      channelChars = gather(padded, closes + 2, idStarts - 1, 16)
+      words = channelChars.view(np.uint64)
+      keys, first, inverse = np.unique(words[:, 0] * np.uint64(1000003) ^ words[:, 1], return_index=True, return_inverse=True)
+      mapping = np.array([self.channelIndex(channelChars[i].tobytes().rstrip(b'\x00').decode()) for i in first], dtype=np.uint8)
+      frames['channel'] = mapping[inverse]
+      self.blocks.append(frames)
+
+   def readLogReader(self, fileName, block=None):
+      if block is not None:
+         #only the block that failed the fast path, through a temporary file
+         fileName = fileName + '.block.log'
+         with open(fileName, 'wb') as f:
+            f.write(block)
+      try:
+         records = []
+         for message in can.LogReader(fileName):
+            if message.is_error_frame or message.is_remote_frame:
+               continue
+            data = bytes(message.data[:8]).ljust(8, b'\x00')
+            records.append((message.timestamp, message.arbitration_id, self.channelIndex(str(message.channel)),
+                            not message.is_rx, min(message.dlc, 8), tuple(data)))
+         self.blocks.append(np.array(records, dtype=Frame))
+      finally:
+         if block is not None:
+            os.remove(fileName)
+
+   def frames(self):
+      frames = np.concatenate(self.blocks) if self.blocks else np.zeros(0, dtype=Frame)
+      if np.all(np.diff(frames['timestamp']) >= 0):
+         return frames
+      return frames[np.argsort(frames['timestamp'], kind='stable')]
+
+# zero bytes around a parsed block so gather() never indexes outside it
+GatherPad = 32
+
+def gather(padded, starts, ends, width, right=False):
+   # fixed width matrix of the characters text[start:end] per row, NUL padded
+   offsets = np.arange(width, dtype=np.int32)
+   if right:
+      index = (ends - width + GatherPad)[:, None] + offsets
+      valid = index >= (starts + GatherPad)[:, None]
+   else:
+      index = (starts + GatherPad)[:, None] + offsets
+      valid = index < (ends + GatherPad)[:, None]
+   chars = padded[index]
+   chars[~valid] = 0
+   return chars
+
+def hexValue(chars):
+   # right aligned ascii hex matrix -> integer per row
+   nibbles = HexNibble[chars].astype(np.uint32)
+   weights = np.uint32(16) ** np.arange(chars.shape[1] - 1, -1, -1, dtype=np.uint32)
+   return (nibbles * weights).sum(axis=1, dtype=np.uint32)
+
+#endregion
+
+#region ********** Decoding **********
+'''
+--------------------------------------
+Vectorized decoding
+--------------------------------------
+
+The dtypes are built from the (field, struct code, divisor) layouts of the
+BMSDiscoverSC* classes so the offline and the live decode can not drift apart.
+'''
+
+NumpyCodes = {'B': 'u1', 'b': 'i1', 'H': 'u2', 'h': 'i2', 'I': 'u4', 'i': 'i4'}
+
+def layoutDtype(decoderClass):
+   return np.dtype([(name or 'reserved' + str(i), '<' + NumpyCodes[code])
+                    for i, (name, code, _) in enumerate(decoderClass.fields)])
+
+def decodeLayout(frames, decoderClass):
+   # column equivalent of decoderClass.decode() for every frame
+   raw = np.ascontiguousarray(frames['data']).view(layoutDtype(decoderClass))[:, 0]
+   columns = {'timestamp': frames['timestamp']}
+   for name, code, divisor in decoderClass.fields:
+      if name is not None:
+         columns[name] = raw[name] / divisor if divisor != 1 else raw[name]
+   return columns
+
+def decodeAlarms(frames):
+   # column of active flags per (alarm, is protection), later pairs win like in decode()
+   data = frames['data']
+   active = {}
+   for index, alarm, protection in BMSDiscoverSCBatteryAlarms.pairs:
+      state = (data[:, index // 4] >> (6 - 2 * (index % 4))) & 3
+      active[(alarm, protection)] = state == 1
+   return active
+
+def asOf(timestamps, sourceTimestamps, values):
+   # latest source value at or before each timestamp, NaN before the first one
+   index = np.searchsorted(sourceTimestamps, timestamps, side='right') - 1
+   if len(values) == 0:
+      return np.full(len(timestamps), np.nan)
+   result = values[np.maximum(index, 0)].astype(np.float64)
+   result[index < 0] = np.nan
+   return result
+
+def episodes(timestamps, active):
+   # (start, end, ongoing) of each run of True
+   edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+   starts = np.flatnonzero(edges == 1)
+   ends = np.flatnonzero(edges == -1)
+   ongoing = ends == len(active)
+   return timestamps[starts], timestamps[np.minimum(ends, len(active) - 1)], ongoing, starts, ends
+
+#endregion
+
+#region ********** Analyses **********
+'''
+--------------------------------------
+Analyses
+--------------------------------------
+'''
+
+def channelFrames(frames, channels, name):
+   if name not in channels:
+      return frames[:0]
+   return frames[frames['channel'] == channels.index(name)]
+
+def bmsTimeSeries(bmsFrames, inverterFrames):
+   # one row per 0x356 measurement with the other frames joined as of that time
+   byId = lambda frames, frameId: frames[frames['id'] == frameId]
+   measurements = decodeLayout(byId(bmsFrames, 0x356), BMSDiscoverSCBatteryMeasurements)
+   timestamps = measurements['timestamp']
+   columns = dict(measurements)
+   columns['batteryTemperatureF'] = measurements['batteryTemperature'] * 9 / 5 + 32
+   for frameId, decoderClass in ((0x355, BMSDiscoverSCBatteryStatus),
+                                 (0x354, BMSDiscoverSCBatteryCapacity),
+                                 (0x351, BMSDiscoverSCBatteryLimits)):
+      decoded = decodeLayout(byId(bmsFrames, frameId), decoderClass)
+      for name, values in decoded.items():
+         if name != 'timestamp':
+            columns[name] = asOf(timestamps, decoded['timestamp'], values)
+   #the Pylontech 0x355 sent to the inverter has the same layout
+   inverterStatus = decodeLayout(byId(inverterFrames, 0x355), BMSDiscoverSCBatteryStatus)
+   columns['inverterStateOfCharge'] = asOf(timestamps, inverterStatus['timestamp'], inverterStatus['batteryStateOfCharge'])
+   return columns
+
+def alarmTimeline(bmsFrames):
+   alarmFrames = bmsFrames[bmsFrames['id'] == 0x35A]
+   rows = []
+   for (alarm, protection), active in decodeAlarms(alarmFrames).items():
+      starts, ends, ongoing, _, _ = episodes(alarmFrames['timestamp'], active)
+      for start, end, isOngoing in zip(starts, ends, ongoing):
+         rows.append((alarm.name, 'protection' if protection else 'alarm', start, end, round(end - start, 3), bool(isOngoing)))
+   rows.sort(key=lambda row: row[2])
+   return ('alarm', 'kind', 'start', 'end', 'durationSeconds', 'ongoing'), rows
+
+def cellBalancingEpisodes(bmsFrames, inverterFrames):
+   # the inverter is held below the BMS SOC while cell balancing is active
+   bmsStatus = decodeLayout(bmsFrames[bmsFrames['id'] == 0x355], BMSDiscoverSCBatteryStatus)
+   inverterStatus = decodeLayout(inverterFrames[(inverterFrames['id'] == 0x355) & inverterFrames['tx']], BMSDiscoverSCBatteryStatus)
+   timestamps = inverterStatus['timestamp']
+   bmsSOC = asOf(timestamps, bmsStatus['timestamp'], bmsStatus['batteryStateOfCharge'])
+   active = inverterStatus['batteryStateOfCharge'] < bmsSOC
+   starts, ends, ongoing, first, last = episodes(timestamps, active)
+   rows = []
+   for start, end, isOngoing, i, j in zip(starts, ends, ongoing, first, last):
+      rows.append((start, end, round(end - start, 3), int(inverterStatus['batteryStateOfCharge'][i:j].min()),
+                   int(np.nanmax(bmsSOC[i:j])), bool(isOngoing)))
+   return ('start', 'end', 'durationSeconds', 'heldSOC', 'maxBMSSOC', 'ongoing'), rows
+
+def frameCadence(inverterFrames):
+   # interval statistics per frame id written to the inverter
+   sent = inverterFrames[inverterFrames['tx']] if inverterFrames['tx'].any() else inverterFrames
+   rows = []
+   for frameId in np.unique(sent['id']):
+      timestamps = sent['timestamp'][sent['id'] == frameId]
+      if len(timestamps) < 2:
+         continue
+      intervals = np.diff(timestamps) * 1000
+      median = np.median(intervals)
+      rows.append(('0x%03X' % frameId, len(timestamps), round(intervals.mean(), 2), round(median, 2),
+                   round(np.percentile(intervals, 99), 2), round(intervals.max(), 2),
+                   int((intervals > 1.5 * median).sum())))
+   return ('frame', 'count', 'meanMs', 'medianMs', 'p99Ms', 'maxMs', 'gaps'), rows
+
+#endregion
+
+#region ********** Output **********
+'''
+--------------------------------------
+Output
+--------------------------------------
+'''
+
+def writeColumns(fileName, columns, format):
+   if format == 'parquet':
+      import pyarrow
+      import pyarrow.parquet
+      pyarrow.parquet.write_table(pyarrow.table(columns), fileName + '.parquet')
+   else:
+      names = list(columns)
+      matrix = np.column_stack([np.asarray(columns[name], dtype=np.float64) for name in names]) if names else np.zeros((0, 0))
+      np.savetxt(fileName + '.csv', matrix, delimiter=',', header=','.join(names), comments='', fmt='%.6f')
+
+def writeRows(fileName, header, rows, format):
+   if format == 'parquet':
+      writeColumns(fileName, {name: [row[i] for row in rows] for i, name in enumerate(header)}, format)
+   else:
+      with open(fileName + '.csv', 'w', newline='') as f:
+         writer = csv.writer(f)
+         writer.writerow(header)
+         writer.writerows(rows)
+
+def printRows(title, header, rows):
+   print(title)
+   if not rows:
+      print('  none')
+      return
+   widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+   for row in [header] + list(rows):
+      print('  ' + '  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+#endregion
+
+#region ********** main **********
+
+def main():
+   parser = argparse.ArgumentParser(description='Decode and analyse recorded BMS2Inverter CAN traces')
+   parser.add_argument('traces', nargs='+', help='candump -L (.log), ASC or BLF trace files')
+   parser.add_argument('-b', '--bms-channel', default='can0', help='channel connected to the Lynk II, e.g. can0')
+   parser.add_argument('-i', '--inverter-channel', default='can1', help='channel connected to the inverter, e.g. can1')
+   parser.add_argument('-o', '--output', default='analysis', help='output directory')
+   parser.add_argument('-f', '--format', default='csv', choices=['csv', 'parquet'], help='output file format')
+   args = parser.parse_args()
+
+   started = datetime.now()
+   reader = TraceReader()
+   for fileName in args.traces:
+      reader.read(fileName)
+   frames = reader.frames()
+   loaded = datetime.now()
+
+   bmsFrames = channelFrames(frames, reader.channels, args.bms_channel)
+   bmsFrames = bmsFrames[~bmsFrames['tx']]
+   inverterFrames = channelFrames(frames, reader.channels, args.inverter_channel)
+   print('Frames: ' + str(len(frames)) + ' (BMS ' + str(len(bmsFrames)) + ', inverter ' + str(len(inverterFrames)) +
+         ') channels: ' + ', '.join(reader.channels))
+
+   os.makedirs(args.output, exist_ok=True)
+   timeSeries = bmsTimeSeries(bmsFrames, inverterFrames)
+   writeColumns(os.path.join(args.output, 'timeseries'), timeSeries, args.format)
+   print('Time series: ' + str(len(timeSeries['timestamp'])) + ' rows')
+
+   for title, fileName, (header, rows) in (('Alarm timeline', 'alarms', alarmTimeline(bmsFrames)),
+                                           ('Cell balancing episodes', 'cellbalancing', cellBalancingEpisodes(bmsFrames, inverterFrames)),
+                                           ('Inverter frame cadence', 'cadence', frameCadence(inverterFrames))):
+      writeRows(os.path.join(args.output, fileName), header, rows, args.format)
+      printRows(title, header, rows[:20])
+
+   finished = datetime.now()
+   print('Loaded in ' + str(round((loaded - started).total_seconds(), 2)) + 's, analysed in ' +
+         str(round((finished - loaded).total_seconds(), 2)) + 's, written to ' + args.output)
+
+if __name__ == "__main__":
+   main()
+#endregion
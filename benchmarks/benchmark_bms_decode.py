@@ -0,0 +1,64 @@
+#!
+
+'''
+Benchmark: benchmark_bms_decode.py
+
+Purpose:
+    Per frame cost of the BMS input protocols: the recorded traces in
+    tests/traces are decoded through each protocol's dispatch table the way
+    readBMS does (one dict lookup, decode, no hooks) and the mean time per
+    frame is reported.
+
+Example:
+    python benchmarks/benchmark_bms_decode.py --repeat 2000
+'''
+
+import argparse
+import os
+import sys
+from time import perf_counter_ns
+
+RepoDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDirectory)
+
+import BMS2Inverter
+
+# protocol name, trace recorded from that kind of BMS
+Traces = (('discover', 'discover.log'),
+          ('pylontech', 'pylontech-in.log'),
+          ('SMA', 'sma-in.log'))
+
+
+def readTrace(fileName):
+   frames = []
+   with open(os.path.join(RepoDirectory, 'tests', 'traces', fileName)) as f:
+      for line in f:
+         fields = line.split()
+         if len(fields) < 3 or '#' not in fields[2]:
+            continue
+         frameId, data = fields[2].split('#')
+         frames.append((int(frameId, 16), bytearray.fromhex(data)))
+   return frames
+
+def benchmark(protocolName, frames, repeat):
+   dispatch = BMS2Inverter.BMSProtocols[protocolName]().dispatch
+   start = perf_counter_ns()
+   for _ in range(repeat):
+      for frameId, data in frames:
+         handler = dispatch.get(frameId)
+         if handler is not None:
+            handler[0](data)
+   return (perf_counter_ns() - start) / (repeat * len(frames))
+
+def main():
+   parser = argparse.ArgumentParser(description='BMS input protocol decode benchmark')
+   parser.add_argument('--repeat', type=int, default=1000, help='passes over each trace')
+   args = parser.parse_args()
+
+   for protocolName, fileName in Traces:
+      frames = readTrace(fileName)
+      nsPerFrame = benchmark(protocolName, frames, args.repeat)
+      print(f'{protocolName:10} {len(frames):5} frames  {nsPerFrame:8.0f} ns/frame')
+
+if __name__ == '__main__':
+   main()
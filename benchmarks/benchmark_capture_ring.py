@@ -0,0 +1,61 @@
+#!
+
+'''
+Benchmark: benchmark_capture_ring.py
+
+Purpose:
+    Cost of the raw CAN frame capture ring: CANCaptureRing.capture per frame
+    (paid on the BMS reader and inverter writer threads), and the snapshot
+    and candump formatting of a full ring done on a dump.
+
+Example:
+    python benchmarks/benchmark_capture_ring.py --frames 32768
+'''
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from time import perf_counter_ns
+
+import can
+
+RepoDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDirectory)
+
+import BMS2Inverter
+
+
+def main():
+   parser = argparse.ArgumentParser(description='CAN capture ring benchmark')
+   parser.add_argument('--frames', type=int, default=32768, help='ring size in frames')
+   parser.add_argument('--repeat', type=int, default=5, help='times the ring is filled')
+   args = parser.parse_args()
+
+   BMS2Inverter.logger = logging.getLogger('BMS2Inverter')
+   BMS2Inverter.metrics = BMS2Inverter.BMStoInverterMetrics()
+   message = can.Message(arbitration_id=0x356, data=bytes.fromhex('82 14 90 01 f8 00 00 00'), is_extended_id=False)
+
+   with tempfile.TemporaryDirectory() as directory:
+      ring = BMS2Inverter.CANCaptureRing(args.frames, directory)
+      count = args.frames * args.repeat
+      start = perf_counter_ns()
+      for _ in range(count):
+         ring.capture(ring.BMS, message)
+      captureNs = (perf_counter_ns() - start) / count
+
+      start = perf_counter_ns()
+      records = ring.snapshot()
+      snapshotMs = (perf_counter_ns() - start) / 1e6
+
+      start = perf_counter_ns()
+      ring._CANCaptureRing__write(os.path.join(directory, 'capture.log'), records)
+      writeMs = (perf_counter_ns() - start) / 1e6
+
+   print(f'capture            {captureNs:8.0f} ns/frame')
+   print(f'snapshot {args.frames:6} {snapshotMs:8.1f} ms (thread calling dump)')
+   print(f'write    {args.frames:6} {writeMs:8.1f} ms (dump thread)')
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,88 @@
+#!
+
+'''
+Benchmark: benchmark_cut_through.py
+
+Purpose:
+    BMS to inverter latency (BMS frame arrival to the transcoded frame being
+    sent) with the scheduled writer and with inverter.cut-through.  Each mode
+    runs BMS2Inverter in its own process against BMSSimulator on python-can
+    virtual buses, in a temporary working directory, and reports the latency
+    ring of the CutThroughRelay.  The scheduled latency depends on where the
+    writer's cycle falls relative to the BMS cadence, anywhere from zero to
+    one protocol period, so it varies from run to run.
+
+Example:
+    python benchmarks/benchmark_cut_through.py --duration 40
+'''
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from time import sleep
+
+import yaml
+
+RepoDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDirectory)
+
+import BMS2Inverter
+import BMSSimulator
+
+Modes = (('scheduled', False), ('cut-through', True))
+
+
+def run(cutThrough, duration):
+   # one mode in this process, working directory already the temporary one
+   config = BMS2Inverter.readConfig(os.path.join(RepoDirectory, BMS2Inverter.ConfigFileName))
+   config['BMS'].update({'interface': 'virtual', 'port': 'can0'})
+   config['inverter'].update({'interface': 'virtual', 'port': 'can1', 'cut-through': cutThrough})
+   for section in ('dashboard', 'sharedstate', 'redundancy', 'capture', 'energy'):
+      config[section] = {'enabled': False}
+   os.makedirs(os.path.dirname(config['logging']['logfile']), exist_ok=True)
+   BMS2Inverter.setConfigParams(config)
+   BMS2Inverter.logger = logging.getLogger('BMS2Inverter')
+   BMS2Inverter.setLogLevel('warning')
+   bridge = threading.Thread(target=BMS2Inverter.main, args=[config])
+   bridge.start()
+
+   with open(os.path.join(RepoDirectory, BMSSimulator.SimulatorConfigFileName)) as f:
+      simulation = BMSSimulator.Simulation(yaml.safe_load(f), 'virtual', 'can0', 'can1', 1, 1, 1)
+   simulation.start()
+   sleep(duration)
+   samples = [latency * 1000 for latency in BMS2Inverter.InverterRelay.latencies.samples()]
+   simulation.stop()
+   BMS2Inverter.requestShutdown()
+   bridge.join()
+   return samples
+
+def main():
+   parser = argparse.ArgumentParser(description='scheduled vs cut-through BMS to inverter latency')
+   parser.add_argument('--duration', type=float, default=30, help='seconds per mode')
+   parser.add_argument('--run', choices=[mode for mode, _ in Modes], help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   if args.run:
+      print(json.dumps(run(dict(Modes)[args.run], args.duration)))
+      return
+
+   for mode, _ in Modes:
+      with tempfile.TemporaryDirectory() as directory:
+         result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', mode, '--duration', str(args.duration)],
+                                 cwd=directory, capture_output=True, text=True, check=True)
+      samples = json.loads(result.stdout.strip().splitlines()[-1])
+      if not samples:
+         print(f'{mode:12} no frames relayed')
+         continue
+      samples.sort()
+      print(f'{mode:12} {len(samples):4} frames  mean {statistics.mean(samples):7.1f} ms  median {statistics.median(samples):7.1f} ms  '
+            f'p95 {samples[int(len(samples) * 0.95)]:7.1f} ms  max {samples[-1]:7.1f} ms')
+
+if __name__ == '__main__':
+   main()
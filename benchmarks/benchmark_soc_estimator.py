@@ -0,0 +1,54 @@
+#!
+
+'''
+Benchmark: benchmark_soc_estimator.py
+
+Purpose:
+    Per frame cost of the coulomb counting SOC estimator: SOCEstimator.update
+    for every 0x356 current reading, re-anchored from 0x354 / 0x355 once a
+    second as the Discover BMS sends them, at the 1s frame cadence in
+    simulated time.
+
+Example:
+    python benchmarks/benchmark_soc_estimator.py --frames 1000000
+'''
+
+import argparse
+import os
+import sys
+from time import perf_counter_ns
+
+RepoDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RepoDirectory)
+
+import BMS2Inverter
+
+
+def main():
+   parser = argparse.ArgumentParser(description='SOC estimator update benchmark')
+   parser.add_argument('--frames', type=int, default=200000, help='0x356 frames to integrate')
+   args = parser.parse_args()
+
+   estimator = BMS2Inverter.SOCEstimator()
+   estimator.anchorCapacity(180, 300)
+   estimator.anchorSOC(60)
+   #a charge / discharge profile in amps, one reading per simulated second
+   currents = [40.0 - (i % 600) * 0.13 for i in range(600)]
+
+   start = perf_counter_ns()
+   for i in range(args.frames):
+      estimator.update(currents[i % 600], float(i))
+   updateNs = (perf_counter_ns() - start) / args.frames
+
+   start = perf_counter_ns()
+   for i in range(args.frames):
+      estimator.update(currents[i % 600], float(i))
+      estimator.anchorCapacity(180, 300)
+      estimator.anchorSOC(60)
+   anchoredNs = (perf_counter_ns() - start) / args.frames
+
+   print(f'update            {updateNs:8.0f} ns/frame')
+   print(f'update + anchors  {anchoredNs:8.0f} ns/frame')
+
+if __name__ == '__main__':
+   main()
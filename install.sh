@@ -141,8 +141,12 @@ After=${APP_NAME}-CAN.service
 Wants=network-online.target
 
 [Service]
+Type=notify
+NotifyAccess=main
+WatchdogSec=15
+TimeoutStartSec=30
 Restart=always
-RestartSec=10
+RestartSec=2
 User=${OS_USER}
 ExecStart=${INSTALL_DIR}/start.sh
 WorkingDirectory=${INSTALL_DIR}
@@ -1,2 +1,3 @@
 #!/bin/bash
-./venv/bin/python ./BMS2Inverter.py
+#exec so systemd sees python as the main process for sd_notify
+exec ./venv/bin/python ./BMS2Inverter.py
@@ -0,0 +1,84 @@
+'''
+Shared fixtures for the BMS2Inverter tests
+
+BMS2Inverter keeps its state in module globals set up by main(), the bridge
+fixture sets up the ones the stages under test read, from the shipped config,
+with the working directory in a temporary directory (cellbalance.marker is
+written relative to it) and energy accounting on, checkpointing there too.
+'''
+
+import logging
+import os
+import sys
+import threading
+
+import can
+import pytest
+
+RepoDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TraceDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+sys.path.insert(0, RepoDirectory)
+
+import BMS2Inverter
+
+
+def readTrace(fileName):
+   # (arbitration id, data) per line of a candump -L trace in tests/traces
+   frames = []
+   with open(os.path.join(TraceDirectory, fileName)) as f:
+      for line in f:
+         fields = line.split()
+         if len(fields) < 3 or '#' not in fields[2]:
+            continue
+         frameId, data = fields[2].split('#')
+         frames.append((int(frameId, 16), bytes.fromhex(data)))
+   return frames
+
+
+class TracePort ():
+   # stands in for the BMS CAN port, recv hands out the frames then stops readBMS
+
+   def __init__(self, frames, runEvent):
+      self.frames = iter(frames)
+      self.runEvent = runEvent
+
+   def recv(self, timeout=None):
+      frame = next(self.frames, None)
+      if frame is None:
+         self.runEvent.clear()
+         return None
+      frameId, data = frame
+      return can.Message(arbitration_id=frameId, data=data, is_extended_id=False)
+
+def replay(bridge, frames):
+   # frames through readBMS, decode, hooks and all, as if read from the BMS port
+   runEvent = threading.Event()
+   runEvent.set()
+   bridge.readBMS(runEvent, TracePort(frames, runEvent))
+
+
+@pytest.fixture
+def bridge(tmp_path, monkeypatch):
+   config = BMS2Inverter.readConfig(os.path.join(RepoDirectory, BMS2Inverter.ConfigFileName))
+   config['energy'].update({'enabled': True, 'file': str(tmp_path / 'energy.json')})
+   config['capture']['enabled'] = False
+   BMS2Inverter.setConfigParams(config)
+   monkeypatch.chdir(tmp_path)
+   BMS2Inverter.logger = logging.getLogger('BMS2Inverter')
+   BMS2Inverter.metrics = BMS2Inverter.BMStoInverterMetrics()
+   BMS2Inverter.CurrentSettings = BMS2Inverter.RuntimeSettings(BMS2Inverter.CellBalancingHoldSOCParam,
+                                                               BMS2Inverter.CellBalancingIntervalParam,
+                                                               BMS2Inverter.CellBalancingMinutesParam,
+                                                               BMS2Inverter.LowVoltageWarningParam,
+                                                               BMS2Inverter.InverterOutputProtocolParam)
+   BMS2Inverter.PendingSettings = None
+   BMS2Inverter.SettingsLock = threading.Lock()
+   BMS2Inverter.Redundancy = None
+   BMS2Inverter.StateExport = None
+   BMS2Inverter.CANCapture = None
+   BMS2Inverter.createCANSupervisors()
+   BMS2Inverter.createBMSState()
+   BMS2Inverter.BMSEnergy = BMS2Inverter.createEnergyAccumulator()
+   BMS2Inverter.createAlarmEvents()
+   BMS2Inverter.createInverterState()
+   return BMS2Inverter
@@ -0,0 +1,51 @@
+import json
+import time
+
+from conftest import readTrace, replay
+
+
+def useAlarmFile(bridge, monkeypatch, fileName):
+   # the file notifier stands in for the command and the webhook
+   monkeypatch.setattr(bridge, 'AlarmEventsParam', dict(bridge.AlarmEventsParam, file=fileName))
+   bridge.createAlarmEvents()
+
+def waitFor(condition, timeout=3):
+   deadline = time.monotonic() + timeout
+   while not condition():
+      if time.monotonic() > deadline:
+         return False
+      time.sleep(0.01)
+   return True
+
+def test_alarm_raised_and_cleared(bridge, tmp_path, monkeypatch):
+   fileName = tmp_path / 'alarms.jsonl'
+   useAlarmFile(bridge, monkeypatch, str(fileName))
+   bridge.BMSInputProtocolParam = 'pylontech'
+   bridge.createBMSState()
+   replay(bridge, readTrace('pylontech-alarm.log'))
+
+   history = list(bridge.BMSAlarmEvents.history)
+   assert [(event['alarm'], event['level'], event['event']) for event in history] == [
+      ('DISCHARGE_CURRENT_HIGH', 'alarm', 'raised'),
+      ('DISCHARGE_CURRENT_HIGH', 'alarm', 'cleared')]
+   assert bridge.BMSAlarmEvents.mask == 0
+
+   assert waitFor(lambda: bridge.metrics.AlarmNotifications == 2)
+   with open(fileName) as f:
+      assert [json.loads(line) for line in f] == [[event] for event in history]
+   assert bridge.metrics.AlarmNotifyErrors == 0
+
+def test_restart_does_not_raise_active_alarms_again(bridge):
+   # startThreads() rebuilds the decoded state, the event log and its mask carry on
+   bridge.BMSInputProtocolParam = 'pylontech'
+   bridge.createBMSState()
+   raised = readTrace('pylontech-alarm.log')[18:36]
+   replay(bridge, raised)
+   events = bridge.BMSAlarmEvents
+   assert len(events.history) == 1
+
+   bridge.createBMSState()
+   replay(bridge, raised)
+   assert bridge.BMSAlarmEvents is events
+   assert len(events.history) == 1
+   assert bridge.BMSBatteryAlarms.mask == events.mask != 0
@@ -0,0 +1,44 @@
+import pytest
+
+from conftest import readTrace, replay
+
+
+def useProtocol(bridge, name):
+   bridge.BMSInputProtocolParam = name
+   bridge.createBMSState()
+
+def test_discover_trace(bridge):
+   replay(bridge, readTrace('discover.log'))
+   assert bridge.BMSBatteryLimits.requestedChargeVoltage == 55.9
+   assert bridge.BMSBatteryCapacity.batteryNominalCapacity == 300
+   assert bridge.BMSBatteryStatus.batteryStateOfCharge == 60
+   assert bridge.BMSManufacturer.manufacturer == 'DISCOVER'
+   assert bridge.BMSLynxFirmware.versionString
+   assert bridge.metrics.BMSDecodeErrors == 0
+
+def test_pylontech_input_trace(bridge):
+   useProtocol(bridge, 'pylontech')
+   replay(bridge, readTrace('pylontech-in.log'))
+   assert bridge.BMSBatteryStatus.batteryStateOfCharge == 72
+   assert bridge.BMSBatteryMeasurements.batteryVoltage == 53.19
+   assert bridge.BMSBatteryMeasurements.batteryCurrent == -9.6
+   assert bridge.BMSManufacturer.manufacturer.rstrip() == 'PYLON'
+   assert [alarm.name for alarm in bridge.BMSBatteryAlarms.protections] == ['PACK_VOLTAGE_LOW']
+   assert bridge.metrics.BMSDecodeErrors == 0
+
+def test_sma_input_trace(bridge):
+   useProtocol(bridge, 'SMA')
+   replay(bridge, readTrace('sma-in.log'))
+   assert bridge.BMSBatteryMeasurements.batteryTemperature == 24.5
+   assert bridge.BMSManufacturer.manufacturer == 'JKBMS'
+   assert [alarm.name for alarm in bridge.BMSBatteryAlarms.protections] == ['PACK_VOLTAGE_LOW']
+   assert bridge.metrics.BMSDecodeErrors == 0
+
+@pytest.mark.parametrize('frame', [(0x356, bytes(3)), (0x351, bytes(7)), (0x35E, b'\xff\xfeBAD\x00\x00\x00')])
+def test_malformed_frame_is_skipped(bridge, frame):
+   frames = readTrace('discover.log')
+   replay(bridge, frames[:5] + [frame] + frames[5:])
+   assert bridge.metrics.BMSDecodeErrors == 1
+   #the reader carried on with the rest of the trace
+   assert bridge.BMSManufacturer.manufacturer == 'DISCOVER'
+   assert bridge.BMSBatteryStatus.batteryStateOfCharge == 60
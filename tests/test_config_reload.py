@@ -0,0 +1,63 @@
+import os
+
+import yaml
+
+
+def writeConfig(path, config):
+   with open(path, 'w') as f:
+      yaml.safe_dump(config, f)
+   # a distinct mtime per write, the watcher polls on st_mtime_ns
+   stat = os.stat(path)
+   os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+def loadedConfig(bridge, tmp_path):
+   config = bridge.readConfig(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), bridge.ConfigFileName))
+   config['energy']['file'] = str(tmp_path / 'energy.json')
+   config['capture']['enabled'] = False
+   return config
+
+def test_unrelated_reload_keeps_cadence(bridge, tmp_path):
+   config = loadedConfig(bridge, tmp_path)
+   fileName = str(tmp_path / 'BMS2Inverter.yaml')
+   writeConfig(fileName, config)
+   watcher = bridge.ConfigWatcher(fileName, config)
+   cadence = bridge.InverterCadenceParam
+
+   config = loadedConfig(bridge, tmp_path)
+   config['logging']['loglevel'] = 'debug'
+   writeConfig(fileName, config)
+   assert watcher.poll()
+   assert bridge.InverterCadenceParam is cadence
+
+   config = loadedConfig(bridge, tmp_path)
+   config['inverter']['cadence-ms'] = {0x35E: 5000}
+   writeConfig(fileName, config)
+   assert watcher.poll()
+   assert bridge.InverterCadenceParam is not cadence
+   assert bridge.InverterCadenceParam == {0x35E: 5.0}
+
+def test_signal_conditioning_reload_keeps_runtime_low_voltage_warning(bridge, tmp_path):
+   config = loadedConfig(bridge, tmp_path)
+   fileName = str(tmp_path / 'BMS2Inverter.yaml')
+   writeConfig(fileName, config)
+   watcher = bridge.ConfigWatcher(fileName, config)
+   bridge.updateSettings({'lowVoltageWarning': 46.0})
+   bridge.applyPendingSettings()
+
+   def confirmLow():
+      return [valueFilter.low for valueFilter in bridge.BMSSignalConditioner.filters['voltage']
+              if isinstance(valueFilter, bridge.ConfirmationFilter)]
+
+   config = loadedConfig(bridge, tmp_path)
+   config['signalconditioning']['voltage']['confirm-samples'] = 4
+   writeConfig(fileName, config)
+   assert watcher.poll()
+   assert confirmLow() == [46.0]
+
+   #queued for the writer's next swap
+   bridge.updateSettings({'lowVoltageWarning': 47.0})
+   config = loadedConfig(bridge, tmp_path)
+   config['signalconditioning']['voltage']['confirm-samples'] = 5
+   writeConfig(fileName, config)
+   assert watcher.poll()
+   assert confirmLow() == [47.0]
@@ -0,0 +1,25 @@
+import threading
+
+import BMS2Inverter
+
+
+def test_stalled_client_is_dropped_without_blocking(monkeypatch):
+   monkeypatch.setattr(BMS2Inverter, 'metrics', BMS2Inverter.BMStoInverterMetrics(), raising=False)
+   monkeypatch.setattr(BMS2Inverter, 'InverterOutput', object(), raising=False)
+   monkeypatch.setattr(BMS2Inverter, 'identitySnapshot', lambda: {})
+   values = iter(range(1000))
+   monkeypatch.setattr(BMS2Inverter, 'stateSnapshot', lambda: {'value': next(values)})
+
+   publisher = BMS2Inverter.DashboardPublisher(clientQueueSize=2)
+   stalled, _ = publisher.addClient()
+   publisher.publish()
+   publisher.publish()
+
+   #the next change overflows the stalled client's queue
+   publishing = threading.Thread(target=publisher.publish, daemon=True)
+   publishing.start()
+   publishing.join(2)
+   assert not publishing.is_alive()
+   assert publisher.clients == []
+   assert BMS2Inverter.metrics.DashboardDroppedClients == 1
+   assert stalled.get_nowait() is None
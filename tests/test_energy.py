@@ -0,0 +1,26 @@
+from time import monotonic, time
+
+
+def test_watchdog_restart_keeps_energy_totals(bridge, monkeypatch):
+   # stopThreads() and startThreads() as in main()'s watchdog branch, nothing has been checkpointed yet
+   monkeypatch.setattr(bridge, 'BMSCANInterfaceParam', 'virtual')
+   monkeypatch.setattr(bridge, 'BMSCANPortParam', 'energy-bms')
+   monkeypatch.setattr(bridge, 'InverterCANInterfaceParam', 'virtual')
+   monkeypatch.setattr(bridge, 'InverterCANPortParam', 'energy-inverter')
+   monkeypatch.setattr(bridge, 'MQTTClient', None, raising=False)
+   energy = bridge.BMSEnergy
+   now = monotonic()
+   for second in range(0, 61, 5):
+      energy.update(52.0, 20.0, now + second, time())
+   energy.update(52.0, -60.0, now + 65, time())
+   totals = energy.handoffState()
+   assert totals['chargeWh'] > 17 and totals['dischargeAh'] > 0
+
+   bridge.startThreads()
+   try:
+      bridge.stopThreads()
+      bridge.startThreads()
+   finally:
+      bridge.stopThreads()
+   assert bridge.BMSEnergy is energy
+   assert bridge.BMSEnergy.handoffState() == totals
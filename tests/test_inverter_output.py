@@ -0,0 +1,38 @@
+import pytest
+
+from conftest import readTrace, replay
+
+# frames each output protocol sends for the state at the end of discover.log,
+# captured from a known good build, any change here changes what the inverter sees
+Golden = {
+   'pylontech': {
+      0x351: '2f 02 04 0b 04 0b b0 01',
+      0x355: '3c 00 64 00 00 00 00 00',
+      0x356: '82 14 90 01 f8 00 00 00',
+      0x35C: 'c0 00',
+      0x35E: '44 49 53 43 4f 56 45 52',
+      0x359: '00 00 00 00 01 50 4e',
+   },
+   'SMA': {
+      0x351: '2f 02 04 0b 04 0b b0 01',
+      0x355: '3c 00 64 00 70 17',
+      0x356: '82 14 90 01 f8 00 00 00',
+      0x35E: '44 49 53 43 4f 56 45 52',
+      0x35A: 'aa aa aa 02 aa aa aa 02',
+   },
+}
+
+@pytest.mark.parametrize('protocolName', sorted(Golden))
+def test_golden_frames(bridge, protocolName):
+   replay(bridge, readTrace('discover.log'))
+   output = bridge.InverterProtocols[protocolName] ()
+   frames = {}
+   for encoder in output.frames:
+      assert encoder.encode()
+      frames[encoder.frame] = bytes(encoder.message).hex(' ')
+   assert frames == Golden[protocolName]
+
+def test_nothing_sent_before_bms_state(bridge):
+   output = bridge.InverterProtocols['pylontech'] ()
+   #only the constant charge flags frame goes out without BMS state
+   assert [encoder.frame for encoder in output.frames if encoder.encode()] == [0x35C]
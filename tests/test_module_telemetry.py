@@ -0,0 +1,36 @@
+from BMS2Inverter import BMSDiscoverModuleTelemetry, BMSDiscoverModuleCells, BMSDiscoverModuleTemperatures
+
+
+def cells(minCell, maxCell):
+   return BMSDiscoverModuleCells.layout.pack(minCell, maxCell, 1, 16, 5300)
+
+def temperatures(minTemperature, maxTemperature):
+   return BMSDiscoverModuleTemperatures.layout.pack(minTemperature, maxTemperature, 0, 0)
+
+
+def test_extremes_move_when_the_holder_recovers():
+   telemetry = BMSDiscoverModuleTelemetry()
+   telemetry.decodeCells(0, cells(3300, 3350))
+   telemetry.decodeCells(1, cells(3310, 3340))
+   assert (telemetry.weakestModule, telemetry.strongestModule, telemetry.cellSpread()) == (0, 0, 50)
+
+   telemetry.decodeCells(0, cells(3320, 3330))
+   assert telemetry.weakestModule == 1
+   assert telemetry.strongestModule == 1
+   assert telemetry.cellSpread() == 30
+
+def test_extremes_taken_over_by_other_modules():
+   telemetry = BMSDiscoverModuleTelemetry()
+   telemetry.decodeCells(0, cells(3300, 3350))
+   telemetry.decodeCells(2, cells(3290, 3360))
+   assert (telemetry.weakestModule, telemetry.strongestModule) == (2, 2)
+   telemetry.decodeCells(0, cells(3295, 3355))
+   assert (telemetry.weakestModule, telemetry.strongestModule) == (2, 2)
+
+def test_hottest_module_cools_down():
+   telemetry = BMSDiscoverModuleTelemetry()
+   telemetry.decodeTemperatures(0, temperatures(240, 300))
+   telemetry.decodeTemperatures(1, temperatures(240, 280))
+   assert telemetry.hottestModule == 0
+   telemetry.decodeTemperatures(0, temperatures(240, 260))
+   assert telemetry.hottestModule == 1
@@ -0,0 +1,56 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+def waitFor(condition, timeout=3):
+   deadline = time.monotonic() + timeout
+   while not condition():
+      if time.monotonic() > deadline:
+         return False
+      time.sleep(0.01)
+   return True
+
+@pytest.fixture
+def publisher(bridge):
+   # the publisher thread against a paho client that accepts every publish and never acknowledges
+   client = bridge.MQTTPublisher('localhost', 1883, qos=1, inflight=2, ackTimeout=0.2)
+   sent = []
+   def publish(topic, payload, qos, retain):
+      sent.append(topic)
+      return SimpleNamespace(rc=0, mid=len(sent))
+   client.client.publish = publish
+   client.connected = True
+   client._MQTTPublisher__running = True
+   thread = threading.Thread(target=client._MQTTPublisher__publisher)
+   thread.start()
+   yield client, sent
+   client._MQTTPublisher__running = False
+   client._MQTTPublisher__wakeup.set()
+   thread.join()
+
+def test_unacknowledged_messages_expire(bridge, publisher):
+   client, sent = publisher
+   for topic in ('a', 'b', 'c', 'd'):
+      client.publish(topic, '1')
+   assert waitFor(lambda: len(sent) == 2)
+   assert bridge.metrics.MQTTInflight == 2
+   #the window reopens once the first two time out
+   assert waitFor(lambda: len(sent) == 4)
+   assert bridge.metrics.MQTTAckTimeouts >= 2
+
+def test_disconnect_clears_inflight(bridge, publisher):
+   client, sent = publisher
+   client.ackTimeout = 30
+   for topic in ('a', 'b', 'c', 'd'):
+      client.publish(topic, '1')
+   assert waitFor(lambda: len(sent) == 2)
+   client._MQTTPublisher__onDisconnect(None, None, None, 'test', None)
+   assert waitFor(lambda: bridge.metrics.MQTTInflight == 0)
+   assert not bridge.metrics.MQTTConnected
+   client.connected = True
+   client.publish('e', '1')
+   assert waitFor(lambda: len(sent) == 4)
+   assert bridge.metrics.MQTTAckTimeouts == 0
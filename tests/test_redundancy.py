@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+import yaml
+
+from conftest import RepoDirectory
+import BMSSimulator
+
+# bridge processes only meet on buses that cross processes, an IPv4 group for the
+# BMS bus and an IPv6 group for the inverter bus keep the two apart
+BMSChannel = '239.74.163.2'
+InverterChannel = 'ff15:7079:7468:6f6e:6465:6d6f:6d63:6173'
+
+
+def test_shared_socket_directory_is_refused(bridge, tmp_path):
+   directory = tmp_path / 'shared'
+   directory.mkdir(mode=0o777)
+   os.chmod(directory, 0o777)
+   with pytest.raises(PermissionError):
+      bridge.GatewayRedundancy('standby', str(directory / 'standby.sock'), str(directory / 'active.sock'), 2.5)
+
+@pytest.mark.skipif(os.getuid() != 0, reason='sending as another uid needs root')
+def test_other_users_messages_are_dropped(bridge):
+   #directly in /tmp, another user can not get through the pytest tmp_path parents
+   directory = tempfile.mkdtemp(prefix='BMS2Inverter-test-')
+   socketPath = os.path.join(directory, 'standby.sock')
+   try:
+      redundancy = bridge.GatewayRedundancy('standby', socketPath, os.path.join(directory, 'active.sock'), 2.5)
+      redundancy.sock.settimeout(2)
+      #opened up after the check so another user can reach the socket at all
+      os.chmod(directory, 0o711)
+      os.chmod(socketPath, 0o666)
+      message = json.dumps({'type': 'state', 'role': 'active', 'sending': True, 'since': 0, 'state': {}}).encode()
+      child = os.fork()
+      if child == 0:
+         try:
+            os.setuid(65534)
+            socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM).sendto(message, socketPath)
+         finally:
+            os._exit(0)
+      os.waitpid(child, 0)
+      assert redundancy._GatewayRedundancy__receive() is None
+      assert redundancy.rejected == 1
+      socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM).sendto(message, socketPath)
+      assert redundancy._GatewayRedundancy__receive()['role'] == 'active'
+   finally:
+      shutil.rmtree(directory)
+
+def waitFor(condition, timeout):
+   deadline = time.monotonic() + timeout
+   while not condition():
+      if time.monotonic() > deadline:
+         return False
+      time.sleep(0.05)
+   return True
+
+def test_failover(monkeypatch, tmp_path):
+   # an active and a standby bridge process fed by the simulator, the active one is
+   # killed and the emulated inverter's longest silence is the failover time
+   monkeypatch.chdir(RepoDirectory)
+   with open(BMSSimulator.SimulatorConfigFileName) as f:
+      config = yaml.safe_load(f)
+   try:
+      simulation = BMSSimulator.Simulation(config, 'udp_multicast', BMSChannel, InverterChannel, 1, 1, 1)
+   except OSError as e:
+      pytest.skip('no multicast: ' + str(e))
+   processes = BMSSimulator.startBridgeProcesses('udp_multicast', BMSChannel, InverterChannel, str(tmp_path))
+   inverter = simulation.inverters[0]
+   takeover = (BMSSimulator.BMS2Inverter.readConfig(BMSSimulator.BMS2Inverter.ConfigFileName).get('redundancy') or {}).get('takeover-ms', 2500) / 1000
+   simulation.start()
+   try:
+      assert waitFor(lambda: inverter.received > 20, 20), 'the active bridge never fed the inverter'
+      assert inverter.maxSilence < 1.5
+      processes['active'].kill()
+      killed = inverter.received
+      assert waitFor(lambda: inverter.received > killed + 20, takeover + 10), 'the standby never took over'
+      #the longest silence is the takeover time plus at most one protocol period
+      assert takeover <= inverter.maxSilence < takeover + 1.5
+      assert processes['standby'].poll() is None
+
+      #restarted, the old active bridge stays standby and leaves the energy file to the sending one
+      consoleLog = tmp_path / 'restarted.log'
+      with open(consoleLog, 'w') as console:
+         processes['restarted'] = subprocess.Popen([sys.executable, os.path.join(RepoDirectory, 'BMS2Inverter.py')], cwd=tmp_path / 'active',
+                                                   stdout=console, stderr=subprocess.STDOUT)
+      #interrupted only once the startup report is out, main() handles Ctrl-C from its main loop
+      assert waitFor(lambda: 'Startup' in consoleLog.read_text(), 30)
+      assert 'configured active, starting standby' in (tmp_path / 'active' / 'log' / 'BMS2Inverter.log').read_text()
+      processes['restarted'].send_signal(signal.SIGINT)
+      processes['restarted'].wait(10)
+      assert not (tmp_path / 'active' / 'energy.json').exists()
+   finally:
+      simulation.stop()
+      for process in processes.values():
+         if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+               process.wait(10)
+            except subprocess.TimeoutExpired:
+               process.kill()
@@ -0,0 +1,65 @@
+import os
+import select
+import threading
+import tty
+
+import pytest
+
+from conftest import readTrace, replay
+
+
+def readResponse(fd, timeout=2):
+   response = b''
+   while not response.endswith(b'\r'):
+      readable, _, _ = select.select([fd], [], [], timeout)
+      if not readable:
+         return None
+      response += os.read(fd, 256)
+   return response
+
+@pytest.fixture
+def rs485(bridge):
+   # writeInverterRS485 on the slave side of a pty pair, the test is the inverter on the master side
+   replay(bridge, readTrace('discover.log'))
+   master, slave = os.openpty()
+   #raw before the writer opens it, a cooked pty turns the \r ending a request into \n
+   tty.setraw(slave)
+   runEvent = threading.Event()
+   runEvent.set()
+   thread = threading.Thread(target=bridge.writeInverterRS485, args=[runEvent, os.ttyname(slave), 9600, 15])
+   thread.start()
+   yield master
+   runEvent.clear()
+   thread.join()
+   os.close(slave)
+   os.close(master)
+
+def test_frame_matches_protocol_example(bridge):
+   assert bridge.pylonRS485Frame(0x02, 0x42, b'\x02') == b'~20024642E00202FD33\r'
+
+def test_analog_poll_over_pty(bridge, rs485):
+   os.write(rs485, bridge.pylonRS485Frame(0x02, 0x42, b'\x02'))
+   response = readResponse(rs485)
+   address, cid1, cid2, info = bridge.pylonRS485Parse(response[:-1])
+   assert (address, cid1, cid2) == (0x02, 0x46, bridge.PylonRS485Output.RTN_NORMAL)
+   assert info[2] == 15
+   assert int.from_bytes(info[3:5], 'big') == int(bridge.BMSBatteryMeasurements.batteryVoltage * 1000 / 15)
+   assert bridge.metrics.RS485Polls == 1
+
+@pytest.mark.parametrize('request_', [
+   b'~20024742E00202FD32',     #CID1 0x47 is not a battery
+   b'~20024642D00202FD34',     #LENGTH checksum nibble wrong
+   b'~20024642E00202FD34',     #frame checksum wrong
+])
+def test_bad_requests_are_not_answered(bridge, rs485, request_):
+   os.write(rs485, request_ + b'\r')
+   assert readResponse(rs485, timeout=0.5) is None
+   assert bridge.metrics.RS485Errors == 1
+
+def test_current_out_of_int16_range(bridge):
+   replay(bridge, readTrace('discover.log'))
+   bridge.BMSBatteryMeasurements.batteryCurrent = -400.0
+   output = bridge.PylonRS485Output(15)
+   _, _, _, info = bridge.pylonRS485Parse(output.respond(bridge.pylonRS485Frame(0x02, 0x42, b'\x02')[:-1])[:-1])
+   offset = 3 + 2 * 15 + 3
+   assert int.from_bytes(info[offset:offset + 2], 'big', signed=True) == -32768
@@ -0,0 +1,58 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+
+def test_apply_builds_new_settings(bridge):
+   posted = bridge.updateSettings({'hold-soc': 90, 'balance': True})
+   bridge.applyPendingSettings()
+   assert bridge.PendingSettings is None
+   assert bridge.CurrentSettings is not posted
+   assert bridge.CurrentSettings.holdSOC == 90
+   assert not bridge.CurrentSettings.balanceRequested
+   #the posted object is left as validated
+   assert posted.balanceRequested
+   assert bridge.InverterOutput.status.cellBalancing.balanceRequested
+
+def test_updates_build_on_pending_settings(bridge):
+   bridge.updateSettings({'hold-soc': 90})
+   bridge.updateSettings({'minutes': 45})
+   bridge.applyPendingSettings()
+   assert (bridge.CurrentSettings.holdSOC, bridge.CurrentSettings.cellBalancingMinutes) == (90, 45)
+   bridge.updateSettings({'interval-days': 7})
+   bridge.applyPendingSettings()
+   assert (bridge.CurrentSettings.holdSOC, bridge.CurrentSettings.cellBalancingInterval) == (90, 7)
+
+def test_on_demand_balance_starts_with_steady_soc(bridge):
+   cellBalancing = bridge.InverterOutput.status.cellBalancing
+   cellBalancing.lastBalanceDate = bridge.datetime.now()
+   holdSOC = bridge.CurrentSettings.holdSOC
+   steadySOC = holdSOC + 1
+   assert cellBalancing.evaluateSOC(steadySOC) == steadySOC
+   assert cellBalancing.evaluateSOC(steadySOC) == steadySOC
+   bridge.updateSettings({'balance': True})
+   bridge.applyPendingSettings()
+   assert cellBalancing.evaluateSOC(steadySOC) == holdSOC
+   assert cellBalancing.isCellBalancingActive
+   assert not cellBalancing.balanceRequested
+
+def test_on_demand_balance_waits_below_hold(bridge):
+   cellBalancing = bridge.InverterOutput.status.cellBalancing
+   holdSOC = bridge.CurrentSettings.holdSOC
+   bridge.updateSettings({'balance': True})
+   bridge.applyPendingSettings()
+   assert cellBalancing.evaluateSOC(holdSOC - 5) == holdSOC - 5
+   assert not cellBalancing.isCellBalancingActive
+   assert cellBalancing.balanceRequested
+
+@pytest.mark.parametrize('payload', [b'{"minutes": 1e999}', b'{"hold-soc": Infinity}', b'{"interval-days": -Infinity}',
+                                     b'{"hold-soc": NaN}'])
+def test_non_finite_command_is_rejected(bridge, monkeypatch, payload):
+   # MQTTCommand runs in paho's loop, nothing may escape it
+   published = []
+   monkeypatch.setattr(bridge, 'MQTTClient', SimpleNamespace(publish=lambda topic, payload: published.append(payload)),
+                       raising=False)
+   bridge.MQTTCommand(payload)
+   assert json.loads(published[0])['status'] == 'rejected'
+   assert bridge.PendingSettings is None
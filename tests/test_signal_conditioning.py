@@ -0,0 +1,44 @@
+from conftest import readTrace, replay
+
+from BMS2Inverter import ConfirmationFilter, RingBuffer
+
+
+def conditionedVoltages(bridge, frames):
+   # battery voltage after every 0x356, as the inverter encoders see it
+   voltages = []
+   for frame in frames:
+      replay(bridge, [frame])
+      if frame[0] == 0x356:
+         voltages.append(bridge.BMSBatteryMeasurements.batteryVoltage)
+   return voltages
+
+def test_lynk_low_voltage_glitches_are_filtered(bridge):
+   # discover.log: 46.2V in the first frame, one 46.5V glitch at 10s and
+   # 47.0V three times from 20s, lowVoltageWarning is 48.5V
+   voltages = conditionedVoltages(bridge, readTrace('discover.log'))
+   assert len(voltages) == 30
+   #no value accepted yet, held just above the warning rather than at it
+   assert voltages[0] == 48.6
+   assert all(voltage > 50 for voltage in voltages[1:10])
+   #the single glitch holds the previous reading
+   assert voltages[10] == voltages[9]
+   assert voltages[20] == voltages[21] == voltages[19]
+   #confirmed on the third consecutive sample
+   assert voltages[22] == 47.0
+   assert voltages[23] > 50
+
+def test_confirmation_high_threshold_margin():
+   confirmation = ConfirmationFilter('temperature', 2, high=60)
+   assert confirmation.apply(65, 0, b'') == 59.9
+   assert confirmation.apply(65, 1, b'') == 65
+
+def test_ring_buffer_median_tracks_the_window():
+   ring = RingBuffer(3, ordered=True)
+   medians = []
+   for value in (5, 1, 9, 7, 3, 3, 8):
+      ring.append(value)
+      medians.append(ring.median())
+   assert medians == [5, 3, 5, 7, 7, 3, 3]
+   ring.clear()
+   ring.append(2)
+   assert ring.median() == 2
@@ -0,0 +1,31 @@
+import logging
+import os
+import threading
+import time
+
+import BMS2Inverter
+from conftest import RepoDirectory
+
+
+def test_mqtt_connects_while_waiting_for_the_bms(tmp_path, monkeypatch):
+   # no BMS on the bus, main() waits readtimeout for a first frame with MQTT already up
+   monkeypatch.chdir(tmp_path)
+   os.makedirs('log')
+   config = BMS2Inverter.readConfig(os.path.join(RepoDirectory, BMS2Inverter.ConfigFileName))
+   config['BMS'].update({'interface': 'virtual', 'port': 'startup-bms', 'readtimeout': 2000})
+   config['inverter'].update({'interface': 'virtual', 'port': 'startup-inverter'})
+   BMS2Inverter.setConfigParams(config)
+   BMS2Inverter.logger = logging.getLogger('BMS2Inverter')
+   bridge = threading.Thread(target=BMS2Inverter.main, args=[config])
+   BMS2Inverter.MQTTClient = None
+   bridge.start()
+   try:
+      time.sleep(1)
+      assert bridge.is_alive()
+      #still in awaitFirstFrames
+      assert BMS2Inverter.metrics.StartupMs == 0
+      assert BMS2Inverter.MQTTClient is not None
+   finally:
+      BMS2Inverter.requestShutdown()
+      bridge.join(30)
+   assert not bridge.is_alive()